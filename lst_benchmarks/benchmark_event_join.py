@@ -0,0 +1,69 @@
+# Compare the sorted-key event join used by the dl1 reorganizers to astropy.table.join
+
+import time
+import argparse
+import numpy as np
+from astropy.table import Table, join
+from lst_scripts.reorganize_dl1hiperta_to_dl1lstchain import join_on_event_id
+
+parser = argparse.ArgumentParser(description="Benchmark the event join of the parameters and mc_shower tables")
+parser.add_argument('--n_events', '-e', type=int, nargs='+', default=[10000, 100000, 1000000],
+                    help='Number of simulated events (rows of the mc_shower table)')
+parser.add_argument('--n_tels', '-t', type=int, default=4,
+                    help='Number of telescopes. Each of them triggers 70 percent of the events')
+parser.add_argument('--n_repeats', '-r', type=int, default=3,
+                    help='Number of repetitions of each join. The best time is reported')
+
+
+def create_tables(n_events, n_tels, seed=0):
+    """
+    Create a parameters table (one row per triggered telescope and event, event_ids repeated among telescopes) and a
+    mc_shower table (one row per event), with the same kind of columns than the reorganized v0.6 files.
+    """
+    rng = np.random.default_rng(seed)
+    event_ids = np.arange(n_events, dtype=np.int64) * 100 + 1
+
+    mc_shower = np.zeros(n_events, dtype=[('event_id', 'i8')] + [(name, 'f8') for name in
+                                                                ['mc_energy', 'mc_alt', 'mc_az', 'mc_core_x',
+                                                                 'mc_core_y', 'mc_h_first_int', 'mc_x_max']])
+    mc_shower['event_id'] = rng.permutation(event_ids)
+    mc_shower['mc_energy'] = 10 ** rng.uniform(-2, 2, n_events)
+
+    parameter_tables = []
+    for tel_id in range(1, n_tels + 1):
+        selected_events = np.sort(rng.choice(event_ids, size=int(0.7 * n_events), replace=False))
+        parameters = np.zeros(len(selected_events), dtype=[('obs_id', 'i4'), ('event_id', 'i8'), ('tel_id', 'i2')] +
+                              [(f'param_{i}', 'f4') for i in range(20)])
+        parameters['event_id'] = selected_events
+        parameters['tel_id'] = tel_id
+        parameter_tables.append(parameters)
+
+    return np.concatenate(parameter_tables), mc_shower
+
+
+def best_time(function, n_repeats):
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    print(f"{'n_events':>10} {'n_rows':>10} {'astropy [s]':>12} {'sorted-key [s]':>15} {'speedup':>8}")
+    for n_events in args.n_events:
+        parameters, mc_shower = create_tables(n_events, args.n_tels)
+        astropy_time, expected = best_time(lambda: join(Table(parameters), Table(mc_shower),
+                                                        keys='event_id').as_array(), args.n_repeats)
+        sorted_key_time, joined = best_time(lambda: join_on_event_id(parameters, mc_shower), args.n_repeats)
+
+        # astropy does not keep the original order of the rows sharing the same event_id
+        assert joined.dtype == expected.dtype
+        assert np.array_equal(joined[np.lexsort((joined['tel_id'], joined['event_id']))],
+                              expected[np.lexsort((expected['tel_id'], expected['event_id']))])
+
+        print(f"{n_events:>10} {len(parameters):>10} {astropy_time:>12.3f} {sorted_key_time:>15.3f} "
+              f"{astropy_time / sorted_key_time:>8.1f}")
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+#
+# Benchmark of the orchestration overhead of the MC workflow (onsite_mc_r0_to_dl3), without a cluster.
+# Stand-in `sbatch`, `sacct`, `conda` and `lstchain_*` executables are put first in the PATH: sbatch returns consecutive
+# jobids (after an optional latency) and the lstchain ones write empty outputs. The workflow is run end to end on
+# synthetic (sparse) DL0 files, in a fresh process by number of files, and its time is broken down by phase:
+#   - directory_scans : listdir and the directory checks / (re)creations of data_management
+#   - list_writing : writing of the training/testing lists and sublists in r0_to_dl1
+#   - submissions : executor submits (sbatch calls with the slurm executor)
+#   - log_dumping : save_log_to_file
+#   - local_jobs : running the jobs, with the local executor only
+# The particles are batched concurrently (see workflow_management), so the time of a phase is summed over threads and
+# phases may add up to more than the total.
+#
+# usage:
+# python benchmark_orchestration.py [-n N_FILES ...] [--executor {slurm,local}] [--sbatch_latency SECONDS]
+#                                   [--job_duration SECONDS] [-d WORKDIR] [--save RESULTS.json]
+
+import io
+import os
+import sys
+import json
+import time
+import runpy
+import shutil
+import argparse
+import threading
+from contextlib import contextmanager, redirect_stdout
+from collections import defaultdict
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+
+LST_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lst_scripts')
+# Scripts run from the current directory by the workflow jobs
+JOB_SCRIPTS = ['core_list.sh', 'core_list_hiperta.sh', 'batch_dl1_utils-merge_and_copy.py',
+               'batch_dl1_utils-merge_tree.py', 'runtime_model.py', 'stage_cache.py']
+FAKE_EXECUTABLES = ['sbatch', 'sacct', 'conda', 'lstchain_mc_r0_to_dl1', 'lstchain_merge_hdf5_files',
+                    'lstchain_mc_trainpipe', 'lstchain_dl1_to_dl2']
+PARTICLES = ['electron', 'gamma', 'gamma-diffuse', 'proton']
+PHASES = ['directory_scans', 'list_writing', 'submissions', 'log_dumping', 'local_jobs']
+
+FAKE_EXECUTABLE = '''#!{python}
+# Stand-in of {name} for benchmark_orchestration
+import os
+import sys
+import time
+import fcntl
+
+sys.path.insert(0, {lst_scripts_dir!r})
+name = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+
+
+def arg(flag):
+    return args[args.index(flag) + 1]
+
+
+def touch(filename):
+    open(filename, 'a').close()
+
+
+if name in ['sbatch', 'sacct']:
+    time.sleep(float(os.environ.get('FAKE_SLURM_LATENCY', 0)))
+else:
+    time.sleep(float(os.environ.get('FAKE_JOB_DURATION', 0)))
+
+if name == 'sbatch':
+    with open(os.environ['FAKE_SLURM_JOBID_FILE'], 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        jobid = int(f.read() or 0) + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(jobid))
+    print(jobid)
+elif name == 'sacct':
+    print('JobID JobName NodeList CPUTime State ExitCode')
+elif name == 'lstchain_mc_r0_to_dl1':
+    from data_management import get_dl1_filename
+    touch(os.path.join(arg('-o'), get_dl1_filename(arg('-f'))))
+elif name == 'lstchain_merge_hdf5_files':
+    touch(arg('-o'))
+elif name == 'lstchain_mc_trainpipe':
+    for model in ['reg_energy.sav', 'reg_disp_vector.sav', 'cls_gh.sav']:
+        touch(os.path.join(arg('-o'), model))
+elif name == 'lstchain_dl1_to_dl2':
+    touch(os.path.join(arg('-o'), os.path.basename(arg('-f')).replace('dl1', 'dl2', 1)))
+'''
+
+parser = argparse.ArgumentParser(description="Benchmark the orchestration overhead of onsite_mc_r0_to_dl3")
+
+parser.add_argument('--n_files', '-n',
+                    type=int,
+                    nargs='+',
+                    dest='n_files',
+                    help='Number of DL0 files (all particles together). One benchmark per value',
+                    default=[100, 1000, 10000]
+                    )
+
+parser.add_argument('--executor', '-ex',
+                    type=str,
+                    dest='executor',
+                    choices=['slurm', 'local'],
+                    help='Executor of the workflow. `local` also runs the (stand-in) jobs. slurm by default',
+                    default='slurm'
+                    )
+
+parser.add_argument('--dl0_size_mb',
+                    type=float,
+                    dest='dl0_size_mb',
+                    help='Apparent size of the (sparse) DL0 files, sets the number of files by job. 50 by default',
+                    default=50
+                    )
+
+parser.add_argument('--sbatch_latency',
+                    type=float,
+                    dest='sbatch_latency',
+                    help='Seconds taken by each sbatch/sacct call. 0 by default',
+                    default=0
+                    )
+
+parser.add_argument('--job_duration',
+                    type=float,
+                    dest='job_duration',
+                    help='Seconds taken by each lstchain_* call (local executor). 0 by default',
+                    default=0
+                    )
+
+parser.add_argument('--workdir', '-d',
+                    type=str,
+                    dest='workdir',
+                    help='Directory of the synthetic productions. ./benchmark_orchestration by default',
+                    default='./benchmark_orchestration'
+                    )
+
+parser.add_argument('--save',
+                    type=str,
+                    dest='save',
+                    help='Save the results in this json file',
+                    default=None
+                    )
+
+
+class PhaseTimer:
+    """Time and number of calls by phase. Nested measures (e.g. listdir within a directory check) count once"""
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self, phase, elapsed):
+        with self._lock:
+            self.times[phase] += elapsed
+            self.calls[phase] += 1
+
+    @contextmanager
+    def measure(self, phase):
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self.add(phase, time.perf_counter() - start)
+
+    def wrap(self, function, phase):
+        def measured_function(*args, **kwargs):
+            with self.measure(phase):
+                return function(*args, **kwargs)
+        return measured_function
+
+
+class _TimedFile:
+    """Context manager of an open file, timing it from its opening until it is closed"""
+
+    def __init__(self, file, on_close):
+        self._file = file
+        self._on_close = on_close
+
+    def __enter__(self):
+        return self._file
+
+    def __exit__(self, *exc):
+        self._file.close()
+        self._on_close()
+
+
+def instrument_workflow(timer):
+    """
+    Wrap the functions of the workflow modules to measure the phases. Must be called before onsite_mc_r0_to_dl3 (and
+    the modules importing from data_management) are imported.
+    """
+    import data_management
+    import job_executor
+
+    os.listdir = timer.wrap(os.listdir, 'directory_scans')
+    for function in ['check_data_path', 'get_input_filelist', 'check_and_make_dir_without_verification',
+                     'check_job_logs', 'check_files_in_dir_from_file']:
+        setattr(data_management, function, timer.wrap(getattr(data_management, function), 'directory_scans'))
+    for executor_class in [job_executor.SlurmExecutor, job_executor.LocalExecutor]:
+        executor_class.submit = timer.wrap(executor_class.submit, 'submissions')
+    job_executor.LocalExecutor.wait = timer.wrap(job_executor.LocalExecutor.wait, 'local_jobs')
+
+    import workflow_management
+    import onsite_mc_r0_to_dl1
+    workflow_management.save_log_to_file = timer.wrap(workflow_management.save_log_to_file, 'log_dumping')
+
+    def timed_open(*args, **kwargs):
+        start = time.perf_counter()
+        return _TimedFile(open(*args, **kwargs), lambda: timer.add('list_writing', time.perf_counter() - start))
+    onsite_mc_r0_to_dl1.open = timed_open
+
+
+def create_fake_bin(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    for name in FAKE_EXECUTABLES:
+        filename = os.path.join(bin_dir, name)
+        with open(filename, 'w') as f:
+            f.write(FAKE_EXECUTABLE.format(python=sys.executable, name=name,
+                                           lst_scripts_dir=os.path.abspath(LST_SCRIPTS_DIR)))
+        os.chmod(filename, 0o755)
+
+
+def create_dl0_files(base_path, n_files, size_mb=50):
+    """Empty sparse DL0 files, split among the particles, with the directory layout of onsite_mc_r0_to_dl3"""
+    for i, particle in enumerate(PARTICLES):
+        dl0_dir = os.path.join(base_path, 'DL0', '20190415', particle, 'south_pointing')
+        os.makedirs(dl0_dir, exist_ok=True)
+        for j in range(i, n_files, len(PARTICLES)):
+            with open(os.path.join(dl0_dir, f'{particle}_run{j}.simtel.gz'), 'w') as f:
+                f.truncate(int(size_mb * 1e6))
+
+
+def run_workflow(workdir, executor='slurm', sbatch_latency=0, job_duration=0):
+    """
+    Run onsite_mc_r0_to_dl3 on the production of `workdir` and measure it by phase. Meant to be run in a fresh process.
+
+    Returns
+    -------
+    dict
+        phase --> {'time_s', 'calls'}, the whole workflow being the `total` phase
+    """
+    os.chdir(workdir)
+    for script in JOB_SCRIPTS:
+        shutil.copy(os.path.join(LST_SCRIPTS_DIR, script), script)
+    os.environ['PATH'] = os.path.abspath('bin') + os.pathsep + os.environ['PATH']
+    os.environ['PYTHONPATH'] = os.path.abspath(os.path.join(LST_SCRIPTS_DIR, os.pardir)) + os.pathsep + \
+        os.environ.get('PYTHONPATH', '')
+    os.environ['FAKE_SLURM_JOBID_FILE'] = os.path.abspath('last_jobid')
+    os.environ['FAKE_SLURM_LATENCY'] = str(sbatch_latency)
+    os.environ['FAKE_JOB_DURATION'] = str(job_duration)
+    sys.path.insert(0, LST_SCRIPTS_DIR)
+
+    timer = PhaseTimer()
+    instrument_workflow(timer)
+
+    sys.argv = ['onsite_mc_r0_to_dl3.py', '--base_path', os.path.abspath('mc'), '--prod_id', 'benchmark',
+                '--executor', executor]
+    # answer the confirmation query of the workflow
+    sys.stdin = io.StringIO('y\n')
+    with open('workflow.log', 'w') as log, redirect_stdout(log):
+        start = time.perf_counter()
+        runpy.run_path(os.path.join(LST_SCRIPTS_DIR, 'onsite_mc_r0_to_dl3.py'), run_name='__main__')
+        total = time.perf_counter() - start
+
+    results = {phase: {'time_s': timer.times[phase], 'calls': timer.calls[phase]} for phase in PHASES}
+    results['total'] = {'time_s': total, 'calls': 1}
+
+    return results
+
+
+def benchmark_orchestration(n_files_list, executor='slurm', dl0_size_mb=50, sbatch_latency=0, job_duration=0,
+                            workdir='./benchmark_orchestration'):
+    """
+    Create the synthetic productions and run the workflow on them.
+
+    Returns
+    -------
+    dict
+        '{n_files}_files' --> phase --> measures
+    """
+    results = {}
+
+    for n_files in n_files_list:
+        production_dir = os.path.abspath(os.path.join(workdir, f'{n_files}_files'))
+        shutil.rmtree(production_dir, ignore_errors=True)
+        create_fake_bin(os.path.join(production_dir, 'bin'))
+        create_dl0_files(os.path.join(production_dir, 'mc'), n_files, dl0_size_mb)
+
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            results[f'{n_files}_files'] = pool.submit(run_workflow, production_dir, executor, sbatch_latency,
+                                                      job_duration).result()
+
+    return results
+
+
+def print_results(results):
+    print(f"\n{'run':<14}{'phase':<18}{'time (s)':>10}{'calls':>8}")
+    for run, phases in results.items():
+        for phase, measures in phases.items():
+            print(f"{run:<14}{phase:<18}{measures['time_s']:>10.3f}{measures['calls']:>8}")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = benchmark_orchestration(args.n_files, args.executor, args.dl0_size_mb, args.sbatch_latency,
+                                      args.job_duration, args.workdir)
+    print_results(results)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#
+# Benchmark of the dl1 reorganizers on synthetic files: wall time, peak RSS and bytes written by stage.
+# Each conversion runs in a fresh process, so that the peak RSS of a run is not biased by the previous ones.
+#
+# usage:
+# python benchmark_reorganizers.py [-e N_EVENTS ...] [-t N_TELS] [-d WORKDIR] [--save RESULTS.json]
+#                                  [--reference REFERENCE.json] [--tolerance 0.2]
+
+import os
+import json
+import time
+import argparse
+import resource
+from contextlib import contextmanager
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from synthetic_dl1_files import create_hiperta_v300_file, create_hipecta_file
+
+REORGANIZERS = ['hiperta300', 'hipecta']
+
+parser = argparse.ArgumentParser(description="Benchmark the dl1 reorganizers on synthetic files")
+
+parser.add_argument('--n_events', '-e',
+                    type=int,
+                    nargs='+',
+                    dest='n_events',
+                    help='Number of simulated events of the synthetic files. One benchmark per value',
+                    default=[2000, 10000]
+                    )
+
+parser.add_argument('--n_tels', '-t',
+                    type=int,
+                    dest='n_tels',
+                    help='Number of telescopes of the synthetic files. 4 by default',
+                    default=4
+                    )
+
+parser.add_argument('--reorganizers', '-r',
+                    type=str,
+                    nargs='+',
+                    dest='reorganizers',
+                    choices=REORGANIZERS,
+                    help='Reorganizers to benchmark. All by default',
+                    default=REORGANIZERS
+                    )
+
+parser.add_argument('--chunk_size', '-cs',
+                    type=int,
+                    dest='chunk_size',
+                    help='Chunk size passed to the reorganizers. Their default if not given',
+                    default=None
+                    )
+
+parser.add_argument('--workdir', '-d',
+                    type=str,
+                    dest='workdir',
+                    help='Directory of the synthetic and output files. ./benchmark_reorganizers by default',
+                    default='./benchmark_reorganizers'
+                    )
+
+parser.add_argument('--save',
+                    type=str,
+                    dest='save',
+                    help='Save the results in this json file',
+                    default=None
+                    )
+
+parser.add_argument('--reference',
+                    type=str,
+                    dest='reference',
+                    help='json file of a previous run (see --save). Stages slower, or using more memory, than the '
+                         'reference by more than the tolerance are reported and the exit code is 1',
+                    default=None
+                    )
+
+parser.add_argument('--tolerance',
+                    type=float,
+                    dest='tolerance',
+                    help='Relative tolerance of the comparison with the reference. 0.2 by default',
+                    default=0.2
+                    )
+
+
+def get_written_bytes():
+    """
+    Bytes written by the current process (`wchar` of /proc/self/io, i.e. passed to write(), page cache included).
+    None if not available (non Linux).
+    """
+    try:
+        with open('/proc/self/io') as f:
+            io_counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io_counters['wchar'])
+    except (OSError, KeyError):
+        return None
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the current process (Linux >= 4.0), so that it can be measured by stage"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss_mb():
+    """Peak RSS of the current process in MB (since the last `reset_peak_rss` if supported)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1e3
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+@contextmanager
+def measure(stage, results):
+    """Record the wall time, peak RSS and bytes written of the code run within the context in `results[stage]`"""
+    reset_peak_rss()
+    written_bytes = get_written_bytes()
+    start = time.perf_counter()
+    yield
+    results[stage] = {'wall_time_s': time.perf_counter() - start,
+                      'peak_rss_MB': get_peak_rss_mb(),
+                      'written_MB': None if written_bytes is None else (get_written_bytes() - written_bytes) / 1e6}
+
+
+def instrument_stages(module, stage_names, results):
+    """Wrap the functions `stage_names` of `module`, called by the reorganizer, to measure them as stages"""
+    for stage_name in stage_names:
+        function = getattr(module, stage_name)
+
+        def measured_function(*args, _function=function, _stage_name=stage_name, **kwargs):
+            with measure(_stage_name, results):
+                return _function(*args, **kwargs)
+
+        setattr(module, stage_name, measured_function)
+
+
+def run_reorganizer(reorganizer, input_filename, output_filename, chunk_size=None):
+    """
+    Run one reorganizer and measure it by stage. Meant to be run in a fresh process.
+
+    Returns
+    -------
+    dict
+        stage --> {'wall_time_s', 'peak_rss_MB', 'written_MB'}, the whole conversion being the `total` stage
+    """
+    from lst_scripts import reorganize_dl1hiperta_to_dl1lstchain as reorganizer_module
+    from lst_scripts import reorganize_dl1hiperta300_to_dl1lstchain060 as reorganizer300_module
+
+    results = {}
+    kwargs = {} if chunk_size is None else {'chunk_size': chunk_size}
+    if reorganizer == 'hiperta300':
+        instrument_stages(reorganizer300_module, ['create_hfile_out'], results)
+        reorganize = reorganizer300_module.main
+    else:
+        instrument_stages(reorganizer_module, ['create_final_h5'], results)
+        reorganize = reorganizer_module.reorganize_dl1
+
+    with measure('total', results):
+        reorganize(input_filename, output_filename, **kwargs)
+
+    # The peak RSS is reset by each stage, the one of the whole conversion is the highest of them
+    results['total']['peak_rss_MB'] = max(measures['peak_rss_MB'] for measures in results.values())
+    results['total']['output_MB'] = os.path.getsize(output_filename) / 1e6
+    os.remove(output_filename)
+
+    return results
+
+
+def benchmark_reorganizers(n_events_list, n_tels=4, reorganizers=REORGANIZERS, workdir='./benchmark_reorganizers',
+                           chunk_size=None):
+    """
+    Create synthetic files and benchmark the reorganizers on them.
+
+    Returns
+    -------
+    dict
+        '{reorganizer}_{n_events}' --> stage --> measures
+    """
+    os.makedirs(workdir, exist_ok=True)
+    create_file = {'hiperta300': create_hiperta_v300_file, 'hipecta': create_hipecta_file}
+    results = {}
+
+    for reorganizer in reorganizers:
+        for n_events in n_events_list:
+            input_filename = os.path.join(workdir, f'dl1_gamma_{reorganizer}_{n_events}.h5')
+            output_filename = os.path.join(workdir, f'dl1v06_reorganized_gamma_{reorganizer}_{n_events}.h5')
+            if not os.path.exists(input_filename):
+                create_file[reorganizer](input_filename, n_events=n_events, n_tels=n_tels)
+
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                results[f'{reorganizer}_{n_events}'] = executor.submit(run_reorganizer, reorganizer, input_filename,
+                                                                       output_filename, chunk_size).result()
+
+    return results
+
+
+def print_results(results):
+    print(f"\n{'run':<22}{'stage':<45}{'wall (s)':>10}{'peak RSS (MB)':>15}{'written (MB)':>14}")
+    for run, stages in results.items():
+        for stage, measures in stages.items():
+            written = '-' if measures['written_MB'] is None else f"{measures['written_MB']:.1f}"
+            print(f"{run:<22}{stage:<45}{measures['wall_time_s']:>10.2f}{measures['peak_rss_MB']:>15.0f}"
+                  f"{written:>14}")
+
+
+def compare_to_reference(results, reference, tolerance=0.2):
+    """
+    List the stages whose wall time or peak RSS exceed the ones of the reference by more than `tolerance`.
+
+    Returns
+    -------
+    list of str
+    """
+    regressions = []
+    for run, stages in results.items():
+        for stage, measures in stages.items():
+            reference_measures = reference.get(run, {}).get(stage)
+            if reference_measures is None:
+                continue
+            for key in ['wall_time_s', 'peak_rss_MB']:
+                if measures[key] > (1 + tolerance) * reference_measures[key]:
+                    regressions.append(f'{run} {stage} {key}: {measures[key]:.2f} (reference '
+                                       f'{reference_measures[key]:.2f})')
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = benchmark_reorganizers(args.n_events, args.n_tels, args.reorganizers, args.workdir, args.chunk_size)
+    print_results(results)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.reference is not None:
+        with open(args.reference) as f:
+            regressions = compare_to_reference(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+#
+# Synthetic dl1 files with the layout of the HiPeRTA v3.0.0 (dl1 v0.8 data model) and HiPeCTA outputs, to test and
+# benchmark the dl1 reorganizers without production data.
+#
+# usage:
+# python synthetic_dl1_files.py OUTFILE [-e N_EVENTS] [-t N_TELS] [--hipecta] [--no_images]
+
+import argparse
+import numpy as np
+import tables
+
+LST_FOCAL_LENGTH = 28.
+LSTCAM_N_PIXELS = 1855
+
+parser = argparse.ArgumentParser(description="Create a synthetic HiPeRTA v3.0.0 (dl1 v0.8) or HiPeCTA dl1 file")
+
+parser.add_argument('outfile', type=str,
+                    help='Output filename. Include `gamma`, `proton` or `electron` in it to set the mc_type')
+
+parser.add_argument('--n_events', '-e',
+                    type=int,
+                    dest='n_events',
+                    help='Number of simulated events. 1000 by default',
+                    default=1000
+                    )
+
+parser.add_argument('--n_tels', '-t',
+                    type=int,
+                    dest='n_tels',
+                    help='Number of telescopes. 4 by default',
+                    default=4
+                    )
+
+parser.add_argument('--n_pixels', '-p',
+                    type=int,
+                    dest='n_pixels',
+                    help=f'Number of pixels of the camera. {LSTCAM_N_PIXELS} by default',
+                    default=LSTCAM_N_PIXELS
+                    )
+
+parser.add_argument('--trigger_fraction',
+                    type=float,
+                    dest='trigger_fraction',
+                    help='Fraction of the events seen by each telescope. 0.7 by default',
+                    default=0.7
+                    )
+
+parser.add_argument('--hipecta',
+                    action='store_true',
+                    dest='hipecta',
+                    help='Create a HiPeCTA file (input of `reorganize_dl1`) instead of a HiPeRTA v3.0.0 one',
+                    )
+
+parser.add_argument('--no_images',
+                    action='store_false',
+                    dest='images',
+                    help='Do not write the images tables',
+                    )
+
+
+def _simulated_showers(rng, n_events, pointing_alt, pointing_az):
+    """Event ids and true parameters of `n_events` showers around the pointing direction"""
+    event_ids = np.arange(n_events, dtype=np.int64) * 3 + 100
+    energy = 10 ** rng.uniform(-2, 2, n_events)
+    alt = pointing_alt + rng.normal(0, 0.02, n_events)
+    az = pointing_az + rng.normal(0, 0.02, n_events)
+    return event_ids, energy, alt, az
+
+
+def _triggered_events(rng, event_ids, trigger_fraction):
+    """Sorted event ids seen by one telescope"""
+    return np.sort(rng.choice(event_ids, size=int(trigger_fraction * len(event_ids)), replace=False))
+
+
+def create_hiperta_v300_file(filename, n_events=1000, n_tels=4, n_pixels=LSTCAM_N_PIXELS, images=True,
+                             trigger_fraction=0.7, seed=0):
+    """
+    Create a synthetic dl1 file with the layout of the HiPeRTA v3.0.0 output (ctapipe dl1 v0.8 data model), input of
+    `reorganize_dl1hiperta300_to_dl1lstchain060`:
+        /simulation/service/shower_distribution, /simulation/event/subarray/shower
+        /configuration/simulation/run, /configuration/instrument/...
+        /dl1/event/subarray/trigger
+        /dl1/event/telescope/parameters/tel_00X, /dl1/event/telescope/images/tel_00X
+
+    Parameters
+    ----------
+    filename: str
+    n_events: int
+        Number of simulated showers
+    n_tels: int
+        Number of telescopes
+    n_pixels: int
+        Number of pixels of the images
+    images: bool
+        Write the images tables
+    trigger_fraction: float
+        Fraction of the events seen by each telescope
+    seed: int
+        Random seed
+    """
+    rng = np.random.default_rng(seed)
+    pointing_alt, pointing_az = np.deg2rad(70), np.pi
+    event_ids, energy, alt, az = _simulated_showers(rng, n_events, pointing_alt, pointing_az)
+    filters = tables.Filters(complevel=1, complib='zlib')
+
+    with tables.open_file(filename, 'w', filters=filters) as hfile:
+        hfile.create_table('/simulation/service', 'shower_distribution', createparents=True,
+                           obj=np.zeros(1, dtype=[('obs_id', 'i4'), ('n_entries', 'i8'),
+                                                  ('histogram', 'f4', (10, 10))]))
+
+        shower = np.zeros(n_events, dtype=[('obs_id', 'i4'), ('event_id', 'i8'), ('true_energy', 'f8'),
+                                           ('true_alt', 'f8'), ('true_az', 'f8'), ('true_core_x', 'f8'),
+                                           ('true_core_y', 'f8'), ('true_h_first_int', 'f8'), ('true_x_max', 'f8'),
+                                           ('true_shower_primary_id', 'i4')])
+        shower['obs_id'] = 1
+        shower['event_id'] = event_ids
+        shower['true_energy'] = energy
+        shower['true_alt'] = alt
+        shower['true_az'] = az
+        for col in ['true_core_x', 'true_core_y', 'true_h_first_int', 'true_x_max']:
+            shower[col] = rng.normal(0, 100, n_events)
+        hfile.create_table('/simulation/event/subarray', 'shower', obj=shower, createparents=True)
+
+        run = np.zeros(1, dtype=[('obs_id', 'i4'), ('run_array_direction', 'f8', (2,)), ('energy_range_min', 'f8')])
+        run['run_array_direction'][0] = [pointing_az, pointing_alt]
+        hfile.create_table('/configuration/simulation', 'run', obj=run, createparents=True)
+
+        hfile.create_table('/configuration/instrument/telescope/camera', 'geometry_LSTCam', createparents=True,
+                           obj=np.zeros(n_pixels, dtype=[('pix_id', 'i4'), ('pix_x', 'f8'), ('pix_y', 'f8')]))
+        hfile.create_table('/configuration/instrument/telescope/camera', 'readout_LSTCam',
+                           obj=np.zeros(10, dtype=[('reference_pulse_shape', 'f8')]))
+        hfile.create_table('/configuration/instrument/telescope', 'optics',
+                           obj=np.array([(LST_FOCAL_LENGTH, b'LST')], dtype=[('equivalent_focal_length', 'f8'),
+                                                                             ('name', 'S5')]))
+        hfile.create_table('/configuration/instrument/subarray', 'layout', createparents=True,
+                           obj=np.zeros(n_tels, dtype=[('tel_id', 'i4'), ('pos_x', 'f8')]))
+
+        hfile.create_table('/dl1/event/subarray', 'trigger', createparents=True,
+                           obj=np.array(list(zip(np.ones(n_events), event_ids)),
+                                        dtype=[('obs_id', 'i4'), ('event_id', 'i8')]))
+
+        hillas_columns = ['hillas_intensity', 'hillas_x', 'hillas_y', 'hillas_r', 'hillas_phi', 'hillas_length',
+                          'hillas_width', 'hillas_psi', 'hillas_skewness', 'hillas_kurtosis', 'timing_slope',
+                          'timing_intercept', 'leakage_intensity_width_1', 'leakage_intensity_width_2']
+        parameters_dtype = [('obs_id', 'i4'), ('event_id', 'i8'), ('tel_id', 'i2')] + \
+                           [(col, 'f4') for col in hillas_columns] + \
+                           [('morphology_num_pixels', 'i4'), ('morphology_num_islands', 'i4')]
+        images_dtype = [('obs_id', 'i4'), ('event_id', 'i8'), ('tel_id', 'i2'), ('image', 'f4', (n_pixels,)),
+                        ('peak_time', 'f4', (n_pixels,)), ('image_mask', '?', (n_pixels,))]
+
+        for tel_id in range(1, n_tels + 1):
+            tel_events = _triggered_events(rng, event_ids, trigger_fraction)
+
+            parameters = np.zeros(len(tel_events), dtype=parameters_dtype)
+            parameters['obs_id'] = 1
+            parameters['event_id'] = tel_events
+            parameters['tel_id'] = tel_id
+            for col in hillas_columns:
+                parameters[col] = rng.uniform(0.1, 1, len(tel_events))
+            parameters['hillas_intensity'] *= 1000
+            parameters['morphology_num_pixels'] = rng.integers(5, 100, len(tel_events))
+            parameters['morphology_num_islands'] = rng.integers(1, 3, len(tel_events))
+            hfile.create_table('/dl1/event/telescope/parameters', f'tel_{tel_id:03d}', obj=parameters,
+                               createparents=True)
+
+            if images:
+                tel_images = np.zeros(len(tel_events), dtype=images_dtype)
+                tel_images['obs_id'] = 1
+                tel_images['event_id'] = tel_events
+                tel_images['tel_id'] = tel_id
+                tel_images['image'] = rng.normal(0, 1, (len(tel_events), n_pixels))
+                tel_images['peak_time'] = rng.normal(10, 1, (len(tel_events), n_pixels))
+                tel_images['image_mask'] = tel_images['image'] > 1
+                hfile.create_table('/dl1/event/telescope/images', f'tel_{tel_id:03d}', obj=tel_images,
+                                   createparents=True)
+
+
+def create_hipecta_file(filename, n_events=1000, n_tels=4, n_pixels=LSTCAM_N_PIXELS, images=True,
+                        trigger_fraction=0.7, seed=0):
+    """
+    Create a synthetic dl1 file with the layout of the HiPeCTA output, input of `reorganize_dl1`:
+        /instrument/subarray/telescope/optics
+        /simulation/mc_event, /simulation/run_config
+        /dl1/tel_00X/parameters, /dl1/tel_00X/calib_pic
+
+    Parameters
+    ----------
+    See `create_hiperta_v300_file`
+    """
+    rng = np.random.default_rng(seed)
+    pointing_alt, pointing_az = np.deg2rad(70), np.pi
+    event_ids, energy, alt, az = _simulated_showers(rng, n_events, pointing_alt, pointing_az)
+
+    with tables.open_file(filename, 'w') as hfile:
+        hfile.create_table('/instrument/subarray/telescope', 'optics', createparents=True,
+                           obj=np.array([(LST_FOCAL_LENGTH,)], dtype=[('equivalent_focal_length', 'f8')]))
+
+        mc_event = np.zeros(n_events, dtype=[('event_id', 'i8'), ('mc_energy', 'f8'), ('mc_alt', 'f8'),
+                                             ('mc_az', 'f8')])
+        mc_event['event_id'] = event_ids
+        mc_event['mc_energy'] = energy
+        mc_event['mc_alt'] = alt
+        mc_event['mc_az'] = az
+        hfile.create_table('/simulation', 'mc_event', obj=mc_event, createparents=True)
+
+        run_config = np.zeros(1, dtype=[('run_array_direction', 'f8', (2,))])
+        run_config['run_array_direction'][0] = [pointing_az, pointing_alt]
+        hfile.create_table('/simulation', 'run_config', obj=run_config)
+
+        parameter_columns = ['intensity', 'x', 'y', 'width', 'length', 'leakage_intensity1', 'leakage_intensity2',
+                             'leakage_pixel1', 'leakage_pixel2']
+        for tel_id in range(1, n_tels + 1):
+            tel_events = _triggered_events(rng, event_ids, trigger_fraction)
+
+            parameters = np.zeros(len(tel_events), dtype=[('event_id', 'i8')] +
+                                                         [(col, 'f4') for col in parameter_columns] +
+                                                         [('nb_selected_pixel', 'i4')])
+            parameters['event_id'] = tel_events
+            for col in parameter_columns:
+                parameters[col] = rng.uniform(0.1, 1, len(tel_events))
+            hfile.create_table(f'/dl1/tel_{tel_id:03d}', 'parameters', obj=parameters, createparents=True)
+
+            if images:
+                calib_pic = np.zeros(len(tel_events), dtype=[('eventId', 'i8'), ('image', 'f4', (n_pixels,)),
+                                                             ('pulse_time', 'f4', (n_pixels,))])
+                calib_pic['eventId'] = tel_events
+                calib_pic['image'] = rng.normal(0, 1, (len(tel_events), n_pixels))
+                calib_pic['pulse_time'] = rng.normal(10, 1, (len(tel_events), n_pixels))
+                hfile.create_table(f'/dl1/tel_{tel_id:03d}', 'calib_pic', obj=calib_pic)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    create_file = create_hipecta_file if args.hipecta else create_hiperta_v300_file
+    create_file(args.outfile, n_events=args.n_events, n_tels=args.n_tels, n_pixels=args.n_pixels,
+                images=args.images, trigger_fraction=args.trigger_fraction)
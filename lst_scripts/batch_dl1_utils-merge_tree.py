@@ -0,0 +1,224 @@
+#!/usr//bin/env python3
+
+# Merge of one group of DL1 files of a tree-reduction merge (see onsite_mc_merge_and_copy_dl1).
+#
+# The DL1 files of a directory are sorted and split into groups of FAN_IN files. The group (by default the slurm array
+# task id) is merged with lstchain_merge_hdf5_files into OUTPUT_DIR/dl1_merged_{group}.h5, or into OUTPUT_FILE for the
+# last level of the tree. The files of the group can also be given in a FILE_LIST, and appended in place to OUTPUT_FILE
+# (streaming merge of the files of some r0_to_dl1 tasks).
+
+import os
+import sys
+import shutil
+import argparse
+import tables
+import subprocess
+from distutils.util import strtobool
+
+# Rows of the tables appended at once by a streaming merge
+APPEND_CHUNK_ROWS = 100000
+
+# Groups of the event tables merged by lstchain_merge_hdf5_files. The other tables (instrument, run_config,
+# thrown_event_distribution) describe the production and are kept from the first merged file.
+EVENT_GROUPS = ('/dl1/event/', '/simulation/event/')
+
+# Group of the images of the DL1 files reorganized with `--image_storage arrays` (see
+# reorganize_dl1hiperta300_to_dl1lstchain060), instead of the LST_LSTCam table. Not readable by lstchain: such files
+# are refused by the merge
+IMAGE_ARRAYS_GROUP = 'LST_LSTCam_arrays'
+
+parser = argparse.ArgumentParser(description="Merge a group of DL1 files, one level of a tree-reduction merge")
+
+parser.add_argument('--input_dir', '-i', type=str,
+                    dest='input_dir',
+                    help='directory of the DL1 files to be merged, by groups of FAN_IN files',
+                    )
+
+parser.add_argument('--fan_in', '-fi', type=int,
+                    dest='fan_in',
+                    help='number of files merged by group',
+                    )
+
+parser.add_argument('--file_list', '-l', type=str,
+                    dest='file_list',
+                    help='file with the DL1 files of the group (one by line), instead of INPUT_DIR and FAN_IN',
+                    default=None
+                    )
+
+parser.add_argument('--group', '-g', type=int,
+                    dest='group',
+                    help='index of the group to merge. SLURM_ARRAY_TASK_ID (or 0 if not a job array) by default',
+                    default=None
+                    )
+
+parser.add_argument('--output_dir', '-o', type=str,
+                    dest='output_dir',
+                    help='directory of the merged file of the group (intermediate levels)',
+                    default=None
+                    )
+
+parser.add_argument('--output_file', '-f', type=str,
+                    dest='output_file',
+                    help='merged file (last level, a single group)',
+                    default=None
+                    )
+
+parser.add_argument('--no-image', type=str,
+                    dest='no_image',
+                    help='--no-image argument of lstchain_merge_hdf5_files',
+                    default='True'
+                    )
+
+parser.add_argument('--smart', type=str,
+                    dest='smart',
+                    help='--smart argument of lstchain_merge_hdf5_files',
+                    default='False'
+                    )
+
+parser.add_argument('--intermediate', type=lambda x: bool(strtobool(x)),
+                    dest='intermediate',
+                    help='The input files are the merged files of the previous level, removed once merged',
+                    default=False
+                    )
+
+parser.add_argument('--append', type=lambda x: bool(strtobool(x)),
+                    dest='append',
+                    help='Append the files of the group to OUTPUT_FILE, if it exists (streaming merge)',
+                    default=False
+                    )
+
+parser.add_argument('--cleanup_dir', type=str,
+                    dest='cleanup_dir',
+                    help='directory (with the intermediate files) removed once the group is merged',
+                    default=None
+                    )
+
+
+def append_dl1_files(output_file, files, smart=False):
+    """
+    Append the rows of the event tables (see EVENT_GROUPS) of `files` to the same tables of `output_file`, in place.
+    The event tables not in `output_file` (e.g. the images, merged with `--no-image`) are skipped.
+
+    Parameters
+    ----------
+    output_file: str
+    files: list of str
+    smart: bool
+        skip (instead of failing on) the files whose event tables do not have the columns of the output ones, as
+        `lstchain_merge_hdf5_files --smart`
+
+    Returns
+    -------
+    list of str
+        the appended files
+    """
+    appended_files = []
+    with tables.open_file(output_file, 'a') as out:
+        out_tables = [table for table in out.walk_nodes('/', 'Table') if table._v_pathname.startswith(EVENT_GROUPS)]
+        for file in files:
+            with tables.open_file(file) as f:
+                compatible = all(table._v_pathname in f and
+                                 f.get_node(table._v_pathname).colnames == table.colnames for table in out_tables)
+                if not compatible:
+                    if smart:
+                        print(f'{file} event tables not compatible with {output_file}, not merged')
+                        continue
+                    raise ValueError(f'{file} event tables not compatible with {output_file}')
+
+                for out_table in out_tables:
+                    table = f.get_node(out_table._v_pathname)
+                    for start in range(0, table.nrows, APPEND_CHUNK_ROWS):
+                        out_table.append(table.read(start, start + APPEND_CHUNK_ROWS).astype(out_table.dtype))
+                    out_table.flush()
+            appended_files.append(file)
+
+    return appended_files
+
+
+def has_image_arrays(file):
+    """The DL1 file stores its images in an IMAGE_ARRAYS_GROUP group instead of the lstchain LST_LSTCam table"""
+    if not tables.is_hdf5_file(file):
+        return False
+    with tables.open_file(file) as f:
+        return '/dl1' in f and any(group._v_name == IMAGE_ARRAYS_GROUP for group in f.walk_groups('/dl1'))
+
+
+def get_group_files(input_dir, fan_in, group, intermediate=False):
+    """
+    DL1 files of `input_dir` belonging to the group `group` (groups of `fan_in` sorted files).
+
+    The merged files of the previous level (`intermediate`) are selected by their index and not by their position: the
+    other groups of the level remove theirs while this one is listed.
+    """
+    if intermediate:
+        files = [os.path.join(input_dir, f'dl1_merged_{index:04d}.h5')
+                 for index in range(group * fan_in, (group + 1) * fan_in)]
+        return [f for f in files if os.path.isfile(f)]
+
+    files = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir)
+                   if f.endswith('.h5') and os.path.isfile(os.path.join(input_dir, f)))
+    return files[group * fan_in:(group + 1) * fan_in]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    group = args.group if args.group is not None else int(os.environ.get('SLURM_ARRAY_TASK_ID', 0))
+    if args.file_list is not None:
+        with open(args.file_list) as f:
+            listed_files = [line.rstrip('\n') for line in f if line.strip() != '']
+        group_files = [file for file in listed_files if os.path.isfile(file)]
+        for file in sorted(set(listed_files) - set(group_files)):
+            print(f'{file} not found, not merged')
+    else:
+        group_files = get_group_files(args.input_dir, args.fan_in, group, args.intermediate)
+
+    image_arrays_files = [file for file in group_files if has_image_arrays(file)]
+    if image_arrays_files:
+        sys.exit('DL1 files with `arrays` images, not readable by lstchain (reorganize them with `--image_storage '
+                 'table`):\n' + '\n'.join(image_arrays_files))
+
+    if args.output_file is not None:
+        output_file = args.output_file
+    else:
+        output_file = os.path.join(args.output_dir, f'dl1_merged_{group:04d}.h5')
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(output_dir, exist_ok=True)
+    # a merged file left by a previous attempt is replaced, unless this job extends the running merged file
+    if not args.append and os.path.exists(output_file):
+        os.remove(output_file)
+
+    if not group_files:
+        # the number of groups is computed from the expected DL1 files: the last ones are empty if some are missing
+        print(f'No files in the group {group} of {args.file_list or args.input_dir}, nothing to merge')
+
+    elif args.append and os.path.isfile(output_file):
+        appended_files = append_dl1_files(output_file, group_files, bool(strtobool(args.smart)))
+        print(f'{len(appended_files)} files of group {group} appended to {output_file}')
+
+    else:
+        # lstchain_merge_hdf5_files merges a whole directory: link the files of the group into their own one
+        group_dir = os.path.splitext(output_file)[0] + '_inputs'
+        if os.path.exists(group_dir):
+            shutil.rmtree(group_dir)
+        os.makedirs(group_dir)
+        for file in group_files:
+            os.symlink(os.path.abspath(file), os.path.join(group_dir, os.path.basename(file)))
+
+        subprocess.run(f'lstchain_merge_hdf5_files -d {group_dir} -o {output_file} --no-image {args.no_image} '
+                       f'--smart {args.smart}', shell=True, check=True)
+        print(f'{len(group_files)} files of group {group} merged into {output_file}')
+        shutil.rmtree(group_dir)
+
+    if args.intermediate:
+        for file in group_files:
+            os.remove(file)
+
+    # The last job of a merge must have written the merged file (the first jobs of a streaming merge may have had
+    # nothing to append yet)
+    last_job = args.output_file is not None and (not args.append or args.cleanup_dir is not None)
+    if last_job and not os.path.isfile(output_file):
+        sys.exit(f'No files merged into {output_file}')
+
+    if args.cleanup_dir is not None:
+        shutil.rmtree(args.cleanup_dir, ignore_errors=True)
@@ -1,5 +1,7 @@
 #!/bin/sh
 # slurm core job - send a job with the command passed as arg1 on every line in the file passed as arg2
+# Within a job array, arg2 is the prefix of the sublists and the file is selected by the task index:
+#  sbatch --array=0-N core_list.sh CMD DIR/training --> DIR/training_${SLURM_ARRAY_TASK_ID}.list
 
 source /fefs/aswg/software/virtual_env/.bashrc
 conda activate cta
@@ -7,6 +9,10 @@ conda activate cta
 CMD=$1
 filelist=$2
 
+if [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    filelist=${2}_${SLURM_ARRAY_TASK_ID}.list
+fi
+
 for file in `cat $filelist`;
 do
     echo "processing $file";
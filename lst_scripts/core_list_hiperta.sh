@@ -1,5 +1,9 @@
 #!/bin/sh
 # slurm core job - send a job with the command passed as arg1 on every line in the file passed as arg2
+# Within a job array, arg2 is the prefix of the sublists and the file is selected by the task index:
+#  sbatch --array=0-N core_list_hiperta.sh CMD DIR/training --> DIR/training_${SLURM_ARRAY_TASK_ID}.list
+# If arg3 is True (staging mode), the whole file is passed to a single CMD (-l), which works in $TMPDIR and copies the
+# outputs of a file while the next one is processed.
 
 # this source is not working because jobs are not accesing /local todo: find a way to access it to be sure to load
 #  the right env
@@ -10,9 +14,19 @@ conda activate hipe-prod
 
 CMD=$1
 filelist=$2
+staging=${3:-False}
 
-for file in `cat $filelist`;
-do
-    echo "processing $file";
-    $CMD -i $file
-done
+if [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    filelist=${2}_${SLURM_ARRAY_TASK_ID}.list
+fi
+
+if [ "$staging" = "True" ]; then
+    echo "processing $filelist in staging mode";
+    $CMD -s True -l $filelist
+else
+    for file in `cat $filelist`;
+    do
+        echo "processing $file";
+        $CMD -i $file
+    done
+fi
@@ -4,10 +4,22 @@
 # Enrique Garcia 09/04/2020
 
 import os
+import re
 import sys
+import glob
+import math
+import datetime
+import heapq
 import shutil
+import tables
+import tempfile
 from distutils.util import strtobool
 
+# Node written last by lstchain_mc_r0_to_dl1: a DL1 file without it comes from an interrupted job
+DL1_COMPLETION_NODE = '/simulation/thrown_event_distribution'
+# Extensions of the DL0 files stripped from their name to get the name of their DL1 file (see get_dl1_filename)
+DL0_EXTENSIONS = ['.simtel.gz', '.simtel.zst', '.h5']
+
 
 def query_yes_no(question, default="yes"):
     """
@@ -130,6 +142,38 @@ def get_input_filelist(data_path):
             os.path.isfile(os.path.join(data_path, f))]
 
 
+def pack_files_by_size(files, max_size):
+    """
+    Split a list of files into sublists of about `max_size` bytes each, balancing their total sizes: the files are
+    taken from the largest to the smallest and each one goes to the sublist with the smallest total size so far.
+
+    Parameters
+    ----------
+    files: list of str
+    max_size: float
+        target total size of the sublists, in bytes. The number of sublists is ceil(total size / max_size)
+
+    Returns
+    -------
+    list of list of str
+        sublists sorted from the largest to the smallest total size
+    """
+    if not files:
+        return []
+
+    sizes = {f: os.stat(f).st_size for f in files}
+    n_sublists = min(len(files), max(1, math.ceil(sum(sizes.values()) / max_size)))
+
+    sublists = [[] for _ in range(n_sublists)]
+    sublists_sizes = [(0, i) for i in range(n_sublists)]
+    for f in sorted(files, key=lambda f: sizes[f], reverse=True):
+        size, i = heapq.heappop(sublists_sizes)
+        sublists[i].append(f)
+        heapq.heappush(sublists_sizes, (size + sizes[f], i))
+
+    return [sublists[i] for size, i in sorted(sublists_sizes, key=lambda size_i: size_i[0], reverse=True)]
+
+
 def check_and_make_dir(directory):
     """
         Check if a directory exists or contains data before to makedir.
@@ -194,6 +238,104 @@ def check_files_in_dir_from_file(directory, file):
     return files_not_in_dir
 
 
+def get_dl1_filename(dl0_filename):
+    """
+    Name of the DL1 file produced by lstchain_mc_r0_to_dl1 from a DL0 file (`dl1_` + DL0 name without its extension,
+    see DL0_EXTENSIONS). The other dots of the name (e.g. `theta_10.0`) are kept.
+
+    Parameters
+    ----------
+    dl0_filename: str
+
+    Returns
+    -------
+    str
+    """
+    name = os.path.basename(dl0_filename)
+    for extension in DL0_EXTENSIONS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return 'dl1_' + name + '.h5'
+
+
+def is_dl1_file_complete(dl1_filename):
+    """
+    Check that a DL1 file exists, can be read and was completely written (see DL1_COMPLETION_NODE)
+
+    Parameters
+    ----------
+    dl1_filename: str
+
+    Returns
+    -------
+    bool
+    """
+    if not os.path.isfile(dl1_filename):
+        return False
+    try:
+        with tables.open_file(dl1_filename) as hfile:
+            return DL1_COMPLETION_NODE in hfile
+    except (OSError, tables.HDF5ExtError):
+        return False
+
+
+def get_missing_dl1_files(dl0_files, dl1_dir):
+    """
+    DL0 files whose DL1 file is not in `dl1_dir` or is incomplete
+
+    Parameters
+    ----------
+    dl0_files: list of str
+    dl1_dir: str
+
+    Returns
+    -------
+    list of str
+    """
+    return [f for f in dl0_files if not is_dl1_file_complete(os.path.join(dl1_dir, get_dl1_filename(f)))]
+
+
+def get_prod_id(prod_id, version_tag, running_analysis_dir=None, date=None):
+    """
+    Full PROD_ID of a production, `{YYYYMMDD}_{version_tag}_{prod_id}`.
+
+    A full PROD_ID (starting with its date, e.g. `20210315_v0.7.3_v00`) is used as it is. Otherwise, the date is the one
+    of the latest production with the same version and suffix found in `running_analysis_dir` (to resume or rerun a
+    production started another day), or `date` (today by default) if there is none.
+
+    Parameters
+    ----------
+    prod_id: str or None
+        full PROD_ID, or its suffix. `v00` (official base production) if None
+    version_tag: str
+        version part of the PROD_ID, e.g. `v0.7.3` or `vRTA_v0.7.3`
+    running_analysis_dir: str or None
+        directory of the running directories of the productions (`{}` for any particle). Searched for an existing
+        production if given
+    date: datetime.date or None
+        date of a new production. Today if None
+
+    Returns
+    -------
+    str
+    """
+    if prod_id is not None and re.match(r'\d{8}_', prod_id):
+        return prod_id
+
+    suffix_id = 'v00' if prod_id is None else prod_id
+    if running_analysis_dir is not None:
+        pattern = re.compile(rf'\d{{8}}_{re.escape(version_tag)}_{re.escape(suffix_id)}')
+        existing_prod_ids = [os.path.basename(path)
+                             for path in glob.glob(os.path.join(running_analysis_dir.replace('{}', '*'), '*'))
+                             if pattern.fullmatch(os.path.basename(path))]
+        if existing_prod_ids:
+            return max(existing_prod_ids)
+
+    date = datetime.date.today() if date is None else date
+    return f'{date.year:04d}{date.month:02d}{date.day:02d}_{version_tag}_{suffix_id}'
+
+
 def read_lines_file(file):
     with open(file) as f:
         lines = [line.rstrip('\n') for line in f]
@@ -226,24 +368,25 @@ def manage_source_env_r0_dl1(source_and_env, file):
     environment = source_and_env.strip(';').rsplit(';')[1].split()[-1]
 
     all_lines = []
-    with open(file, 'r+') as f:
+    with open(file, 'r') as f:
         for line in f.readlines():
             if line.startswith('source'):
                 old_source = line.split()[-1]
-                new_source = line.replace(old_source, source)
-                all_lines.append(new_source)
+                all_lines.append(line.replace(old_source, source))
             elif line.startswith('conda'):
                 old_env = line.split()[-1]
-                new_env = line.replace(old_env, environment)
-                all_lines.append(new_env)
+                all_lines.append(line.replace(old_env, environment))
             else:
                 all_lines.append(line)
 
-    # Overwrite the file ONLY if there is any change in the source path or environment
-    if (new_env != old_env) or (new_source != old_source):
-        with open(file, 'w+') as new_f:
+    # Overwrite the file ONLY if there is any change in the source path or environment. The new file replaces the old
+    # one at once, so that it is never read half written (the particles are batched concurrently)
+    if (environment != old_env) or (source != old_source):
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file)))
+        with os.fdopen(tmp_fd, 'w') as new_f:
             new_f.writelines(all_lines)
-        os.chmod(file, 0o755)  # -rwxr-xr-x
+        os.chmod(tmp_file, 0o755)  # -rwxr-xr-x
+        os.replace(tmp_file, file)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 #
 # usage:
-# python hiperta_r0_to_dl1lstchain.py -i INFILE [-o OUTDIR] [-c CONFIG_FILE] [-k KEEP_FILE]
+# python hiperta_r0_to_dl1lstchain.py -i INFILE [-o OUTDIR] [-c CONFIG_FILE] [-k KEEP_FILE] [-s STAGING]
+# python hiperta_r0_to_dl1lstchain.py -l INPUT_LIST [-o OUTDIR] [-c CONFIG_FILE] [-k KEEP_FILE] [-s STAGING]
 
 import os
+import sys
+import shutil
 import argparse
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from distutils.util import strtobool
 # from reorganize_dl1hiperta_to_dl1lstchain import reorganize_dl1
 from lst_scripts.reorganize_dl1hiperta300_to_dl1lstchain060 import main as reorganize_dl1
@@ -18,6 +24,14 @@ parser.add_argument('--infile', '-i',
                     help='mc r0 file to be run with hiperta_r0_dl1',
                     )
 
+parser.add_argument('--input_list', '-l',
+                    type=str,
+                    dest='input_list',
+                    help='Text file with one mc r0 file per line, all processed by this single job. In staging mode, '
+                         'the output of a file is copied to OUTDIR while the next one is processed.',
+                    default=None
+                    )
+
 parser.add_argument('--outdir', '-o',
                     type=str,
                     dest='outdir',
@@ -46,8 +60,69 @@ parser.add_argument('--debug_mode', '-d',
                     default=False
                     )
 
+parser.add_argument('--staging', '-s',
+                    type=lambda x: bool(strtobool(x)),
+                    dest='staging',
+                    help='Staging mode: hiperta_r0_dl1 output is written and reorganized in a node-local directory '
+                         '(see --staging_dir) and only the final files are copied to OUTDIR. Set by default to False',
+                    default=False
+                    )
+
+parser.add_argument('--staging_dir', '-sd',
+                    type=str,
+                    dest='staging_dir',
+                    help='Node-local directory used in staging mode. $TMPDIR (or the system temporal directory) '
+                         'by default',
+                    default=None
+                    )
+
 
-def main(infile, outdir='./dl1_data/', config='./default_PConfigCut.txt', keep_file=False, debug_mode=False):
+def get_staging_dir(staging_dir=None):
+    """
+    Node-local directory where the intermediate files are written in staging mode.
+
+    Parameters
+    ----------
+    staging_dir: str or None
+        If None, $TMPDIR of the job (or the system temporal directory if not defined)
+
+    Returns
+    -------
+    str
+    """
+    if staging_dir is None:
+        staging_dir = os.environ.get('TMPDIR', tempfile.gettempdir())
+    os.makedirs(staging_dir, exist_ok=True)
+    return staging_dir
+
+
+def stage_out(filename, outdir):
+    """
+    Move a file from the staging directory to `outdir` (shared filesystem). The file is copied under a temporal
+    name and renamed once complete, so that a partial copy is never taken for an output file.
+
+    Parameters
+    ----------
+    filename: str
+        File in the staging directory
+    outdir: str
+        Destination directory
+
+    Returns
+    -------
+    str
+        Path of the moved file
+    """
+    output_filename = os.path.join(outdir, os.path.basename(filename))
+    shutil.copyfile(filename, output_filename + '.part')
+    os.replace(output_filename + '.part', output_filename)
+    os.remove(filename)
+    print(f"\t{filename} --> {output_filename}")
+    return output_filename
+
+
+def main(infile, outdir='./dl1_data/', config='./default_PConfigCut.txt', keep_file=False, debug_mode=False,
+         staging=False, staging_dir=None, stage_out_executor=None):
     """
     Run hiperta_r0_dl1 and reorganize_dl1hipertaV300_to_dl1lstchain060
 
@@ -65,38 +140,129 @@ def main(infile, outdir='./dl1_data/', config='./default_PConfigCut.txt', keep_f
         dl1_reorganized_*.h5 will be always created.
     debug_mode : bool
         Activate debug mode in HiPeRTA (add cleaned mask in the output hdf5). Set by default to False
+    staging: bool
+        Staging mode. The output of hiperta_r0_dl1 is written, and reorganized, in `staging_dir` (node-local) instead
+        of `outdir`. Only the files to keep are then moved to `outdir`. Set by default to False
+    staging_dir: str or None
+        Node-local directory used in staging mode. If None, $TMPDIR. The files are written in a temporal subdirectory,
+        removed at the end of the run, even if it fails.
+    stage_out_executor: `concurrent.futures.Executor` or None
+        In staging mode, if given, the files are moved to `outdir` asynchronously by this executor, so that the
+        next file can be processed meanwhile. Otherwise they are moved before returning.
 
     Returns
     -------
-    none
+    list of `concurrent.futures.Future`
         It creates the dl1_reorganized_rta_INFILE_NAME.h5 file. If keep_file is set to True, it will also keep the
-        output of hiperta_r0_to_dl1
+        output of hiperta_r0_to_dl1. The futures of the asynchronous moves to `outdir` are returned (empty list if
+        there are none).
 
     """
     os.makedirs(outdir, exist_ok=True)
+    # Own directory within the staging one, so that the files of this run can be removed whatever happens
+    work_dir = tempfile.mkdtemp(prefix='hiperta_r0_dl1_', dir=get_staging_dir(staging_dir)) if staging else outdir
+
+    futures = []
+    try:
+        cmd_hiperta = f'hiperta_r0_dl1 -i {infile} -c {config} -o {work_dir}'
+        if debug_mode:  # in HiPeRTA
+            cmd_hiperta += ' -g'
+        # a failed run may leave a partial dl1 file: it must not be reorganized and staged out as an output
+        if os.system(cmd_hiperta) != 0:
+            raise RuntimeError(f'hiperta_r0_dl1 failed on {infile}')
 
-    cmd_hiperta = f'hiperta_r0_dl1 -i {infile} -c {config} -o {outdir}'
-    if debug_mode:  # in HiPeRTA
-        cmd_hiperta += ' -g'
-    os.system(cmd_hiperta)
+        # We know in advance the name of the output
+        output_hiperta_filename = os.path.join(work_dir, "dl1_" + os.path.basename(infile))
+        output_reorganized_filename = os.path.join(work_dir, "dl1v06_reorganized_" + os.path.basename(infile))
+        # the reorganized files feed the lstchain workflow: images in the lstchain LST_LSTCam table
+        reorganize_dl1(output_hiperta_filename, output_reorganized_filename, image_storage='table')
 
-    # We know in advance the name of the output
-    output_hiperta_filename = os.path.join(outdir, "dl1_" + os.path.basename(infile))
-    output_reorganized_filename = os.path.join(outdir, "dl1v06_reorganized_" + os.path.basename(infile))
-    reorganize_dl1(output_hiperta_filename, output_reorganized_filename)
+        # Erase the hiperta dl1 file created ?
+        if not keep_file:
+            os.remove(output_hiperta_filename)
 
-    # Erase the hiperta dl1 file created ?
-    if not keep_file:
-        os.remove(output_hiperta_filename)
+        if staging:
+            files_to_keep = [output_reorganized_filename] + ([output_hiperta_filename] if keep_file else [])
+            for filename in files_to_keep:
+                if stage_out_executor is not None:
+                    futures.append(stage_out_executor.submit(stage_out, filename, outdir))
+                else:
+                    stage_out(filename, outdir)
+    finally:
+        # The staged files left (all of them if the run failed) are removed, after the asynchronous moves if any
+        if staging and futures:
+            futures.append(stage_out_executor.submit(shutil.rmtree, work_dir, ignore_errors=True))
+        elif staging:
+            shutil.rmtree(work_dir, ignore_errors=True)
 
     print("\nDone.")
 
+    return futures
+
+
+def main_list(infiles, outdir='./dl1_data/', config='./default_PConfigCut.txt', keep_file=False, debug_mode=False,
+              staging=False, staging_dir=None):
+    """
+    Run `main` over several files within the same job. In staging mode, the output files of one file are moved to
+    `outdir` while the next file is processed. A failing file (run or move) does not stop the others.
+
+    Parameters
+    ----------
+    infiles: list of str
+        Paths to the files to analyse
+    outdir, config, keep_file, debug_mode, staging, staging_dir:
+        See `main`
+
+    Returns
+    -------
+    failed_files: dict
+        input file --> traceback of the files whose conversion or move to `outdir` failed
+    """
+    failed_files = {}
+    with ThreadPoolExecutor(max_workers=1) as stage_out_executor:
+        file_futures = []
+        for infile in infiles:
+            try:
+                file_futures.extend((infile, future) for future in main(infile, outdir, config, keep_file, debug_mode,
+                                                                        staging=staging,
+                                                                        staging_dir=staging_dir,
+                                                                        stage_out_executor=stage_out_executor))
+            except Exception:
+                failed_files[infile] = traceback.format_exc()
+                print(f'\tFAILED {infile}:\n{failed_files[infile]}')
+
+        # Errors of the asynchronous moves
+        for infile, future in file_futures:
+            try:
+                future.result()
+            except Exception:
+                failed_files.setdefault(infile, traceback.format_exc())
+                print(f'\tFAILED {infile}:\n{failed_files[infile]}')
+
+    return failed_files
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    main(args.infile,
-         args.outdir,
-         args.config,
-         args.keep_file,
-         args.debug_mode
-         )
+    if args.input_list is not None:
+        with open(args.input_list) as f:
+            input_files = [line.strip() for line in f if line.strip() != '']
+        failed = main_list(input_files,
+                           args.outdir,
+                           args.config,
+                           args.keep_file,
+                           args.debug_mode,
+                           args.staging,
+                           args.staging_dir
+                           )
+        if failed:
+            sys.exit(f'{len(failed)} of {len(input_files)} files failed:\n' + '\n'.join(failed))
+    else:
+        main(args.infile,
+             args.outdir,
+             args.config,
+             args.keep_file,
+             args.debug_mode,
+             args.staging,
+             args.staging_dir
+             )
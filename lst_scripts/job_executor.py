@@ -0,0 +1,305 @@
+# Executors of the jobs of the MC workflow:
+#  - slurm : jobs batched with sbatch (onsite, La Palma cluster)
+#  - local : jobs run as subprocesses of the current process, at most `max_workers` at the same time, to run small
+#     productions (or CI) on a single multi-core node without a scheduler
+#
+# Both take the same job description (command, name, partition, `afterok` dependencies, output and error files, array)
+# and return jobids that can be passed as dependencies of the next jobs.
+#
+# With a runtime model (see runtime_model), the slurm jobs whose inputs are known are batched with a time limit and in
+# the partition fitting their predicted runtime.
+
+import os
+import time
+import threading
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from runtime_model import get_time_and_partition
+
+EXECUTORS = ['slurm', 'local']
+
+
+class SlurmExecutor:
+    """
+    Batch the jobs with `sbatch`. The jobids are the slurm ones.
+
+    Parameters
+    ----------
+    runtime_model : dict
+        runtime model of the jobs (see runtime_model.fit_runtime_model), setting the time limit and the partition of
+        the jobs submitted with their `job_inputs`. None to keep the partitions given at submission, without time limit
+    """
+    name = 'slurm'
+
+    def __init__(self, runtime_model=None):
+        self.runtime_model = runtime_model
+        # jobid --> sbatch command, to be stored in the logs
+        self.submitted = {}
+        # jobid --> stage, particle and input bytes of the job (see runtime_model)
+        self.job_inputs = {}
+
+    def submit(self, command, job_name=None, partition='short', wait_jobids='', stdout=None, stderr=None,
+               n_array_tasks=None, wrap=True, time_limit=None, job_inputs=None):
+        """
+        Batch a job.
+
+        Parameters
+        ----------
+        command : str
+            command to run. A shell command line if `wrap`, else a script followed by its arguments
+        job_name : str
+            name of the job (`-J`)
+        partition : str
+            slurm partition (`-p`). With a runtime model, partition of the jobs without prediction
+        wait_jobids : str
+            jobids, separated by ',', that must have finished correctly (`afterok`) before the job starts.
+            Empty string for no dependency
+        stdout : str
+            path of the output file (`-o`). It may contain the slurm filename patterns %j, %A and %a
+        stderr : str
+            path of the error file (`-e`). Same as the output file if None
+        n_array_tasks : int
+            submit a job array of `n_array_tasks` tasks, with indexes (SLURM_ARRAY_TASK_ID) from 0 to n_array_tasks - 1.
+            Dependencies on the array jobid wait for all its tasks
+        wrap : bool
+            `command` is a shell command line (`--wrap`) or a script with its arguments
+        time_limit : str
+            slurm time limit of the job (`--time`), by task for job arrays. Predicted from the runtime model and the
+            `job_inputs` if None, partition limit if there is no prediction
+        job_inputs : dict
+            {'stage', 'particle', 'input_bytes'} of the job (`input_bytes` being a list by task for job arrays), to
+            predict its runtime. Stored in `job_inputs` to add the runtime to the history once finished
+
+        Returns
+        -------
+        jobid : str
+        """
+        if job_inputs is not None and time_limit is None:
+            partition, time_limit = get_time_and_partition(self.runtime_model, job_inputs['stage'],
+                                                           job_inputs['particle'], job_inputs['input_bytes'],
+                                                           default_partition=partition)
+
+        cmd = f'sbatch --parsable -p {partition}'
+        if job_name is not None:
+            cmd += f' -J {job_name}'
+        if n_array_tasks is not None:
+            cmd += f' --array=0-{n_array_tasks - 1}'
+        if time_limit is not None:
+            cmd += f' --time={time_limit}'
+        if wait_jobids != '':
+            cmd += f' --dependency=afterok:{wait_jobids}'
+        if stderr is not None:
+            cmd += f' -e {stderr}'
+        if stdout is not None:
+            cmd += f' -o {stdout}'
+        cmd += f' --wrap="{command}"' if wrap else f' {command}'
+
+        jobid = os.popen(cmd).read().strip('\n')
+        self.submitted[jobid] = cmd
+        if job_inputs is not None:
+            self.job_inputs[jobid] = job_inputs
+
+        return jobid
+
+    def accounting_command(self, jobids, output_file):
+        """Shell command appending the accounting information of the jobs `jobids` (str, ',' separated) to a file"""
+        return f'sacct --format=jobid,jobname,nodelist,cputime,state,exitcode,' \
+               f'avediskread,maxdiskread,avediskwrite,maxdiskwrite,AveVMSize,MaxVMSize,avecpufreq,' \
+               f'reqmem -j {jobids} >> {output_file}'
+
+    def wait(self):
+        """Jobs are managed by slurm, nothing to wait for"""
+        return {}
+
+
+class LocalExecutor:
+    """
+    Run the jobs on the current node, as subprocesses (`sh`) started from the current directory, like `sbatch` would.
+    A job starts once all the jobs it depends on are COMPLETED (exit code 0), and it is CANCELLED if any of them is
+    not. The jobids are consecutive integers (as str) and the tasks of an array are `{jobid}_{index}`.
+
+    Jobs run in the background: call `wait` before leaving the script.
+
+    Parameters
+    ----------
+    max_workers : int
+        maximum number of jobs running at the same time. Number of CPUs by default
+    accounting_file : str
+        file where a line (jobid, job name, state, exit code, elapsed time) is appended when each job finishes
+    """
+    name = 'local'
+
+    def __init__(self, max_workers=None, accounting_file='local_jobs_accounting.txt'):
+        self.max_workers = os.cpu_count() if max_workers is None else max_workers
+        self.accounting_file = os.path.abspath(accounting_file)
+        # jobid --> command, to be stored in the logs
+        self.submitted = {}
+
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._lock = threading.Lock()
+        self._last_jobid = 0
+        # jobid (and {jobid}_{index} for array tasks) --> Future with the final state of the job
+        self._jobs = {}
+
+    def submit(self, command, job_name=None, partition='short', wait_jobids='', stdout=None, stderr=None,
+               n_array_tasks=None, wrap=True, time_limit=None, job_inputs=None):
+        """
+        Run a job once its dependencies are satisfied. See `SlurmExecutor.submit`, `partition`, `time_limit` and
+        `job_inputs` are ignored.
+        """
+        with self._lock:
+            self._last_jobid += 1
+            jobid = str(self._last_jobid)
+
+        dependencies = []
+        for dependency in wait_jobids.split(','):
+            if dependency == '':
+                continue
+            if dependency not in self._jobs:
+                raise ValueError(f'Job dependency problem: unknown jobid {dependency}')
+            dependencies.append(self._jobs[dependency])
+
+        if not wrap:
+            command = f'sh {command}'
+
+        if n_array_tasks is None:
+            self._jobs[jobid] = self._run_after(dependencies, command, jobid, None, job_name, stdout, stderr)
+        else:
+            tasks = []
+            for index in range(n_array_tasks):
+                task = self._run_after(dependencies, command, jobid, index, job_name, stdout, stderr)
+                self._jobs[f'{jobid}_{index}'] = task
+                tasks.append(task)
+            self._jobs[jobid] = _gather_states(tasks)
+
+        self.submitted[jobid] = command
+        print(f'\t\tlocal job {jobid} ({job_name}): {command}')
+
+        return jobid
+
+    def accounting_command(self, jobids, output_file):
+        """Shell command appending the accounting information of the finished jobs to a file"""
+        return f'cat {self.accounting_file} >> {output_file}'
+
+    def state(self, jobid):
+        """PENDING/RUNNING while the job is not finished, then COMPLETED, FAILED or CANCELLED"""
+        job = self._jobs[jobid]
+        return job.result() if job.done() else 'PENDING/RUNNING'
+
+    def wait(self):
+        """
+        Wait for all the submitted jobs to finish.
+
+        Returns
+        -------
+        states : dict
+            jobid --> final state of the job (COMPLETED, FAILED or CANCELLED)
+        """
+        while True:
+            jobs = dict(self._jobs)
+            wait(jobs.values())
+            if len(jobs) == len(self._jobs):
+                break
+        self._pool.shutdown()
+
+        return {jobid: job.result() for jobid, job in jobs.items()}
+
+    def _run_after(self, dependencies, command, jobid, index, job_name, stdout, stderr):
+        """Future with the final state of the job, run once all the `dependencies` are done"""
+        job = Future()
+
+        def start():
+            if any(dependency.result() != 'COMPLETED' for dependency in dependencies):
+                self._account(jobid, index, job_name, 'CANCELLED', None, 0)
+                job.set_result('CANCELLED')
+                return
+            run = self._pool.submit(self._run, command, jobid, index, job_name, stdout, stderr)
+            run.add_done_callback(lambda finished: job.set_result('FAILED' if finished.exception() is not None
+                                                                  else finished.result()))
+
+        _when_all_done(dependencies, start)
+
+        return job
+
+    def _run(self, command, jobid, index, job_name, stdout, stderr):
+        env = dict(os.environ, SLURM_JOB_ID=jobid)
+        if index is not None:
+            env.update(SLURM_ARRAY_JOB_ID=jobid, SLURM_ARRAY_TASK_ID=str(index))
+            default_output = 'slurm-%A_%a.out'
+        else:
+            default_output = 'slurm-%j.out'
+        stdout = _log_filename(default_output if stdout is None else stdout, jobid, index)
+        stderr = stdout if stderr is None else _log_filename(stderr, jobid, index)
+
+        start = time.time()
+        with open(stdout, 'a') as out, open(stderr, 'a') as err:
+            returncode = subprocess.run(command, shell=True, stdout=out, stderr=err, env=env).returncode
+        state = 'COMPLETED' if returncode == 0 else 'FAILED'
+        self._account(jobid, index, job_name, state, returncode, time.time() - start)
+
+        return state
+
+    def _account(self, jobid, index, job_name, state, returncode, elapsed):
+        task_id = jobid if index is None else f'{jobid}_{index}'
+        with self._lock:
+            with open(self.accounting_file, 'a') as f:
+                f.write(f'{task_id} {job_name} {state} {returncode} {elapsed:.1f}s\n')
+
+
+def _when_all_done(futures, callback):
+    """Call `callback()` once all the `futures` are done (immediately if there are none)"""
+    if not futures:
+        callback()
+        return
+
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def count_down(_):
+        with lock:
+            remaining[0] -= 1
+            all_done = remaining[0] == 0
+        if all_done:
+            callback()
+
+    for future in futures:
+        future.add_done_callback(count_down)
+
+
+def _gather_states(tasks):
+    """Future with the state of a job array: COMPLETED if all its tasks are COMPLETED, FAILED otherwise"""
+    array = Future()
+    _when_all_done(tasks, lambda: array.set_result('COMPLETED' if all(task.result() == 'COMPLETED' for task in tasks)
+                                                   else 'FAILED'))
+    return array
+
+
+def _log_filename(filename, jobid, index):
+    """Replace the slurm filename patterns %A (array jobid), %a (array index) and %j (jobid)"""
+    task_id = jobid if index is None else f'{jobid}_{index}'
+    return filename.replace('%A', jobid).replace('%a', '' if index is None else str(index)).replace('%j', task_id)
+
+
+def get_executor(name='slurm', n_workers=None, runtime_model=None):
+    """
+    Executor of the workflow jobs
+
+    Parameters
+    ----------
+    name : str
+        'slurm' or 'local'
+    n_workers : int
+        maximum number of jobs running at the same time with the local executor. Number of CPUs by default
+    runtime_model : dict
+        runtime model of the slurm jobs (see runtime_model). None to batch them without time limit
+
+    Returns
+    -------
+    SlurmExecutor or LocalExecutor
+    """
+    if name == 'slurm':
+        return SlurmExecutor(runtime_model=runtime_model)
+    elif name == 'local':
+        return LocalExecutor(max_workers=n_workers)
+    else:
+        raise ValueError(f'Unknown executor {name}, choose one of {EXECUTORS}')
@@ -10,6 +10,7 @@ import argparse
 from data_management import (check_and_make_dir,
                              query_continue,
                              check_and_make_dir_without_verification)
+from job_executor import SlurmExecutor
 
 parser = argparse.ArgumentParser(description="Convert onsite files from dl1 to dl2")
 
@@ -31,7 +32,8 @@ parser.add_argument('--config_file', '-conf', action='store', type=str,
 
 
 def main(input_dir, path_models, config_file, flag_full_workflow=False, particle=None, wait_jobid_train_pipe=None,
-         wait_jobids_merge=None, dictionary_with_dl1_paths=None, source_environment=None):
+         wait_jobids_merge=None, dictionary_with_dl1_paths=None, source_environment=None, executor=None,
+         set_types=('training', 'testing')):
     """
     Convert onsite files from dl1 to dl2"
 
@@ -63,7 +65,8 @@ def main(input_dir, path_models, config_file, flag_full_workflow=False, particle
             ! COMPULSORY argument when flag_full_workflow is set to True.
 
     dictionary_with_dl1_paths : dict
-        Dictionary with 'particles' as keys containing final outnames of dl1 files.
+        Dictionary with 'particles' as keys containing final outnames of dl1 files (and the bytes of DL0 files of
+        each set type, `dl0_bytes`, to predict the runtime of the jobs, when known).
             ! COMPULSORY argument when flag_full_workflow is set to True.
 
     source_environment : str
@@ -71,6 +74,12 @@ def main(input_dir, path_models, config_file, flag_full_workflow=False, particle
         certain conda environment. By default : `conda activate cta`.
         ! NOTE : train_pipe AND dl1_to_dl2 MUST BE RUN WITH THE SAME ENVIRONMENT
 
+    executor : SlurmExecutor or LocalExecutor
+        executor of the jobs if flag_full_workflow is True (see job_executor). Slurm by default.
+
+    set_types : list of str
+        set types ('training', 'testing') whose dl1 file is converted if flag_full_workflow is True. Both by default.
+
     Returns
     -------
     log_dl1_to_dl2 : dict
@@ -90,14 +99,27 @@ def main(input_dir, path_models, config_file, flag_full_workflow=False, particle
 
     if flag_full_workflow:
 
-        check_and_make_dir_without_verification(output_dir)
+        if set(set_types) == {'training', 'testing'}:
+            check_and_make_dir_without_verification(output_dir)
+        else:
+            # the other set type may be converted at the same time (see workflow_dag): only remove the outputs of these
+            os.makedirs(output_dir, exist_ok=True)
+            for f in os.listdir(output_dir):
+                if f.endswith('.h5') and any(set_type in f for set_type in set_types):
+                    os.remove(os.path.join(output_dir, f))
         print(f"\tOutput dir {particle}: {output_dir}")
 
         log_dl1_to_dl2 = {particle: {}}
+        if executor is None:
+            executor = SlurmExecutor()
 
         # path to dl1 files by particle type
-        file_list = [dictionary_with_dl1_paths[particle]['training']['train_path_and_outname_dl1'],
-                     dictionary_with_dl1_paths[particle]['testing']['test_path_and_outname_dl1']]
+        file_list = []
+        file_dl0_bytes = []
+        for set_type in set_types:
+            set_type_short = 'train' if set_type == 'training' else 'test'
+            file_list.append(dictionary_with_dl1_paths[particle][set_type][f'{set_type_short}_path_and_outname_dl1'])
+            file_dl0_bytes.append(dictionary_with_dl1_paths[particle][set_type].get('dl0_bytes'))
 
         return_jobids = []
 
@@ -126,7 +148,7 @@ def main(input_dir, path_models, config_file, flag_full_workflow=False, particle
 
         query_continue(f"{len(file_list)} jobs,  ok?")
 
-    for file in file_list:
+    for i, file in enumerate(file_list):
 
         cmd = ''
         if source_environment is not None:
@@ -153,16 +175,18 @@ def main(input_dir, path_models, config_file, flag_full_workflow=False, particle
             jobe = os.path.join(output_dir, f"dl1_dl2_{particle}_{ftype}job.e")
             jobo = os.path.join(output_dir, f"dl1_dl2_{particle}_{ftype}job.o")
 
-            batch_cmd = 'sbatch --parsable -p short'
-            if wait_jobs != '':
-                batch_cmd += ' --dependency=afterok:' + wait_jobid_train_pipe
-            batch_cmd += ' -J {} -e {} -o {} --wrap="{}"'.format(job_name[particle],
-                                                                 jobe, jobo,
-                                                                 cmd)
-
-            jobid_dl1_to_dl2 = os.popen(batch_cmd).read().strip('\n')
-
-            log_dl1_to_dl2[particle][jobid_dl1_to_dl2] = batch_cmd
+            jobid_dl1_to_dl2 = executor.submit(cmd,
+                                               job_name=job_name[particle],
+                                               partition='short',
+                                               wait_jobids=wait_jobs,
+                                               stdout=jobo,
+                                               stderr=jobe,
+                                               job_inputs={'stage': 'dl1_to_dl2',
+                                                           'particle': particle,
+                                                           'input_bytes': file_dl0_bytes[i]}
+                                               )
+
+            log_dl1_to_dl2[particle][jobid_dl1_to_dl2] = executor.submitted[jobid_dl1_to_dl2]
             return_jobids.append(jobid_dl1_to_dl2)
 
     # copy this script and config into working dir
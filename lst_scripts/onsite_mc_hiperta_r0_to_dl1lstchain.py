@@ -6,7 +6,7 @@
 #
 # usage:
 # python onsite_mc_r0_dl1.py INPUT_DIR [-conf config_file] [-ratio train_test_ratio] [--sed random_seed] \
-#  [-nfdl1 n_files_per_dl1] [--prod_id prod_id] [-k keep_rta_output_file]
+#  [-nfdl1 n_files_per_dl1] [--prod_id prod_id] [-k keep_rta_output_file] [-s staging]
 
 import os
 import shutil
@@ -18,6 +18,8 @@ from data_management import (check_data_path,
                              get_input_filelist,
                              check_and_make_dir,
                              check_and_make_dir_without_verification)
+from job_executor import SlurmExecutor
+from runtime_model import get_files_bytes
 
 parser = argparse.ArgumentParser(description="MC R0 to DL1 - MC onsite conversion")
 
@@ -64,9 +66,18 @@ parser.add_argument('--keep_rta_file', '-k',
                     default=False
                     )
 
+parser.add_argument('--staging', '-s',
+                    dest='staging',
+                    type=lambda x: bool(strtobool(x)),
+                    help='Staging mode: each job writes and reorganizes the hiperta output in its node-local $TMPDIR '
+                         'and only copies the final files to the DL1 directory (see hiperta_r0_to_dl1lstchain). '
+                         'Set by default to False',
+                    default=False
+                    )
+
 
 def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_files_per_dl1=0, prod_id=None,
-         keep_rta_file=False, flag_full_workflow=False, lst_config=None):
+         keep_rta_file=False, flag_full_workflow=False, lst_config=None, executor=None, staging=False):
     """
     same as for r0_to_dl1 lst-like but with the exceptions of rta
 
@@ -82,6 +93,11 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
     flag_full_workflow
     lst_config: str
         path used just to copy the config to `running analysis`
+    executor: SlurmExecutor or LocalExecutor
+        executor of the jobs if flag_full_workflow is True (see job_executor). Slurm by default.
+    staging: bool
+        staging mode of hiperta_r0_to_dl1lstchain: the files of a sublist are processed in the node-local $TMPDIR
+        of the job, the outputs being copied to the DL1 directory while the next file is processed
 
     Returns
     -------
@@ -98,6 +114,8 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
     else:
         # Full prod_id is passed as argument
         PROD_ID = prod_id
+        if executor is None:
+            executor = SlurmExecutor()
 
     TRAIN_TEST_RATIO = float(train_test_ratio)
     RANDOM_SEED = random_seed
@@ -121,8 +139,8 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
         size_dl1 = size_dl0 / reduction_dl0_dl1
         NFILES_PER_DL1 = max(1, int(DESIRED_DL1_SIZE_MB / size_dl1))
 
-    random.seed(RANDOM_SEED)
-    random.shuffle(raw_files_list)
+    # Own random generator, the particles can be processed concurrently (see workflow_management)
+    random.Random(RANDOM_SEED).shuffle(raw_files_list)
 
     number_files = len(raw_files_list)
     ntrain = int(number_files * TRAIN_TEST_RATIO)
@@ -135,16 +153,6 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
     print("\t{} files in training dataset".format(ntrain))
     print("\t{} files in test dataset".format(ntest))
 
-    with open('training.list', 'w+') as newfile:
-        for f in training_list:
-            newfile.write(f)
-            newfile.write('\n')
-
-    with open('testing.list', 'w+') as newfile:
-        for f in testing_list:
-            newfile.write(f)
-            newfile.write('\n')
-
     RUNNING_DIR = os.path.join(DL0_DATA_DIR.replace('R0', 'running_analysis'), PROD_ID)  ##
 
     JOB_LOGS = os.path.join(RUNNING_DIR, 'job_logs')
@@ -162,6 +170,17 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
         else:
             check_and_make_dir(directory)
 
+    # save file lists into logs
+    with open(os.path.join(RUNNING_DIR, 'training.list'), 'w+') as newfile:
+        for f in training_list:
+            newfile.write(f)
+            newfile.write('\n')
+
+    with open(os.path.join(RUNNING_DIR, 'testing.list'), 'w+') as newfile:
+        for f in testing_list:
+            newfile.write(f)
+            newfile.write('\n')
+
     # dumping the training and testing lists and splitting them in sub-lists for parallel jobs
 
     jobid2log = {}
@@ -191,61 +210,72 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
                     out.write(line)
                     out.write('\n')
         print('\t{} files generated for {} list'.format(number_of_sublists, set_type))
+        if number_of_sublists == 0:
+            continue
 
         ### HiPeRTA ###
-        counter = 0
-
-        for file in os.listdir(dir_lists):
-            if set_type == 'training':
-                jobo = os.path.join(JOB_LOGS, "job{}_train.o".format(counter))
-                jobe = os.path.join(JOB_LOGS, "job{}_train.e".format(counter))
-            else:
-                jobo = os.path.join(JOB_LOGS, "job{}_test.o".format(counter))
-                jobe = os.path.join(JOB_LOGS, "job{}_test.e".format(counter))
-
-            # TODO for the moment is only user enrique.garcia who has installed HiPeRTA  ##
-            cc = ' -c {}'.format(config_file) if config_file is not None else ' '
-            base_cmd = f'core_list_hiperta.sh "/home/enrique.garcia/software/LST_scripts/lst_scripts/' \
-                       f'hiperta_r0_to_dl1lstchain.py -o {output_dir} -k {keep_rta_file} {cc}"'
-
-            # recover or not the jobid depending of the workflow mode
-            if not flag_full_workflow:
-
-                cmd = f'sbatch -p short -e {jobe} -o {jobo} {base_cmd} {os.path.join(dir_lists, file)}'
-
-                # print(cmd)
-                os.system(cmd)
-
-            else:  # flag_full_workflow == True !
-                job_name = {'electron': 'e_RTA-r0dl1',
-                            'gamma': 'g_RTA-r0dl1',
-                            'gamma-diffuse': 'gd_RTA-r0dl1',
-                            'proton': 'p_RTA-r0dl1'
-                            }
-
-                particle_type = DL0_DATA_DIR.split('/')[-2]
-
-                cmd = f'sbatch --parsable -p short -J {job_name[particle_type]} ' \
-                      f'-e {jobe} -o {jobo} {base_cmd} {os.path.join(dir_lists, file)}'
-
-                jobid = os.popen(cmd).read().strip('\n')
-
-                jobids_RTA_r0_dl1_reorganized.append(jobid)
-
-                # Fill the dictionaries if IN workflow mode
-                jobid2log[jobid] = {}
-                jobid2log[jobid]['particle'] = particle_type
-                jobid2log[jobid]['set_type'] = set_type
-                jobid2log[jobid]['jobe_path'] = jobe
-                jobid2log[jobid]['jobo_path'] = jobo
-                jobid2log[jobid]['sbatch_command'] = cmd
-
-                # print(f'\t\t{cmd}')
-                print(f'\t\tSubmitted batch job {jobid}')
-
-            counter += 1
-
-        print("\n\t{} jobs submitted".format(counter))
+        # One job array by set_type, the task index selecting the `{set_type}_{i}.list` sublist (see
+        # core_list_hiperta.sh)
+        set_type_short = 'train' if set_type == 'training' else 'test'
+        jobo = os.path.join(JOB_LOGS, "job%a_{}.o".format(set_type_short))
+        jobe = os.path.join(JOB_LOGS, "job%a_{}.e".format(set_type_short))
+
+        # TODO for the moment is only user enrique.garcia who has installed HiPeRTA  ##
+        cc = ' -c {}'.format(config_file) if config_file is not None else ' '
+        base_cmd = f'core_list_hiperta.sh "/home/enrique.garcia/software/LST_scripts/lst_scripts/' \
+                   f'hiperta_r0_to_dl1lstchain.py -o {output_dir} -k {keep_rta_file} {cc}"'
+        sublists = f'{os.path.join(dir_lists, set_type)} {staging}'
+        array = f'--array=0-{number_of_sublists - 1}'
+
+        # recover or not the jobid depending of the workflow mode
+        if not flag_full_workflow:
+
+            cmd = f'sbatch -p short {array} -e {jobe} -o {jobo} {base_cmd} {sublists}'
+
+            # print(cmd)
+            os.system(cmd)
+
+        else:  # flag_full_workflow == True !
+            job_name = {'electron': 'e_RTA-r0dl1',
+                        'gamma': 'g_RTA-r0dl1',
+                        'gamma-diffuse': 'gd_RTA-r0dl1',
+                        'proton': 'p_RTA-r0dl1'
+                        }
+
+            particle_type = DL0_DATA_DIR.split('/')[-2]
+
+            # `afterok` on the array jobid waits for all its tasks
+            input_bytes = [get_files_bytes(list[i * NFILES_PER_DL1:NFILES_PER_DL1 * (i + 1)])
+                           for i in range(number_of_sublists)]
+            jobid = executor.submit(f'{base_cmd} {sublists}',
+                                    job_name=job_name[particle_type],
+                                    partition='short',
+                                    stdout=jobo,
+                                    stderr=jobe,
+                                    n_array_tasks=number_of_sublists,
+                                    wrap=False,
+                                    job_inputs={'stage': 'r0_to_dl1_rta',
+                                                'particle': particle_type,
+                                                'input_bytes': input_bytes}
+                                    )
+            cmd = executor.submitted[jobid]
+
+            jobids_RTA_r0_dl1_reorganized.append(jobid)
+
+            # Fill the dictionaries if IN workflow mode
+            jobid2log[jobid] = {}
+            jobid2log[jobid]['particle'] = particle_type
+            jobid2log[jobid]['set_type'] = set_type
+            jobid2log[jobid]['array_task_ids'] = [f'{jobid}_{i}' for i in range(number_of_sublists)]
+            jobid2log[jobid]['input_bytes'] = input_bytes
+            jobid2log[jobid]['jobe_path'] = jobe
+            jobid2log[jobid]['jobo_path'] = jobo
+            jobid2log[jobid]['sbatch_command'] = cmd
+
+            # print(f'\t\t{cmd}')
+            print(f'\t\tSubmitted batch job array {jobid}')
+
+        print("\n\t{} jobs submitted".format(number_of_sublists))
 
     # copy this script itself into logs
     shutil.copyfile(__file__, os.path.join(RUNNING_DIR, os.path.basename(__file__)))
@@ -255,10 +285,6 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
     if lst_config is not None:
         shutil.copy(lst_config, os.path.join(RUNNING_DIR, os.path.basename(lst_config)))
 
-    # save file lists into logs
-    shutil.move('testing.list', os.path.join(RUNNING_DIR, 'testing.list'))
-    shutil.move('training.list', os.path.join(RUNNING_DIR, 'training.list'))
-
     # create log dictionary and return it if IN workflow mode
     if flag_full_workflow:
         return jobid2log, jobids_RTA_r0_dl1_reorganized
@@ -275,5 +301,6 @@ if __name__ == '__main__':
          args.random_seed,
          args.n_files_per_dl1,
          args.prod_id,
-         args.keep_rta_file
+         args.keep_rta_file,
+         staging=args.staging
          )
@@ -12,6 +12,7 @@
 # 5. move running_dir 
 
 import os
+import math
 import shutil
 import argparse
 from data_management import (check_job_logs,
@@ -19,7 +20,9 @@ from data_management import (check_job_logs,
                              check_files_in_dir_from_file,
                              query_continue,
                              check_and_make_dir,
-                             move_dir_content)
+                             move_dir_content,
+                             get_dl1_filename)
+from job_executor import SlurmExecutor
 
 parser = argparse.ArgumentParser(description="Merge and copy DL1 data after production. \n"
                                              " 1. check job_logs \n"
@@ -34,8 +37,161 @@ parser.add_argument('input_dir', type=str,
                     )
 
 
+def submit_merge_tree(executor, input_dir, output_filename, tree_dir, n_files, fan_in, flag_no_image, flag_merge,
+                      job_name, wait_jobids, first_level=0, job_inputs=None):
+    """
+    Batch a tree-reduction merge of the DL1 files of `input_dir`: the level 0 jobs (a job array) merge groups of
+    `fan_in` files in parallel, the jobs of the next level merge groups of `fan_in` merged files of the previous level,
+    and so on until a single group is left, merged into `output_filename`. The intermediate files are removed as soon
+    as they are merged, and `tree_dir` at the end.
+
+    Parameters
+    ----------
+    executor : SlurmExecutor or LocalExecutor
+        executor of the jobs (see job_executor)
+    input_dir : str
+        directory of the DL1 files
+    output_filename : str
+        final merged file
+    tree_dir : str
+        directory of the intermediate merged files (one subdirectory by level)
+    n_files : int
+        number of DL1 files expected in `input_dir`
+    fan_in : int
+        number of files merged by job
+    flag_no_image : bool
+        `--no-image` argument of lstchain_merge_hdf5_files
+    flag_merge : bool
+        `--smart` argument of lstchain_merge_hdf5_files
+    job_name : str
+        name of the jobs, followed by their level
+    wait_jobids : str
+        jobids the level 0 jobs wait for
+    first_level : int
+        level of the first jobs. From level 1, the files of `input_dir` are the merged files of the previous level
+        (`tree_dir/level{first_level - 1}`)
+    job_inputs : dict or None
+        runtime inputs of the whole merge (see job_executor). Each job gets the share of the `input_bytes` of the DL1
+        files it merges, to predict its time limit from the runtime model of the `stage`
+
+    Returns
+    -------
+    jobids : list
+        jobids of the levels, the last one merging into `output_filename`
+    """
+    def level_job_inputs(n_groups, files_by_group):
+        """Runtime inputs of the jobs of a level, the bytes of the DL1 files of each group (by task)"""
+        if job_inputs is None:
+            return None
+        input_bytes = job_inputs['input_bytes']
+        if input_bytes is not None:
+            input_bytes = [input_bytes * min(files_by_group, n_files - group * files_by_group) / n_files
+                           for group in range(n_groups)]
+        return {**job_inputs, 'input_bytes': input_bytes if n_groups > 1 or input_bytes is None else input_bytes[0]}
+
+    jobids = []
+    level = first_level
+    level_input_dir = input_dir
+    n_groups = math.ceil(n_files / fan_in)
+    # number of DL1 files merged into each file of the level
+    files_by_group = fan_in
+
+    while True:
+        cmd = f'python batch_dl1_utils-merge_tree.py -i {level_input_dir} -fi {fan_in} ' \
+              f'--no-image {flag_no_image} --smart {flag_merge} --intermediate {level > 0}'
+        if n_groups == 1:
+            cmd += f' -f {output_filename} --cleanup_dir {tree_dir}'
+            jobids.append(executor.submit(cmd, job_name=f'{job_name}{level}', wait_jobids=wait_jobids,
+                                          job_inputs=level_job_inputs(1, n_files)))
+            return jobids
+
+        level_output_dir = os.path.join(tree_dir, f'level{level}')
+        cmd += f' -o {level_output_dir}'
+        jobids.append(executor.submit(cmd, job_name=f'{job_name}{level}', wait_jobids=wait_jobids,
+                                      n_array_tasks=n_groups, job_inputs=level_job_inputs(n_groups, files_by_group)))
+
+        wait_jobids = jobids[-1]
+        level_input_dir = level_output_dir
+        level += 1
+        n_groups = math.ceil(n_groups / fan_in)
+        files_by_group *= fan_in
+
+
+def submit_streaming_merge(executor, r0_dl1_logs, dl1_files, output_filename, tree_dir, tasks_per_merge,
+                           flag_no_image, flag_merge, job_name, particle=None):
+    """
+    Batch a streaming merge of the DL1 files of a set type: the DL1 files of every `tasks_per_merge` r0_to_dl1 array
+    tasks are appended to the merged file as soon as these tasks finish (`afterok` on the array task ids), while the
+    other tasks are still running. The jobs are chained (each one extends the merged file of the previous one), so the
+    last job only appends the DL1 files of the last tasks.
+
+    Parameters
+    ----------
+    executor : SlurmExecutor or LocalExecutor
+        executor of the jobs (see job_executor)
+    r0_dl1_logs : dict
+        log of the r0_to_dl1 job arrays of the set type (see onsite_mc_r0_to_dl1), with the DL1 files of each task
+    dl1_files : list
+        all the DL1 files of the set type. Those not produced by the r0_to_dl1 jobs (complete files kept when resuming
+        the production) are merged first, by a job without dependency
+    output_filename : str
+        merged file
+    tree_dir : str
+        directory of the file lists of the jobs, removed by the last one
+    tasks_per_merge : int
+        number of r0_to_dl1 array tasks whose DL1 files are appended by each job
+    flag_no_image : bool
+        `--no-image` argument of lstchain_merge_hdf5_files
+    flag_merge : bool
+        `--smart` argument of lstchain_merge_hdf5_files
+    job_name : str
+        name of the jobs
+    particle : str or None
+        particle of the jobs, to predict their time limit from the runtime model of the `merge` stage if the DL0 bytes
+        of the r0_to_dl1 tasks (`input_bytes`) are in `r0_dl1_logs`
+
+    Returns
+    -------
+    jobids : list
+        jobids of the chained merge jobs, the last one writing the complete merged file
+    """
+    # (files, array task ids, DL0 bytes) of each merge job
+    groups = []
+    produced_files = set()
+    for jobid, log in r0_dl1_logs.items():
+        for first_task in range(0, len(log['dl1_files']), tasks_per_merge):
+            tasks = range(first_task, min(first_task + tasks_per_merge, len(log['dl1_files'])))
+            input_bytes = sum(log['input_bytes'][task] for task in tasks) if 'input_bytes' in log else None
+            groups.append(([f for task in tasks for f in log['dl1_files'][task]], [f'{jobid}_{task}' for task in tasks],
+                           input_bytes))
+            produced_files.update(groups[-1][0])
+    existing_files = [f for f in dl1_files if f not in produced_files]
+    if existing_files:
+        # DL0 bytes of the kept files estimated from the produced ones
+        known_bytes = [input_bytes for _, _, input_bytes in groups]
+        input_bytes = None
+        if known_bytes and None not in known_bytes:
+            input_bytes = sum(known_bytes) / max(len(produced_files), 1) * len(existing_files)
+        groups.insert(0, (existing_files, [], input_bytes))
+
+    os.makedirs(tree_dir, exist_ok=True)
+    jobids = []
+    for group, (files, task_ids, input_bytes) in enumerate(groups):
+        file_list = os.path.join(tree_dir, f'dl1_merged_{group:04d}.list')
+        with open(file_list, 'w') as f:
+            f.write('\n'.join(files) + '\n')
+        cmd = f'python batch_dl1_utils-merge_tree.py -l {file_list} -g {group} -f {output_filename} ' \
+              f'--no-image {flag_no_image} --smart {flag_merge} --append {group > 0}'
+        if group == len(groups) - 1:
+            cmd += f' --cleanup_dir {tree_dir}'
+        jobids.append(executor.submit(cmd, job_name=f'{job_name}s', wait_jobids=','.join(task_ids + jobids[-1:]),
+                                      job_inputs={'stage': 'merge', 'particle': particle, 'input_bytes': input_bytes}))
+
+    return jobids
+
+
 def main(input_dir, flag_full_workflow=False, particle2jobs_dict={}, particle=None, flag_merge=False,
-         flag_no_image=True):
+         flag_no_image=True, executor=None, merge_fan_in=0, streaming_merge=0):
     """
     Merge and copy DL1 data after production.
 
@@ -57,6 +213,8 @@ def main(input_dir, flag_full_workflow=False, particle2jobs_dict={}, particle=No
     particle2jobs_dict : dict
         Dictionary used to retrieve the r0 to dl1 jobids that were sent in the previous step of the r0-dl3 workflow.
         This script will NOT start until all the jobs sent before have finished.
+        When its `jobid_log` entry is present, the merge of each set type only waits for the r0 to dl1 jobs of that set
+        type, and the bytes of DL0 files of each set type, to predict the runtime of the jobs, are taken from it.
         COMPULSORY argument when flag_full_workflow is set to True.
 
     particle : str
@@ -73,6 +231,19 @@ def main(input_dir, flag_full_workflow=False, particle2jobs_dict={}, particle=No
         True (--no-image True) or False (--no-image False).
         Default set to True.
 
+    executor : SlurmExecutor or LocalExecutor
+        executor of the jobs if flag_full_workflow is True (see job_executor). Slurm by default.
+
+    merge_fan_in : int
+        If flag_full_workflow is True and larger than 1, the DL1 files of each set type are merged by a tree of jobs,
+        each one merging `merge_fan_in` files (see submit_merge_tree). 0 (by default) to merge them in a single job.
+
+    streaming_merge : int
+        If flag_full_workflow is True and larger than 0, the DL1 files of every `streaming_merge` r0 to dl1 array tasks
+        are appended to the merged file as soon as these tasks finish, the last job only appending those of the last
+        tasks (see submit_streaming_merge). Needs the DL1 files of the tasks in the `jobid_log` of `particle2jobs_dict`
+        (lstchain workflow), otherwise (or if 0, by default) the merge waits for all the r0 to dl1 jobs.
+
     Returns
     -------
 
@@ -81,7 +252,11 @@ def main(input_dir, flag_full_workflow=False, particle2jobs_dict={}, particle=No
         separated by particle
 
          - log_merge[particle][set_type].keys() = ['logs_script_test or logs_script_train',
-                                        'train_path_and_outname_dl1 or test_path_and_outname_dl1', 'jobid']
+                                        'train_path_and_outname_dl1 or test_path_and_outname_dl1', 'dl0_bytes',
+                                        'jobid']
+
+         `dl0_bytes` being the bytes of DL0 files of the set type (None if unknown), from which the runtime of the
+         next stages is predicted
 
         ****  otherwise : (if flag_full_workflow is False, by default) ****
         None is returned -- THIS IS APPLIED FOR THE ARGUMENTS SHOWN BELOW TOO
@@ -97,6 +272,8 @@ def main(input_dir, flag_full_workflow=False, particle2jobs_dict={}, particle=No
 
     if flag_full_workflow:
         log_merge = {particle: {'training': {}, 'testing': {}}}
+        if executor is None:
+            executor = SlurmExecutor()
 
         wait_r0_dl1_jobs = particle2jobs_dict[particle]
 
@@ -203,21 +380,48 @@ def main(input_dir, flag_full_workflow=False, particle2jobs_dict={}, particle=No
             else:
                 log_merge[particle][set_type]['test_path_and_outname_dl1'] = os.path.join(final_DL1_dir, base_filename)
 
-            # TODO missing the job.o and job.e for the sbatch of the merge and copy
-            cmd = 'sbatch --parsable -p short'
-            if wait_r0_dl1_jobs != '':
-                cmd += ' --dependency=afterok:' + wait_r0_dl1_jobs
+            r0_dl1_logs = {jobid: log for jobid, log in particle2jobs_dict.get('jobid_log', {}).items()
+                           if log['particle'] == particle and log['set_type'] == set_type}
+            wait_r0_dl1_set_type_jobs = ','.join(r0_dl1_logs) if r0_dl1_logs else wait_r0_dl1_jobs
+
+            dl0_bytes = None
+            if r0_dl1_logs and all('input_bytes' in log for log in r0_dl1_logs.values()):
+                dl0_bytes = sum(sum(log['input_bytes']) for log in r0_dl1_logs.values())
+            log_merge[particle][set_type]['dl0_bytes'] = dl0_bytes
 
-            cmd += ' -J {} --wrap="lstchain_merge_hdf5_files -d {} -o {} --no-image {} --smart {}"'.format(
-                job_name[particle],
+            # TODO missing the job.o and job.e for the sbatch of the merge and copy
+            cmd = 'lstchain_merge_hdf5_files -d {} -o {} --no-image {} --smart {}'.format(
                 tdir,
                 output_filename,
                 flag_no_image,
                 flag_merge  ##
             )
 
-            jobid_merge = os.popen(cmd).read().strip('\n')
-            log_merge[particle][set_type][jobid_merge] = cmd
+            dl0_files = read_lines_file(training_filelist if set_type == 'training' else testing_filelist)
+            n_files = len(dl0_files)
+            tree_dir = os.path.join(input_dir, 'DL1_merge_tree', set_type)
+            if streaming_merge > 0 and r0_dl1_logs and all('dl1_files' in log for log in r0_dl1_logs.values()):
+                merge_jobids = submit_streaming_merge(executor, r0_dl1_logs,
+                                                      [os.path.join(tdir, get_dl1_filename(f)) for f in dl0_files],
+                                                      output_filename, tree_dir, streaming_merge,
+                                                      flag_no_image, flag_merge, job_name[particle], particle)
+            elif merge_fan_in > 1 and n_files > merge_fan_in:
+                merge_jobids = submit_merge_tree(executor, tdir, output_filename, tree_dir, n_files, merge_fan_in,
+                                                 flag_no_image, flag_merge, job_name[particle],
+                                                 wait_r0_dl1_set_type_jobs,
+                                                 job_inputs={'stage': 'merge', 'particle': particle,
+                                                             'input_bytes': dl0_bytes})
+            else:
+                merge_jobids = [executor.submit(cmd, job_name=job_name[particle],
+                                                wait_jobids=wait_r0_dl1_set_type_jobs,
+                                                job_inputs={'stage': 'merge', 'particle': particle,
+                                                            'input_bytes': dl0_bytes})]
+            # the last job writes the merged file
+            for jobid in merge_jobids[:-1]:
+                log_merge[particle][set_type][jobid] = executor.submitted[jobid]
+                return_jobids_debug.append(jobid)
+            jobid_merge = merge_jobids[-1]
+            log_merge[particle][set_type][jobid_merge] = executor.submitted[jobid_merge]
 
             print(f'\t\tSubmitted batch job {jobid_merge} -- {particle}, {set_type}')
 
@@ -233,47 +437,39 @@ def main(input_dir, flag_full_workflow=False, particle2jobs_dict={}, particle=No
 
         print("\tDL1 files will be moved to {}".format(final_DL1_dir))
 
-        base_cmd = 'sbatch --parsable -p short -J {} --dependency=afterok:{} ' \
-                   '--wrap="python batch_dl1_utils-merge_and_copy.py -s {} -d {} --copy_conf {}"'
+        base_cmd = 'python batch_dl1_utils-merge_and_copy.py -s {} -d {} --copy_conf {}'
 
         wait_both_merges = ','.join(wait_both_merges)
 
         # 4 --> move DL1 files in final place
-        batch_mv_dl1 = base_cmd.format(job_name[particle].split('_')[0]+'_mv_dl1',
-                                       wait_both_merges,
-                                       running_DL1_dir,
-                                       final_DL1_dir,
-                                       'False'
-                                       )
-
-        jobid_move_dl1 = os.popen(batch_mv_dl1).read().strip('\n')
-        log_merge[particle][set_type][jobid_move_dl1] = batch_mv_dl1
+        dl0_bytes = [log_merge[particle][set_type]['dl0_bytes'] for set_type in ['testing', 'training']]
+        jobid_move_dl1 = executor.submit(base_cmd.format(running_DL1_dir, final_DL1_dir, 'False'),
+                                         job_name=job_name[particle].split('_')[0] + '_mv_dl1',
+                                         wait_jobids=wait_both_merges,
+                                         job_inputs={'stage': 'move_dl1', 'particle': particle,
+                                                     'input_bytes': None if None in dl0_bytes else sum(dl0_bytes)}
+                                         )
+        log_merge[particle][set_type][jobid_move_dl1] = executor.submitted[jobid_move_dl1]
 
         print(f'\t\tSubmitted batch job {jobid_move_dl1}. It will move dl1 files when {wait_both_merges} finish.')
 
         # 5 --> copy lstchain config file in final_dir too
-        batch_copy_conf = base_cmd.format(job_name[particle].split('_')[0] + '_cp_conf',
-                                          jobid_move_dl1,
-                                          input_dir,
-                                          final_DL1_dir,
-                                          'True'
+        jobid_copy_conf = executor.submit(base_cmd.format(input_dir, final_DL1_dir, 'True'),
+                                          job_name=job_name[particle].split('_')[0] + '_cp_conf',
+                                          wait_jobids=jobid_move_dl1,
+                                          job_inputs={'stage': 'move_logs', 'particle': particle, 'input_bytes': None}
                                           )
-
-        jobid_copy_conf = os.popen(batch_copy_conf).read().strip('\n')
-        log_merge[particle][set_type][jobid_copy_conf] = batch_copy_conf
+        log_merge[particle][set_type][jobid_copy_conf] = executor.submitted[jobid_copy_conf]
 
         print(f'\t\tSubmitted batch job {jobid_copy_conf}. It will copy the used config when {jobid_move_dl1} finish.')
 
         # 6 --> move running_dir to final analysis_logs
-        batch_mv_dir = base_cmd.format(job_name[particle].split('_')[0]+'_mv_dir',
-                                       jobid_copy_conf,
-                                       input_dir,
-                                       logs_destination_dir,
-                                       'False'
-                                       )
-
-        jobid_move_log = os.popen(batch_mv_dir).read().strip('\n')
-        log_merge[particle][set_type][jobid_move_log] = batch_mv_dir
+        jobid_move_log = executor.submit(base_cmd.format(input_dir, logs_destination_dir, 'False'),
+                                         job_name=job_name[particle].split('_')[0] + '_mv_dir',
+                                         wait_jobids=jobid_copy_conf,
+                                         job_inputs={'stage': 'move_logs', 'particle': particle, 'input_bytes': None}
+                                         )
+        log_merge[particle][set_type][jobid_move_log] = executor.submitted[jobid_move_log]
 
         print(f'\t\tSubmitted batch job {jobid_move_log}. It will move running_dir when {jobid_copy_conf} finish.')
 
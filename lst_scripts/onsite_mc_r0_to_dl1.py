@@ -6,20 +6,27 @@
 #
 # usage:
 # python onsite_mc_r0_dl1.py INPUT_DIR [-conf config_file] [-ratio train_test_ratio] [--sed random_seed] \
-#  [-nfdl1 n_files_per_dl1] [--prod_id prod_id]
+#  [-nfdl1 n_files_per_dl1] [--prod_id prod_id] [-pack pack_by_size] [-rf reduction_factor] [--resume resume]
 
 import os
 import shutil
 import random
 import argparse
-import calendar
 import lstchain
+from distutils.util import strtobool
 from data_management import (check_data_path,
                              get_input_filelist,
                              check_and_make_dir,
                              check_and_make_dir_without_verification,
-                             manage_source_env_r0_dl1
+                             manage_source_env_r0_dl1,
+                             pack_files_by_size,
+                             read_lines_file,
+                             get_dl1_filename,
+                             get_missing_dl1_files,
+                             get_prod_id
                              )
+from job_executor import SlurmExecutor
+from runtime_model import get_files_bytes
 
 parser = argparse.ArgumentParser(description="R0 to DL1 MC onsite conversion ")
 
@@ -48,20 +55,47 @@ parser.add_argument('--random_seed', '-seed', action='store', type=str,
 parser.add_argument('--n_files_per_dl1', '-nfdl1', action='store', type=str,
                     dest='n_files_per_dl1',
                     help='Number of input files merged in one DL1. If 0, the number of files per DL1 is computed '
-                         'based on the size of the DL0 files and the expected reduction factor of 5 '
+                         'based on the size of the DL0 files and the expected reduction factor (5 by default) '
                          'to obtain DL1 files of ~100 MB. Else, use fixed number of files',
                     default=0,
                     )
 
 parser.add_argument('--prod_id', action='store', type=str,
                     dest='prod_id',
-                    help="Production ID. If None, _v00 will be used, indicating an official base production",
+                    help="Production ID, suffix of the PROD_ID or full PROD_ID (YYYYMMDD_vX.Y.Z_suffix). If None, "
+                         "_v00 will be used, indicating an official base production",
                     default=None,
                     )
 
+parser.add_argument('--pack_by_size', '-pack', action='store',
+                    type=lambda x: bool(strtobool(x)),
+                    dest='pack_by_size',
+                    help='Pack the DL0 files into jobs according to their size instead of their number: each job gets '
+                         'about `reduction_factor` x 1000 MB of DL0 files, the jobs are balanced and the largest ones '
+                         'are submitted first. n_files_per_dl1 is ignored. Default False',
+                    default=False
+                    )
+
+parser.add_argument('--reduction_factor', '-rf', action='store', type=float,
+                    dest='reduction_factor',
+                    help='Expected size reduction factor from DL0 to DL1, to compute the number (or size) of DL0 files '
+                         'by DL1 file. Default 5',
+                    default=5
+                    )
+
+parser.add_argument('--resume', action='store',
+                    type=lambda x: bool(strtobool(x)),
+                    dest='resume',
+                    help='Resume a production (same PROD_ID, the latest one with this suffix if the date is not '
+                         'given) after a partial failure: keep its running directory and training/testing lists, and only process the files whose DL1 file is missing or incomplete. '
+                         'Default False',
+                    default=False
+                    )
+
 
 def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_files_per_dl1=0,
-         prod_id=None, flag_full_workflow=False, source_environment=None):
+         prod_id=None, flag_full_workflow=False, source_environment=None, executor=None, pack_by_size=False,
+         reduction_factor=5, resume=False):
     """
     R0 to DL1 MC onsite conversion.
 
@@ -78,16 +112,30 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
         Random seed for random processes. Default = 42
     n_files_per_dl1 : int
         Number of input files merged in one DL1. If 0, the number of files per DL1 is computed based on the size
-        of the DL0 files and the expected reduction factor of 5 to obtain DL1 files of ~100 MB. Else, use fixed
-        number of files. Default = 0
+        of the DL0 files and the expected reduction factor (see reduction_factor) to obtain DL1 files of ~100 MB.
+        Else, use fixed number of files. Default = 0
     prod_id :str
-        Production ID. If None, _v00 will be used, indicating an official base production. Default = None.
+        Production ID, suffix of the PROD_ID or full PROD_ID (see data_management.get_prod_id). If None, _v00 will be
+        used, indicating an official base production. Default = None.
     flag_full_workflow : bool
         Boolean flag to indicate if this script is run as part of the workflow that converts r0 to dl2 files.
     source_environment : str
         path to a .bashrc file (lstanalyzer user by default - can be configurable for custom runs @ mc_r0_to_dl3 script)
          to activate a certain conda environment. By default : `conda activate cta`.
         ! NOTE : train_pipe AND dl1_to_dl2 MUST BE RUN WITH THE SAME ENVIRONMENT
+    executor : SlurmExecutor or LocalExecutor
+        executor of the jobs if flag_full_workflow is True (see job_executor). Slurm by default.
+    pack_by_size : bool
+        Pack the DL0 files into jobs according to their size instead of their number (n_files_per_dl1 is then
+        ignored): all the files are stat'ed and split into balanced jobs of about `reduction_factor` x 1000 MB of
+        DL0 files. The largest jobs are the first tasks of the job arrays, so that they start first. Default = False
+    reduction_factor : float
+        Expected size reduction factor from DL0 to DL1. Default = 5
+    resume : bool
+        Resume the production after a partial failure. The running directory, with its training and testing lists
+        (train_test_ratio and random_seed are then ignored) and its DL1 files, is kept. Only the DL0 files without a
+        complete DL1 file in `DL1/training` or `DL1/testing` are regrouped into new sublists and processed again.
+        The logs of the previous attempt are moved to `job_logs/attempt_N`. Default = False
 
     Returns
     -------
@@ -101,35 +149,42 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
 
         The second layer contains, organized by jobid,
              - the kind of particle that corresponded to the jobid
-             - the command that was run to batch the job into the server
-             - the path to both the output and error files (job_`jobid`.o and job_`jobid`.e) that were generated
-                 when the job was send to the cluster
+             - the command that was run to batch the job into the server (or to run it, with the local executor)
+             - the path to both the output and error files (job`%a`_train.o and job`%a`_train.e, `%a` being
+                 replaced by slurm by the array task index) that were generated when the job was send to the cluster
+             - the ids of the array tasks (`jobid`_`task index`), one by sublist of files
+
+             - the bytes of DL0 files processed by each array task (to predict the runtime of the next stages)
+             - the DL1 files produced by each array task (to merge them as soon as the task finishes)
 
-             dict[jobid].keys() = ['particle', 'sbatch_command', 'jobe_path', 'jobo_path']
+             dict[jobid].keys() = ['particle', 'set_type', 'array_task_ids', 'input_bytes', 'dl1_files',
+                                   'sbatch_command', 'jobe_path', 'jobo_path']
 
              ****  otherwise : (if flag_full_workflow is False, by default) ****
             None is returned -- THIS IS APPLIED FOR THE ARGUMENTS SHOWN BELOW TOO
 
     jobids_r0_dl1
 
-        A list of all the jobs sent by particle (including test and train set types).
+        A list of the job arrays sent by particle (one by set type, train and test). Slurm dependencies on an array
+        jobid wait for all the tasks of the array.
 
     """
     if not flag_full_workflow:
         print("\n ==== START {} ==== \n".format(os.path.basename(__file__)))
-        # This formatting should be the same as in `onsite_mc_r0_to_dl3.py`
-        today = calendar.datetime.date.today()
-        base_prod_id = f'{today.year:04d}{today.month:02d}{today.day:02d}_v{lstchain.__version__}'
-        suffix_id = '_v00' if prod_id is None else '_{}'.format(prod_id)
-        PROD_ID = base_prod_id + suffix_id
+        # This formatting should be the same as in `onsite_mc_r0_to_dl3.py`. A resumed production keeps the date of
+        # its first attempt
+        PROD_ID = get_prod_id(prod_id, f'v{lstchain.__version__}',
+                              running_analysis_dir=input_dir.replace('DL0', 'running_analysis') if resume else None)
 
     else:
         # Full prod_id is passed as argument
         PROD_ID = prod_id
+        if executor is None:
+            executor = SlurmExecutor()
 
     TRAIN_TEST_RATIO = float(train_test_ratio)
     RANDOM_SEED = random_seed
-    NFILES_PER_DL1 = n_files_per_dl1
+    NFILES_PER_DL1 = int(n_files_per_dl1)
 
     DESIRED_DL1_SIZE_MB = 1000
 
@@ -145,38 +200,36 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
 
     raw_files_list = get_input_filelist(DL0_DATA_DIR)
 
-    if NFILES_PER_DL1 == 0:
+    if NFILES_PER_DL1 == 0 and not pack_by_size:
         size_dl0 = os.stat(raw_files_list[0]).st_size / 1e6
-        reduction_dl0_dl1 = 5
-        size_dl1 = size_dl0 / reduction_dl0_dl1
+        size_dl1 = size_dl0 / reduction_factor
         NFILES_PER_DL1 = max(1, int(DESIRED_DL1_SIZE_MB / size_dl1))
 
-    random.seed(RANDOM_SEED)
-    random.shuffle(raw_files_list)
+    RUNNING_DIR = os.path.join(DL0_DATA_DIR.replace('DL0', 'running_analysis'), PROD_ID)
+
+    if resume:
+        if not os.path.exists(os.path.join(RUNNING_DIR, 'training.list')):
+            raise ValueError(f"No production to resume in {RUNNING_DIR}")
+        training_list = read_lines_file(os.path.join(RUNNING_DIR, 'training.list'))
+        testing_list = read_lines_file(os.path.join(RUNNING_DIR, 'testing.list'))
+        number_files = len(training_list) + len(testing_list)
+        ntrain = len(training_list)
+        ntest = len(testing_list)
+    else:
+        # Own random generator, the particles can be processed concurrently (see workflow_management)
+        random.Random(RANDOM_SEED).shuffle(raw_files_list)
 
-    number_files = len(raw_files_list)
-    ntrain = int(number_files * TRAIN_TEST_RATIO)
-    ntest = number_files - ntrain
+        number_files = len(raw_files_list)
+        ntrain = int(number_files * TRAIN_TEST_RATIO)
+        ntest = number_files - ntrain
 
-    training_list = raw_files_list[:ntrain]
-    testing_list = raw_files_list[ntrain:]
+        training_list = raw_files_list[:ntrain]
+        testing_list = raw_files_list[ntrain:]
 
     print("\t{} raw files".format(number_files))
     print("\t{} files in training dataset".format(ntrain))
     print("\t{} files in test dataset".format(ntest))
 
-    with open('training.list', 'w+') as newfile:
-        for f in training_list:
-            newfile.write(f)
-            newfile.write('\n')
-
-    with open('testing.list', 'w+') as newfile:
-        for f in testing_list:
-            newfile.write(f)
-            newfile.write('\n')
-
-    RUNNING_DIR = os.path.join(DL0_DATA_DIR.replace('DL0', 'running_analysis'), PROD_ID)
-
     JOB_LOGS = os.path.join(RUNNING_DIR, 'job_logs')
     # DIR_LISTS_BASE = os.path.join(RUNNING_DIR, 'file_lists')
     DL1_DATA_DIR = os.path.join(RUNNING_DIR, 'DL1')
@@ -186,11 +239,32 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
     print("\tJOB_LOGS DIR: \t", JOB_LOGS)
     print("\tDL1 DATA DIR: \t", DL1_DATA_DIR)
 
-    for directory in [RUNNING_DIR, DL1_DATA_DIR, JOB_LOGS]:
-        if flag_full_workflow:
-            check_and_make_dir_without_verification(directory)
-        else:
-            check_and_make_dir(directory)
+    if resume:
+        # keep the logs of the previous attempt, out of the ones checked by merge_and_copy
+        os.makedirs(JOB_LOGS, exist_ok=True)
+        attempt = len([d for d in os.listdir(JOB_LOGS) if d.startswith('attempt_')])
+        previous_logs = [f for f in os.listdir(JOB_LOGS) if os.path.isfile(os.path.join(JOB_LOGS, f))]
+        os.makedirs(os.path.join(JOB_LOGS, f'attempt_{attempt}'))
+        for f in previous_logs:
+            shutil.move(os.path.join(JOB_LOGS, f), os.path.join(JOB_LOGS, f'attempt_{attempt}', f))
+
+    else:
+        for directory in [RUNNING_DIR, DL1_DATA_DIR, JOB_LOGS]:
+            if flag_full_workflow:
+                check_and_make_dir_without_verification(directory)
+            else:
+                check_and_make_dir(directory)
+
+        # save file lists into logs
+        with open(os.path.join(RUNNING_DIR, 'training.list'), 'w+') as newfile:
+            for f in training_list:
+                newfile.write(f)
+                newfile.write('\n')
+
+        with open(os.path.join(RUNNING_DIR, 'testing.list'), 'w+') as newfile:
+            for f in testing_list:
+                newfile.write(f)
+                newfile.write('\n')
 
     # dumping the training and testing lists and spliting them in sublists for parallel jobs
 
@@ -205,7 +279,11 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
         dir_lists = os.path.join(RUNNING_DIR, 'file_lists_' + set_type)
         output_dir = os.path.join(RUNNING_DIR, 'DL1')
         output_dir = os.path.join(output_dir, set_type)
-        if flag_full_workflow:
+        if resume:
+            # the sublists of the previous attempt are replaced, the complete DL1 files kept
+            check_and_make_dir_without_verification(dir_lists)
+            os.makedirs(output_dir, exist_ok=True)
+        elif flag_full_workflow:
             check_and_make_dir_without_verification(dir_lists)
             check_and_make_dir_without_verification(output_dir)
         else:
@@ -213,79 +291,100 @@ def main(input_dir, config_file=None, train_test_ratio=0.5, random_seed=42, n_fi
             check_and_make_dir(output_dir)
         print("\toutput dir: \t", output_dir)
 
-        number_of_sublists = len(list) // NFILES_PER_DL1 + int(len(list) % NFILES_PER_DL1 > 0)
-        for i in range(number_of_sublists):
+        if resume:
+            list = get_missing_dl1_files(list, output_dir)
+            for f in list:
+                dl1_filename = os.path.join(output_dir, get_dl1_filename(f))
+                if os.path.exists(dl1_filename):
+                    os.remove(dl1_filename)
+            print('\t{} {} files without complete DL1 file to be processed again'.format(len(list), set_type))
+
+        if pack_by_size:
+            sublists = pack_files_by_size(list, max_size=DESIRED_DL1_SIZE_MB * 1e6 * reduction_factor)
+        else:
+            number_of_sublists = len(list) // NFILES_PER_DL1 + int(len(list) % NFILES_PER_DL1 > 0)
+            sublists = [list[i * NFILES_PER_DL1:NFILES_PER_DL1 * (i + 1)] for i in range(number_of_sublists)]
+
+        number_of_sublists = len(sublists)
+        for i, sublist in enumerate(sublists):
             output_file = os.path.join(dir_lists, '{}_{}.list'.format(set_type, i))
             with open(output_file, 'w+') as out:
-                for line in list[i * NFILES_PER_DL1:NFILES_PER_DL1 * (i + 1)]:
+                for line in sublist:
                     out.write(line)
                     out.write('\n')
         print('\t{} files generated for {} list'.format(number_of_sublists, set_type))
+        if number_of_sublists == 0:
+            continue
 
         ### LSTCHAIN ###
-        counter = 0
-
-        for file in os.listdir(dir_lists):
-            if set_type == 'training':
-                jobo = os.path.join(JOB_LOGS, "job{}_train.o".format(counter))
-                jobe = os.path.join(JOB_LOGS, "job{}_train.e".format(counter))
+        # One job array by set_type, the task index selecting the `{set_type}_{i}.list` sublist (see core_list.sh)
+        set_type_short = 'train' if set_type == 'training' else 'test'
+        jobo = os.path.join(JOB_LOGS, "job%a_{}.o".format(set_type_short))
+        jobe = os.path.join(JOB_LOGS, "job%a_{}.e".format(set_type_short))
+        cc = ' -c {}'.format(config_file) if config_file is not None else ' '
+
+        base_cmd = 'core_list.sh "lstchain_mc_r0_to_dl1 -o {} {}"'.format(output_dir, cc)
+        array = f'--array=0-{number_of_sublists - 1}'
+
+        # recover or not the jobid depending of the workflow mode
+        if not flag_full_workflow:
+            cmd = f'sbatch -p short {array} -e {jobe} -o {jobo} {base_cmd} {os.path.join(dir_lists, set_type)}'
+
+            # print(cmd)
+            os.system(cmd)
+
+        else:  # flag_full_workflow == True !
+            job_name = {'electron': 'r0dl1_e',
+                        'gamma': 'r0dl1_g',
+                        'gamma-diffuse': 'r0dl1_gd',
+                        'proton': 'r0dl1_p'
+                        }
+
+            particle_type = DL0_DATA_DIR.split('/')[-2]
+            # partition of the jobs without runtime prediction (see runtime_model)
+            if particle_type == 'proton':
+                queue = 'long'
             else:
-                jobo = os.path.join(JOB_LOGS, "job{}_test.o".format(counter))
-                jobe = os.path.join(JOB_LOGS, "job{}_test.e".format(counter))
-            cc = ' -c {}'.format(config_file) if config_file is not None else ' '
-
-            base_cmd = 'core_list.sh "lstchain_mc_r0_to_dl1 -o {} {}"'.format(output_dir, cc)
-
-            # recover or not the jobid depending of the workflow mode
-            if not flag_full_workflow:
-                cmd = f'sbatch -p short -e {jobe} -o {jobo} {base_cmd} {os.path.join(dir_lists, file)}'
-
-                # print(cmd)
-                os.system(cmd)
-
-            else:  # flag_full_workflow == True !
-                job_name = {'electron': 'r0dl1_e',
-                            'gamma': 'r0dl1_g',
-                            'gamma-diffuse': 'r0dl1_gd',
-                            'proton': 'r0dl1_p'
-                            }
-
-                particle_type = DL0_DATA_DIR.split('/')[-2]
-                if particle_type == 'proton':
-                    queue = 'long'
-                else:
-                    queue = 'short'
-
-                cmd = f'sbatch --parsable -p {queue} -J {job_name[particle_type]} ' \
-                      f'-e {jobe} -o {jobo} {base_cmd} {os.path.join(dir_lists, file)}'
-
-                jobid = os.popen(cmd).read().strip('\n')
-                jobids_r0_dl1.append(jobid)
-
-                # Fill the dictionaries if IN workflow mode
-                jobid2log[jobid] = {}
-                jobid2log[jobid]['particle'] = particle_type
-                jobid2log[jobid]['set_type'] = set_type
-                jobid2log[jobid]['jobe_path'] = jobe
-                jobid2log[jobid]['jobo_path'] = jobo
-                jobid2log[jobid]['sbatch_command'] = cmd
-
-                # print(f'\t\t{cmd}')
-                print(f'\t\tSubmitted batch job {jobid}')
-
-            counter += 1
-
-        print("\n\t{} jobs submitted".format(counter))
+                queue = 'short'
+
+            # `afterok` on the array jobid waits for all its tasks
+            input_bytes = [get_files_bytes(sublist) for sublist in sublists]
+            jobid = executor.submit(f'{base_cmd} {os.path.join(dir_lists, set_type)}',
+                                    job_name=job_name[particle_type],
+                                    partition=queue,
+                                    stdout=jobo,
+                                    stderr=jobe,
+                                    n_array_tasks=number_of_sublists,
+                                    wrap=False,
+                                    job_inputs={'stage': 'r0_to_dl1',
+                                                'particle': particle_type,
+                                                'input_bytes': input_bytes}
+                                    )
+            cmd = executor.submitted[jobid]
+            jobids_r0_dl1.append(jobid)
+
+            # Fill the dictionaries if IN workflow mode
+            jobid2log[jobid] = {}
+            jobid2log[jobid]['particle'] = particle_type
+            jobid2log[jobid]['set_type'] = set_type
+            jobid2log[jobid]['array_task_ids'] = [f'{jobid}_{i}' for i in range(number_of_sublists)]
+            jobid2log[jobid]['input_bytes'] = input_bytes
+            jobid2log[jobid]['dl1_files'] = [[os.path.join(output_dir, get_dl1_filename(f)) for f in sublist]
+                                             for sublist in sublists]
+            jobid2log[jobid]['jobe_path'] = jobe
+            jobid2log[jobid]['jobo_path'] = jobo
+            jobid2log[jobid]['sbatch_command'] = cmd
+
+            # print(f'\t\t{cmd}')
+            print(f'\t\tSubmitted batch job array {jobid}')
+
+        print("\n\t{} jobs submitted".format(number_of_sublists))
 
     # copy this script and config into working dir
     shutil.copyfile(__file__, os.path.join(RUNNING_DIR, os.path.basename(__file__)))
     if config_file is not None:
         shutil.copyfile(config_file, os.path.join(RUNNING_DIR, os.path.basename(config_file)))
 
-    # save file lists into logs
-    shutil.move('testing.list', os.path.join(RUNNING_DIR, 'testing.list'))
-    shutil.move('training.list', os.path.join(RUNNING_DIR, 'training.list'))
-
     # create log dictionary and return it if IN workflow mode
     if flag_full_workflow:
         return jobid2log, jobids_r0_dl1
@@ -301,5 +400,8 @@ if __name__ == '__main__':
          args.train_test_ratio,
          args.random_seed,
          args.n_files_per_dl1,
-         args.prod_id
+         args.prod_id,
+         pack_by_size=args.pack_by_size,
+         reduction_factor=args.reduction_factor,
+         resume=args.resume
          )
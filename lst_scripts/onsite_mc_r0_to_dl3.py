@@ -12,25 +12,33 @@
 #
 # usage:
 # > python onsite_mc_r0_to_dl3.py [-conf_lst LSTCHAIN_CONFIG_FILE] [-conf_rta RTA_CONFIG_FILE] [-pid PROD_ID]
+#                                 [-bp BASE_PATH] [-pack PACK_BY_SIZE] [-fi MERGE_FAN_IN] [-sm STREAMING_MERGE]
+#                                 [-ex {slurm,local}] [-nw N_LOCAL_WORKERS] [-rh RUNTIME_HISTORY] [--resume RESUME]
+#                                 [--stage_cache STAGE_CACHE]
+#                                 [--stages STAGE [STAGE ...]] [--particles PARTICLE [PARTICLE ...]]
+#
+#   The stages are batched by particle, each one waiting only for the jobs it needs (see workflow_dag).
+#   `--stages` and `--particles` rerun part of the graph (and everything depending on it), the outputs of the rest
+#   of the production being read from disk.
 #
 #   The input_dir is set in the global variable `DL0_DATA_DIR`
 
 import os
 import sys
 import argparse
-import calendar
 import lstchain
-from data_management import query_continue
+from data_management import query_continue, manage_source_env_r0_dl1, get_prod_id
 from distutils.util import strtobool
-from workflow_management import (batch_r0_to_dl1,
-                                 batch_r0_to_dl1_rta,
-                                 batch_merge_and_copy_dl1,
-                                 batch_train_pipe,
-                                 batch_dl1_to_dl2,
-                                 save_log_to_file,
-                                 create_dict_with_filenames,
-                                 batch_mc_production_check
+from workflow_management import (MC_WORKFLOW_STAGES,
+                                 build_mc_workflow_dag,
+                                 save_log_to_file
                                  )
+from job_executor import EXECUTORS, get_executor
+from runtime_model import load_runtime_model
+from stage_cache import (get_dl1_fingerprint,
+                         get_models_fingerprint,
+                         find_cached_output,
+                         link_cached_output)
 
 #######################################################################################################################
 #######################################################################################################################
@@ -46,6 +54,10 @@ OBS_DATE = '20190415'
 POINTING = 'south_pointing'
 ALL_PARTICLES = ['electron', 'gamma', 'gamma-diffuse', 'proton']
 
+# split of the DL1 files into training and testing data (lst workflow)
+TRAIN_TEST_RATIO = 0.5
+RANDOM_SEED = 42
+
 # source env onsite - can be changed for custom install - ** !! ADD A `;` at the end of the `source_env` string !! **
 source_env = 'source /fefs/aswg/software/virtual_env/.bashrc; conda activate cta;'  # By default
 
@@ -76,12 +88,19 @@ parser.add_argument('--config_file_rta', '-conf_rta', action='store', type=str,
 
 parser.add_argument('--prod_id', '-pid', action='store', type=str,
                     dest='prod_id',
-                    help="Production ID. If None, _v00 will be used, indicating an official base production",
+                    help="Production ID, suffix of the PROD_ID or full PROD_ID (YYYYMMDD_vX.Y.Z_suffix). If None, "
+                         "_v00 will be used, indicating an official base production",
                     default=None,
                     )
 
 # OPTIONAL / ADVANCED ARGUMENTS
 
+parser.add_argument('--base_path', '-bp', action='store', type=str,
+                    dest='base_path',
+                    help=f'Base path of the MC data (DL0, running_analysis, DL1...). Default: {BASE_PATH}',
+                    default=BASE_PATH
+                    )
+
 parser.add_argument('--no-image', action='store',
                     type=lambda x: bool(strtobool(x)),
                     dest='flag_no_image',
@@ -89,6 +108,92 @@ parser.add_argument('--no-image', action='store',
                          'True will merge dl1 files without image. False will do the oppossite',
                     default=True
                     )
+
+parser.add_argument('--pack_by_size', '-pack', action='store',
+                    type=lambda x: bool(strtobool(x)),
+                    dest='pack_by_size',
+                    help='Pack the DL0 files into r0_to_dl1 jobs according to their size instead of their number '
+                         '(lstchain workflow). Default False',
+                    default=False
+                    )
+
+parser.add_argument('--merge_fan_in', '-fi', action='store', type=int,
+                    dest='merge_fan_in',
+                    help='Merge the DL1 files by a tree of jobs, each one merging MERGE_FAN_IN files (DL1 files at the '
+                         'first level, merged files of the previous level after). Default 0: a single merge job by '
+                         'particle and set type',
+                    default=0
+                    )
+
+parser.add_argument('--streaming_merge', '-sm', action='store', type=int,
+                    dest='streaming_merge',
+                    help='Append the DL1 files of every STREAMING_MERGE r0_to_dl1 array tasks to the merged file as soon '
+                         'as these tasks finish, the last job only appending those of the last tasks (lstchain '
+                         'workflow). '
+                         'Default 0: the merge waits for all the r0_to_dl1 jobs of the particle',
+                    default=0
+                    )
+
+parser.add_argument('--executor', '-ex', action='store', type=str,
+                    dest='executor',
+                    choices=EXECUTORS,
+                    help='Executor of the jobs. `slurm` batches them with sbatch, `local` runs them on this node '
+                         '(small productions, CI) and waits until they have all finished. Default: slurm',
+                    default='slurm'
+                    )
+
+parser.add_argument('--n_local_workers', '-nw', action='store', type=int,
+                    dest='n_local_workers',
+                    help='Maximum number of jobs running at the same time with the local executor. '
+                         'Number of CPUs by default',
+                    default=None
+                    )
+
+parser.add_argument('--runtime_history', '-rh', action='store', type=str,
+                    dest='runtime_history',
+                    help='json file with the elapsed times of the jobs of the previous productions, from which the '
+                         'time limit and the partition of the slurm jobs are predicted. Updated at the end of the '
+                         'production. Default: BASE_PATH/analysis_logs/runtime_history.json',
+                    default=None
+                    )
+
+parser.add_argument('--resume', action='store',
+                    type=lambda x: bool(strtobool(x)),
+                    dest='resume',
+                    help='Resume the r0_to_dl1 stage (lstchain workflow) of the production PROD_ID (the latest one with '
+                         'this suffix if the date is not given) after a partial failure: only the DL0 files without a '
+                         'complete DL1 file are processed again. Default False',
+                    default=False
+                    )
+
+parser.add_argument('--stage_cache', action='store',
+                    type=lambda x: bool(strtobool(x)),
+                    dest='stage_cache',
+                    help='Link the DL1 files and models of previous productions (other PROD_IDs) made from the same '
+                         'inputs, config, lstchain version, environment and scripts, instead of producing them '
+                         'again (lstchain workflow). Only the productions run with the stage cache write the '
+                         'fingerprints of their outputs, and can be reused. Default False',
+                    default=False
+                    )
+
+parser.add_argument('--stages', action='store', type=str,
+                    nargs='+',
+                    dest='stages',
+                    choices=MC_WORKFLOW_STAGES,
+                    help='Rerun these stages of the production PROD_ID (the latest one with this suffix if the date '
+                         'is not given), and all the stages depending on them. '
+                         'The DO_* flags of the script by default',
+                    default=None
+                    )
+
+parser.add_argument('--particles', action='store', type=str,
+                    nargs='+',
+                    dest='particles',
+                    choices=ALL_PARTICLES,
+                    help='Only run the stages of these particles (and the stages depending on them, e.g. train_pipe '
+                         'for proton). All the particles by default',
+                    default=None
+                    )
 args = parser.parse_args()
 
 #######################################################################################################################
@@ -97,14 +202,16 @@ args = parser.parse_args()
 if __name__ == '__main__':
 
     # Global variables
-    today = calendar.datetime.date.today()
+    BASE_PATH = args.base_path
     if WORKFLOW_KIND == 'lst':
-        base_prod_id = f'{today.year:04d}{today.month:02d}{today.day:02d}_v{lstchain.__version__}'
+        version_tag = f'v{lstchain.__version__}'
     elif WORKFLOW_KIND == 'rta':
-        base_prod_id = f'{today.year:04d}{today.month:02d}{today.day:02d}_vRTA_v{lstchain.__version__}'
-    suffix_id = '_v00' if args.prod_id is None else '_{}'.format(args.prod_id)
-
-    PROD_ID = base_prod_id + suffix_id
+        version_tag = f'vRTA_v{lstchain.__version__}'
+    # A resumed or rerun production keeps the date of its first run
+    existing_production = args.resume or args.stages is not None
+    PROD_ID = get_prod_id(args.prod_id, version_tag,
+                          running_analysis_dir=os.path.join(BASE_PATH, 'running_analysis', OBS_DATE, '{}', POINTING)
+                          if existing_production else None)
     RUNNING_ANALYSIS_DIR = os.path.join(BASE_PATH, 'running_analysis', OBS_DATE, '{}', POINTING, PROD_ID)
     ANALYSIS_LOG_DIR = os.path.join(BASE_PATH, 'analysis_logs', OBS_DATE, '{}', POINTING, PROD_ID)
     if WORKFLOW_KIND == 'lst':
@@ -112,6 +219,15 @@ if __name__ == '__main__':
     elif WORKFLOW_KIND == 'rta':
         DL0_DATA_DIR = os.path.join(BASE_PATH, 'R0', OBS_DATE, '{}', POINTING)  ##
     DL1_DATA_DIR = os.path.join(BASE_PATH, 'DL1', OBS_DATE, '{}', POINTING, PROD_ID)
+    # Same as in onsite_mc_train
+    if DL1_DATA_DIR.find('/mc/DL1/') > 0:
+        MODELS_DIR = DL1_DATA_DIR.format('proton').replace('/mc/DL1', '/models').replace('/proton/', '/')
+    else:
+        MODELS_DIR = DL1_DATA_DIR.format('proton').replace('/DL1', '/models').replace('/proton/', '/')
+    if args.runtime_history is None:
+        RUNTIME_HISTORY = os.path.join(BASE_PATH, 'analysis_logs', 'runtime_history.json')
+    else:
+        RUNTIME_HISTORY = os.path.abspath(args.runtime_history)
 
     # #################################################
     # ########### Beginning of the workflow ###########
@@ -144,96 +260,119 @@ if __name__ == '__main__':
     if source_env.strip()[-1] != ';':
         source_env = source_env + ';'
 
-    # R0/1 to DL1
-    if DO_r0_to_dl1:
-
-        if WORKFLOW_KIND == 'lst':
-            log_batch_r0_dl1, debug_r0dl1, jobs_all_r0_dl1 = batch_r0_to_dl1(DL0_DATA_DIR,
-                                                                             args.config_file_lst,
-                                                                             PROD_ID,
-                                                                             ALL_PARTICLES,
-                                                                             source_env=source_env)
-        elif WORKFLOW_KIND == 'rta':
-            log_batch_r0_dl1, debug_r0dl1, jobs_all_r0_dl1 = batch_r0_to_dl1_rta(DL0_DATA_DIR,
-                                                                                 args.config_file_rta,
-                                                                                 PROD_ID,
-                                                                                 ALL_PARTICLES,
-                                                                                 args.config_file_lst)
-        else:
-            sys.exit("Choose a valid WORKFLOW_KIND : 'lst' OR 'rta' ")
-
-        save_log_to_file(log_batch_r0_dl1, log_file, log_format='yml', workflow_step='r0_to_dl1')
-        save_log_to_file(debug_r0dl1, debug_file, log_format='yml', workflow_step='r0_to_dl1')
-
-    else:
-        jobs_all_r0_dl1 = ''
-        log_batch_r0_dl1 = {}
-        for particle in ALL_PARTICLES:
-            log_batch_r0_dl1[particle] = ''
-
-    # Merge,copy and move DL1 files
-    if DO_merge_and_copy:
-        log_batch_merge_and_copy, jobs_to_train, jobs_all_dl1_finished, debug_merge = batch_merge_and_copy_dl1(
-            RUNNING_ANALYSIS_DIR,
-            log_batch_r0_dl1,
-            ALL_PARTICLES,
-            # smart_merge=WORKFLOW_KIND
-            smart_merge=False,
-            no_image_flag=args.flag_no_image
-        )
-
-        save_log_to_file(log_batch_merge_and_copy, log_file, log_format='yml', workflow_step='merge_and_copy_dl1')
-        save_log_to_file(debug_merge, debug_file, log_format='yml', workflow_step='merge_and_copy_dl1')
-
-    else:
-        # Create just the needed dictionary inputs (dl1 files must exist !)
-        log_batch_merge_and_copy = create_dict_with_filenames(DL1_DATA_DIR, ALL_PARTICLES)
-        jobs_to_train = ''
-        jobs_all_dl1_finished = ''
-
-    # Train pipe
-    if DO_TRAIN_PIPE:
-        log_batch_train_pipe, job_from_train_pipe, model_dir, debug_train = batch_train_pipe(
-            log_batch_merge_and_copy,
-            args.config_file_lst,
-            jobs_to_train,
-            source_env=source_env
-        )
-
-        save_log_to_file(log_batch_train_pipe, log_file, log_format='yml', workflow_step='train_pipe')
-        save_log_to_file(debug_train, debug_file, log_format='yml', workflow_step='train_pipe')
+    executor = get_executor(args.executor, args.n_local_workers, load_runtime_model(RUNTIME_HISTORY))
 
-    else:
-        job_from_train_pipe = ''
-        if BASE_PATH == '/fefs/aswg/data/mc':
-            model_dir = os.path.join('/fefs/aswg/data/', 'models', OBS_DATE, POINTING, PROD_ID)
-        else:
-            model_dir = os.path.join(BASE_PATH, 'models', OBS_DATE, POINTING, PROD_ID)
-
-    # DL1 to DL2 stage
-    if DO_dl1_to_dl2:
-        log_batch_dl1_to_dl2, jobs_for_dl2_to_dl3, debug_dl1dl2 = batch_dl1_to_dl2(
-            DL1_DATA_DIR,
-            model_dir,
-            args.config_file_lst,
-            job_from_train_pipe,       # Single jobid from train
-            jobs_all_dl1_finished,     # jobids from merge
-            log_batch_merge_and_copy,  # final dl1 names
-            ALL_PARTICLES,
-            source_env=source_env
-        )
-
-        save_log_to_file(log_batch_dl1_to_dl2, log_file, log_format='yml', workflow_step='dl1_to_dl2')
-        save_log_to_file(debug_dl1dl2, debug_file, log_format='yml', workflow_step='dl1_to_dl2')
+    if WORKFLOW_KIND not in ['lst', 'rta']:
+        sys.exit("Choose a valid WORKFLOW_KIND : 'lst' OR 'rta' ")
 
+    # Fingerprints of the DL1 files (by particle) and of the models (see stage_cache). Without the stage cache, they are
+    # neither computed (a scan of all the DL0 files) nor written by the workflow
+    dl1_fingerprints = None
+    models_fingerprint = None
+    if WORKFLOW_KIND == 'lst' and args.stage_cache:
+        dl1_fingerprints = {}
+        for particle in ALL_PARTICLES:
+            dl1_fingerprints[particle], _ = get_dl1_fingerprint(DL0_DATA_DIR.format(particle),
+                                                                args.config_file_lst,
+                                                                lstchain.__version__,
+                                                                source_env,
+                                                                {'no_image': args.flag_no_image,
+                                                                 'train_test_ratio': TRAIN_TEST_RATIO,
+                                                                 'random_seed': RANDOM_SEED})
+        models_fingerprint, _ = get_models_fingerprint({particle: dl1_fingerprints[particle]
+                                                        for particle in ['gamma-diffuse', 'proton']},
+                                                       args.config_file_lst,
+                                                       lstchain.__version__,
+                                                       source_env)
+
+    # Graph of the jobs: each stage of a particle waits only for the stages it needs (see workflow_dag)
+    workflow_dag = build_mc_workflow_dag(WORKFLOW_KIND,
+                                         DL0_DATA_DIR,
+                                         RUNNING_ANALYSIS_DIR,
+                                         DL1_DATA_DIR,
+                                         MODELS_DIR,
+                                         PROD_ID,
+                                         ALL_PARTICLES,
+                                         args.config_file_lst,
+                                         source_env,
+                                         executor=executor,
+                                         config_file_rta=args.config_file_rta,
+                                         no_image_flag=args.flag_no_image,
+                                         pack_by_size=args.pack_by_size,
+                                         resume=args.resume,
+                                         merge_fan_in=args.merge_fan_in,
+                                         streaming_merge=args.streaming_merge,
+                                         dl1_fingerprints=dl1_fingerprints,
+                                         models_fingerprint=models_fingerprint,
+                                         runtime_history=RUNTIME_HISTORY,
+                                         train_test_ratio=TRAIN_TEST_RATIO,
+                                         random_seed=RANDOM_SEED)
+
+    if args.stages is None:
+        # The DO_* flags select the stages, the outputs of the others must already be there
+        stages = [stage for stage, do_stage in [('r0_to_dl1', DO_r0_to_dl1),
+                                                ('merge_and_copy_dl1', DO_merge_and_copy),
+                                                ('train_pipe', DO_TRAIN_PIPE),
+                                                ('dl1_to_dl2', DO_dl1_to_dl2)] if do_stage]
+        stages += ['dl1_fingerprint', 'models_fingerprint', 'check']
+        selected_nodes = {node for node in workflow_dag.descendants(workflow_dag.select(stages, args.particles,
+                                                                                       downstream=False))
+                          if node[0] in stages}
     else:
-        jobs_for_dl2_to_dl3 = ''
-
-    # Check DL2 jobs and thus the full workflow has finished correctly
-    jobid_check = batch_mc_production_check(jobs_all_r0_dl1,
-                                            jobs_all_dl1_finished,
-                                            job_from_train_pipe,
-                                            jobs_for_dl2_to_dl3,
-                                            prod_id=PROD_ID)
-
-    save_log_to_file(jobid_check, debug_file, log_format='yml', workflow_step='check_full_workflow')
+        # Partial rerun: the given stages and all the ones depending on them
+        selected_nodes = workflow_dag.select(args.stages, args.particles)
+
+    # Stage cache: outputs of previous productions with the same fingerprints, linked instead of being produced again
+    reused_stages = {}
+    if WORKFLOW_KIND == 'lst' and args.stage_cache:
+        if not args.resume:
+            for particle in ALL_PARTICLES:
+                dl1_nodes = {('r0_to_dl1', particle, None),
+                             ('merge_and_copy_dl1', particle, None),
+                             ('dl1_fingerprint', particle, None)}
+                if not dl1_nodes.issubset(selected_nodes):
+                    continue
+                cached_dir = find_cached_output(DL1_DATA_DIR.format(particle), 'dl1', dl1_fingerprints[particle])
+                if cached_dir is not None:
+                    link_cached_output(cached_dir, DL1_DATA_DIR.format(particle), 'dl1', dl1_fingerprints[particle])
+                    reused_stages[f'dl1_{particle}'] = cached_dir
+                    selected_nodes -= dl1_nodes
+
+        models_nodes = {('train_pipe', None, None), ('models_fingerprint', None, None)}
+        if models_nodes.issubset(selected_nodes):
+            cached_dir = find_cached_output(MODELS_DIR, 'models', models_fingerprint)
+            if cached_dir is not None:
+                link_cached_output(cached_dir, MODELS_DIR, 'models', models_fingerprint)
+                reused_stages['models'] = cached_dir
+                selected_nodes -= models_nodes
+
+        for stage, cached_dir in reused_stages.items():
+            print(f'\tStage cache: {stage} reused from {cached_dir}')
+        save_log_to_file({'dl1_fingerprints': dl1_fingerprints,
+                          'models_fingerprint': models_fingerprint,
+                          'reused_stages': reused_stages},
+                         log_file, log_format='yml', workflow_step='stage_cache')
+
+    # `core_list.sh` is shared by all the particles, modify it once before batching them concurrently
+    if WORKFLOW_KIND == 'lst' and any(node[0] == 'r0_to_dl1' for node in selected_nodes):
+        manage_source_env_r0_dl1(source_and_env=source_env, file=os.path.abspath('./core_list.sh'))
+
+    print(f'\n ==== START {len(selected_nodes)} workflow nodes ==== \n')
+    results = workflow_dag.run(selected_nodes)
+    print(f'\n ==== END {len(selected_nodes)} workflow nodes ==== \n')
+
+    for node, result in results.items():
+        workflow_step = '_'.join(name for name in node if name is not None)
+        if 'log' in result:
+            save_log_to_file(result['log'], log_file, log_format='yml', workflow_step=workflow_step)
+        if 'debug' in result:
+            save_log_to_file(result['debug'], debug_file, log_format='yml', workflow_step=workflow_step)
+
+    # The local jobs are run by this process
+    if args.executor == 'local':
+        print('\n\tWaiting for the local jobs to finish')
+        job_states = executor.wait()
+        save_log_to_file(job_states, debug_file, log_format='yml', workflow_step='local_jobs_states')
+        failed_jobs = {jobid: state for jobid, state in job_states.items() if state != 'COMPLETED'}
+        if failed_jobs:
+            sys.exit(f'Local jobs not completed: {failed_jobs}. See {executor.accounting_file}')
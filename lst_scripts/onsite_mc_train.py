@@ -9,6 +9,7 @@ import shutil
 import argparse
 from data_management import (check_and_make_dir,
                              check_and_make_dir_without_verification)
+from job_executor import SlurmExecutor
 
 parser = argparse.ArgumentParser(description="Train models onsite")
 
@@ -33,7 +34,7 @@ source_env = 'source /fefs/aswg/software/virtual_env/.bashrc; conda activate cta
 
 
 def main(gamma_dl1_train_file, proton_dl1_train_file, config_file=None, source_environment=source_env,
-         flag_full_workflow=False, wait_ids_proton_and_gammas=None):
+         flag_full_workflow=False, wait_ids_proton_and_gammas=None, executor=None, dl0_bytes=None):
     """
     Train RF from dl1 data  (onsite LaPalma cluster)
 
@@ -55,6 +56,11 @@ def main(gamma_dl1_train_file, proton_dl1_train_file, config_file=None, source_e
         a string (of chained jobids separated by ',' and without spaces between each element), to indicate the
         dependencies of the job to be batched
         COMPULSORY argument when flag_full_workflow is set to True.
+    executor : SlurmExecutor or LocalExecutor
+        executor of the job if flag_full_workflow is True (see job_executor). Slurm by default.
+    dl0_bytes : int
+        bytes of the DL0 files of the gamma and proton training datasets, to predict the runtime of the job.
+        None if unknown
 
 
     Returns
@@ -77,6 +83,8 @@ def main(gamma_dl1_train_file, proton_dl1_train_file, config_file=None, source_e
 
     if flag_full_workflow:
         log_train = {}
+        if executor is None:
+            executor = SlurmExecutor()
 
     else:
         print("\n ==== START {} ==== \n".format(os.path.basename(__file__)))
@@ -120,13 +128,17 @@ def main(gamma_dl1_train_file, proton_dl1_train_file, config_file=None, source_e
 
     else:  # flag_full_workflow == True !
         # 'sbatch --parsable --dependency=afterok:{wait_ids_proton_and_gammas} -e {jobe} -o {jobo} --wrap="{base_cmd}"'
-        cmd = 'sbatch --parsable -p long'
-        if wait_ids_proton_and_gammas != '':
-            cmd += ' --dependency=afterok:' + wait_ids_proton_and_gammas
-        cmd += ' -J {} -e {} -o {} --wrap="{}" '.format('train_pipe', jobe, jobo, base_cmd)
-
-        jobid_train = os.popen(cmd).read().strip('\n')
-        log_train[jobid_train] = cmd
+        jobid_train = executor.submit(base_cmd,
+                                      job_name='train_pipe',
+                                      partition='long',
+                                      wait_jobids=wait_ids_proton_and_gammas,
+                                      stdout=jobo,
+                                      stderr=jobe,
+                                      job_inputs={'stage': 'train_pipe',
+                                                  'particle': 'gamma-diffuse_proton',
+                                                  'input_bytes': dl0_bytes}
+                                      )
+        log_train[jobid_train] = executor.submitted[jobid_train]
 
     # copy this script and config into working dir
     shutil.copyfile(__file__, os.path.join(models_dir, os.path.basename(__file__)))
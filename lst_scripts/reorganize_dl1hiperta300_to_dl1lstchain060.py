@@ -4,12 +4,57 @@
 # in the moment lstchain upgrades to V0.8
 
 import os
+import glob
+import json
+import time
 import tables
 import argparse
+import traceback
 import numpy as np
-from astropy.table import Table, vstack, join
-from astropy.io.misc.hdf5 import write_table_hdf5
-from lst_scripts.reorganize_dl1hiperta_to_dl1lstchain import add_disp_and_mc_type_to_parameters_table
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.recfunctions import append_fields, drop_fields
+from lst_scripts.reorganize_dl1hiperta_to_dl1lstchain import (append_disp_and_mc_type_columns,
+                                                              get_mc_type,
+                                                              join_on_event_id,
+                                                              sort_on_key,
+                                                              renamed_dtype,
+                                                              copy_table_renaming_columns,
+                                                              copy_group_except,
+                                                              stack_tables_by_chunks,
+                                                              stack_images_to_arrays,
+                                                              get_filters_and_chunkshape,
+                                                              read_output_layout,
+                                                              check_output_layout,
+                                                              DEFAULT_CHUNK_SIZE,
+                                                              OUTPUT_LAYOUT_NODES,
+                                                              IMAGE_STORAGES)
+
+# Column renames from the v0.8 (ctapipe / hiperta) to the v0.6 (lstchain) data model
+MC_SHOWER_COLUMNS_V08_TO_V06 = {'true_energy': 'mc_energy',
+                                'true_alt': 'mc_alt',
+                                'true_az': 'mc_az',
+                                'true_core_x': 'mc_core_x',
+                                'true_core_y': 'mc_core_y',
+                                'true_h_first_int': 'mc_h_first_int',
+                                'true_x_max': 'mc_x_max',
+                                'true_shower_primary_id': 'mc_shower_primary_id',
+                                }
+
+PARAMETERS_COLUMNS_V08_TO_V06 = {'hillas_intensity': 'intensity',
+                                 'hillas_x': 'x',
+                                 'hillas_y': 'y',
+                                 'hillas_r': 'r',
+                                 'hillas_phi': 'phi',
+                                 'hillas_length': 'length',
+                                 'hillas_width': 'width',
+                                 'hillas_psi': 'psi',
+                                 'hillas_skewness': 'skewness',
+                                 'hillas_kurtosis': 'kurtosis',
+                                 'timing_slope': 'time_gradient',
+                                 'timing_intercept': 'intercept',
+                                 'morphology_num_pixels': 'n_pixels',
+                                 'morphology_num_islands': 'n_islands',
+                                 }
 
 parser = argparse.ArgumentParser(description="Re-organize the dl1 `standard` output file from either the "
                                              "hiptecta_r1_to_dl1 or hiperta_r1_dl1 to the lstchain DL1 structure")
@@ -28,154 +73,221 @@ parser.add_argument('--outfile', '-o',
                     default='./dl1v0.6_reorganized.h5'
                     )
 
+parser.add_argument('--chunk_size', '-cs',
+                    type=int,
+                    dest='chunk_size',
+                    help='Number of rows of the telescope tables read and written at once. Bounds the memory used. '
+                         f'{DEFAULT_CHUNK_SIZE} by default.',
+                    default=DEFAULT_CHUNK_SIZE
+                    )
 
-def stack_and_write_images_table(input_filename, hfile_out, node_dl1_event):
-    """
-    Stack all the `tel_00X` image tables (in case they exit) and write in the v0.6 file
+parser.add_argument('--output_layout', '-ol',
+                    type=str,
+                    dest='output_layout',
+                    help='Path to a json file with the compression (complib, complevel, shuffle, bitshuffle) and '
+                         f'chunkshape of the output nodes {OUTPUT_LAYOUT_NODES}. Uncompressed by default.',
+                    default=None
+                    )
 
-    Parameters
-    input_filename : [ste] input hfile name
-    hfile_out : output File pointer
-    node_dl1_event : Output hfile (V0.6) dl1.event node pointer
-    """
-    telescope_node = node_dl1_event.telescope
+parser.add_argument('--image_storage', '-is',
+                    type=str,
+                    dest='image_storage',
+                    choices=IMAGE_STORAGES,
+                    help='Storage of the stacked images. `table`: LST_LSTCam table (lstchain layout). `arrays`: one 2-D '
+                         'array (n_events x n_pixels, one image per chunk) per image column, in the LST_LSTCam_arrays '
+                         'group, without the LST_LSTCam table. `arrays` output is NOT readable by lstchain (only by '
+                         '`read_images_arrays`) and is refused by the merge of the MC workflow. `table` by default.',
+                    default='table'
+                    )
 
-    imag_per_tels = [Table(table_img.read()) for table_img in telescope_node.images]
-    image_table = vstack(imag_per_tels)
+parser.add_argument('--benchmark_layouts', '-bl',
+                    type=str,
+                    dest='benchmark_layouts',
+                    help='Benchmark mode. Path to a json file with named output layouts {name: layout}. The infile is '
+                         'converted with each layout and the write time, read time and size are reported. '
+                         'See standard_configs/reorganizer_benchmark_layouts.json',
+                    default=None
+                    )
 
-    for tab in telescope_node.images:
-        hfile_out.remove_node(tab)
+# Batch mode arguments
+parser.add_argument('--input_files', '-f',
+                    type=str,
+                    nargs='+',
+                    dest='input_files',
+                    help='Batch mode. dl1 output files of `hiperta_r0_dl1` (or glob patterns) to be converted.',
+                    default=None
+                    )
 
-    # Todo change names of column `image_mask` to `` ??
+parser.add_argument('--input_list', '-l',
+                    type=str,
+                    dest='input_list',
+                    help='Batch mode. Text file with one dl1 output file of `hiperta_r0_dl1` per line.',
+                    default=None
+                    )
+
+parser.add_argument('--outdir', '-d',
+                    type=str,
+                    dest='outdir',
+                    help='Batch mode. Output directory. ./ by default.',
+                    default='./'
+                    )
 
-    dump_plus_copy_node_to_create_new_table(input_filename,
-                                            hfile_out,
-                                            image_table,
-                                            hfile_out.root.dl1.event.telescope.images,
-                                            newname_pointer='LST_LSTCam',
-                                            tmp_name='imgsTable')
+parser.add_argument('--n_workers', '-n',
+                    type=int,
+                    dest='n_workers',
+                    help='Batch mode. Number of files converted in parallel. By default, the number of CPUs of the '
+                         'slurm allocation (or of the machine).',
+                    default=None
+                    )
 
 
-def stack_and_write_parameters_table(input_filename, hfile_out, node_dl1_event, output_mc_table_pointer):
+def stack_and_write_images_table(hfile_out, dl1_event_pointer08, node_dl1_event, chunk_size=DEFAULT_CHUNK_SIZE,
+                                 output_layout=None, image_storage='table'):
     """
-    Stack all the `tel_00X` parameters tables (of v0.8), change names of the columns and write the table in the
-    V0.6 (lstchain like) format
+    Stack all the `tel_00X` image tables (in case they exit), reading them straight from the v0.8 file, and write in
+    the v0.6 file
 
     Parameters
     hfile_out : output File pointer
+    dl1_event_pointer08 : Input hfile (V0.8) dl1.event node pointer
     node_dl1_event : Output hfile (V0.6) dl1.event node pointer
-    output_mc_table_pointer : output subarray node pointer
+    chunk_size : [int] number of rows of the `tel_00X` tables read and written at once
+    output_layout : [dict] compression and chunkshape of the output nodes
+    image_storage : [str] `table` to write the `LST_LSTCam` table, `arrays` to write the `LST_LSTCam_arrays` group of
+        2-D arrays (see `stack_images_to_arrays`) instead, not readable by lstchain. The chunkshape of the output layout
+        only applies to `table`.
     """
     telescope_node = node_dl1_event.telescope
+    imag_per_tels = list(dl1_event_pointer08.telescope.images)
+    filters, chunkshape = get_filters_and_chunkshape(output_layout, 'images')
 
-    param_per_tels = [Table(table_param.read()) for table_param in telescope_node.parameters]
-    parameter_table = vstack(param_per_tels)
-
-    for tab in telescope_node.parameters:
-        hfile_out.remove_node(tab)
-
-    parameter_table.rename_column('hillas_intensity', 'intensity')
-    parameter_table.rename_column('hillas_x', 'x')
-    parameter_table.rename_column('hillas_y', 'y')
-    parameter_table.rename_column('hillas_r', 'r')
-    parameter_table.rename_column('hillas_phi', 'phi')
-    parameter_table.rename_column('hillas_length', 'length')
-    parameter_table.rename_column('hillas_width', 'width')
-    parameter_table.rename_column('hillas_psi', 'psi')
-    parameter_table.rename_column('hillas_skewness', 'skewness')
-    parameter_table.rename_column('hillas_kurtosis', 'kurtosis')
-    parameter_table.rename_column('timing_slope', 'time_gradient')
-    parameter_table.rename_column('timing_intercept', 'intercept')
-    parameter_table.rename_column('morphology_num_pixels', 'n_pixels')
-    parameter_table.rename_column('morphology_num_islands', 'n_islands')
-    parameter_table.add_column(np.log10(parameter_table['intensity']), name='log_intensity')
-    parameter_table.add_column(parameter_table['width'] / parameter_table['length'], name='wl')
-
-    # Param table is indeed huge - it contains all the mc_events parameters (from v0.6 !!) too
-    mc_event_table = Table(output_mc_table_pointer.mc_shower.read())
-    mc_event_table.remove_column('obs_id')
-    parameter_table = join(parameter_table, mc_event_table, keys='event_id')
-    parameter_table.add_column(np.log10(parameter_table['mc_energy']), name='log_mc_energy')
+    # Todo change names of column `image_mask` to `` ??
 
-    dump_plus_copy_node_to_create_new_table(input_filename,
-                                            hfile_out,
-                                            parameter_table,
-                                            hfile_out.root.dl1.event.telescope.parameters,
-                                            newname_pointer='LST_LSTCam',
-                                            tmp_name='paramsTable')
+    if image_storage == 'arrays':
+        stack_images_to_arrays(hfile_out,
+                               imag_per_tels,
+                               telescope_node.images,
+                               'LST_LSTCam_arrays',
+                               chunk_size=chunk_size,
+                               filters=filters)
+    else:
+        stack_tables_by_chunks(hfile_out,
+                               imag_per_tels,
+                               telescope_node.images,
+                               'LST_LSTCam',
+                               chunk_size=chunk_size,
+                               filters=filters,
+                               chunkshape=chunkshape)
 
 
-def dump_plus_copy_node_to_create_new_table(input_filename, hfile_out, astropy_table_to_copy, newparent_pointer,
-                                            newname_pointer, tmp_name, overwrite=False):
+def modify_parameters_table(parameter_table, mc_event_table, mc_event_sorted=None):
     """
-    General function to write an astropy table to a temporal file, and immediately after copy it to the
-    output v0.6 hfile.
+    Change names of the columns of a (v0.8) parameters table, compute the missing parameters and join it with the
+    mc_event table.
 
     Parameters
-    input_filename : [ste] input hfile name
-    hfile_out : output File pointer
-    astropy_table_to_copy : astropy table to be copied
-    newparent_pointer : newparent copy_node parameter
-    newname_pointer : newname copy_node parameter
-    tmp_name : [str] flag to identify the temportal table and make it unique (necessary when simultaneous reorganizers
-                are run in the same dir)
-    overwrite : overwrite parameter of the copy_node method
+    parameter_table : [numpy.ndarray] parameters structured array
+    mc_event_table : [numpy.ndarray] mc_shower structured array (with v0.6 column names, without `obs_id` and with
+        the `log_mc_energy` column)
+    mc_event_sorted : [tuple] `sort_on_key(mc_event_table)`, computed once for all the chunks of the parameters (see
+        `join_on_event_id`). Sorted at each call if None.
+
+    Returns
+    numpy.ndarray - structured array
     """
-    input_filename = input_filename.split('___')[0]
-    if tmp_name == '':
-        flag_name = 'UNKNOWN'
-    else:
-        flag_name = tmp_name
+    # Renaming is a view of the same data with another dtype
+    parameter_table = parameter_table.view(renamed_dtype(parameter_table.dtype, PARAMETERS_COLUMNS_V08_TO_V06))
+    parameter_table = append_fields(parameter_table,
+                                    ['log_intensity', 'wl'],
+                                    [np.log10(parameter_table['intensity']),
+                                     parameter_table['width'] / parameter_table['length']],
+                                    usemask=False)
 
-    temp_table_name = f'{input_filename}_tmp_table_reoganizer_{flag_name}.h5'
-    write_table_hdf5(astropy_table_to_copy, temp_table_name, path='/root')
-    temp_table = tables.open_file(temp_table_name, 'r')
-    hfile_out.copy_node(temp_table.root.root, newparent=newparent_pointer, newname=newname_pointer, overwrite=overwrite)
-    temp_table.close()
-    os.remove(temp_table_name)
+    # Param table is indeed huge - it contains all the mc_events parameters (from v0.6 !!) too
+    return join_on_event_id(parameter_table, mc_event_table, right_sorted=mc_event_sorted)
 
 
-def rename_mc_shower_colnames(input_filename, hfile_out, event_node, output_mc_table_pointer):
+def stack_and_write_parameters_table(hfile_out, dl1_event_pointer08, node_dl1_event, output_mc_table_pointer,
+                                     run_array_direction, focal, mc_type=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                                     output_layout=None):
+    """
+    Stack all the `tel_00X` parameters tables (of v0.8), reading them straight from the v0.8 file, change names of
+    the columns, add the disp_* and mc_type columns and write the table in the V0.6 (lstchain like) format
+
+    Parameters
+    hfile_out : output File pointer
+    dl1_event_pointer08 : Input hfile (V0.8) dl1.event node pointer
+    node_dl1_event : Output hfile (V0.6) dl1.event node pointer
+    output_mc_table_pointer : output subarray node pointer
+    run_array_direction : [tuple] (az, alt) pointing of the telescopes in rad
+    focal : [float] focal length in meters
+    mc_type : [int] mc_type of the events (see `get_mc_type`). The column is not written if None.
+    chunk_size : [int] number of rows of the `tel_00X` tables read and written at once
+    output_layout : [dict] compression and chunkshape of the output nodes
+    """
+    telescope_node = node_dl1_event.telescope
+    param_per_tels = list(dl1_event_pointer08.telescope.parameters)
+    filters, chunkshape = get_filters_and_chunkshape(output_layout, 'parameters')
+
+    mc_event_table = drop_fields(output_mc_table_pointer.mc_shower.read(), 'obs_id', usemask=False)
+    mc_event_table = append_fields(mc_event_table, 'log_mc_energy', np.log10(mc_event_table['mc_energy']),
+                                   usemask=False)
+    # The mc_events are joined with every chunk of the parameters: sorted once for all
+    mc_event_sorted = sort_on_key(mc_event_table)
+
+    stack_tables_by_chunks(hfile_out,
+                           param_per_tels,
+                           telescope_node.parameters,
+                           'LST_LSTCam',
+                           modify_chunk=lambda chunk, *_: append_disp_and_mc_type_columns(
+                               modify_parameters_table(chunk, mc_event_table, mc_event_sorted),
+                               run_array_direction, focal, mc_type),
+                           chunk_size=chunk_size,
+                           filters=filters,
+                           chunkshape=chunkshape)
+
+
+def rename_mc_shower_colnames(hfile_out, shower_pointer08, output_mc_table_pointer, output_layout=None):
     """
-    Rename column names of the `mc_shower` table and dump the table to the v0.6 output hfile.
+    Copy the v0.8 `shower` table into the `mc_shower` table of the v0.6 output hfile, renaming its columns (see
+    `MC_SHOWER_COLUMNS_V08_TO_V06`). Only the description and attributes of the table change, the data is copied as
+    it is.
 
     Parameters
-    input_filename : [ste] input hfile name
     hfile_out : output File pointer
-    event_node : root.dl1.event node (of output hfile, so V0.6)
+    shower_pointer08 : dl1-file_v0.8 simulation.event.subarray.shower pointer
     output_mc_table_pointer : output subarray node pointer
+    output_layout : [dict] compression and chunkshape of the output nodes
     """
-    mc_shower_table = Table(event_node.subarray.mc_shower.read())
-    mc_shower_table.rename_column('true_energy', 'mc_energy')
-    mc_shower_table.rename_column('true_alt', 'mc_alt')
-    mc_shower_table.rename_column('true_az', 'mc_az')
-    mc_shower_table.rename_column('true_core_x', 'mc_core_x')
-    mc_shower_table.rename_column('true_core_y', 'mc_core_y')
-    mc_shower_table.rename_column('true_h_first_int', 'mc_h_first_int')
-    mc_shower_table.rename_column('true_x_max', 'mc_x_max')
-    mc_shower_table.rename_column('true_shower_primary_id', 'mc_shower_primary_id')
-
-    dump_plus_copy_node_to_create_new_table(input_filename,
-                                            hfile_out,
-                                            mc_shower_table,
-                                            output_mc_table_pointer,
-                                            newname_pointer='mc_shower',
-                                            tmp_name='mcShowerTable',
-                                            overwrite=True)
-
-
-def create_hfile_out(input_filename, outfile_name, sim_pointer08, config_pointer08, dl1_pointer, filter_pointer):
+    filters, chunkshape = get_filters_and_chunkshape(output_layout, 'simulation', default_filters=hfile_out.filters)
+    copy_table_renaming_columns(hfile_out,
+                                shower_pointer08,
+                                output_mc_table_pointer,
+                                'mc_shower',
+                                MC_SHOWER_COLUMNS_V08_TO_V06,
+                                filters=filters,
+                                chunkshape=chunkshape)
+
+
+def create_hfile_out(outfile_name, sim_pointer08, config_pointer08, dl1_pointer, filter_pointer,
+                     chunk_size=DEFAULT_CHUNK_SIZE, output_layout=None, image_storage='table'):
     """
     Create output hfile (lstchainv0.6 like hdf5 file)
 
     Parameters
-    input_filename : [ste] input hfile name
     outfile_name : [str] output hfile name
     sim_pointer08 : dl1-file_v0.8_simulation pointer
     config_pointer08 : dl1-file_v.08_configuration pointer
     dl1_pointer :  dl1-file_v0.8_dl1 pointer
     filter_pointer : dl1-file_v0.8 filters pointer
+    chunk_size : [int] number of rows of the telescope tables read and written at once
+    output_layout : [dict] compression and chunkshape of the `parameters`, `images` and `simulation` output nodes.
+        By default, the stacked tables are not compressed and the simulation nodes keep the input filters.
+    image_storage : [str] storage of the stacked images, `table` or `arrays` (see `stack_and_write_images_table`)
     """
+    sim_filters, sim_chunkshape = get_filters_and_chunkshape(output_layout, 'simulation',
+                                                             default_filters=filter_pointer)
+
     hfile_out = tables.open_file(outfile_name, 'w')
     hfile_out.create_group('/', 'simulation')
     hfile_out.create_group('/', 'dl1')
@@ -187,12 +299,14 @@ def create_hfile_out(input_filename, outfile_name, sim_pointer08, config_pointer
                         newparent=hfile_out.root.simulation,
                         newname='thrown_event_distribution',
                         recursive=True,
-                        filters=filter_pointer)
+                        filters=sim_filters,
+                        chunkshape=sim_chunkshape)
     hfile_out.copy_node(config_pointer08.simulation.run,
                         newparent=hfile_out.root.simulation,
                         newname='run_config',
                         recursive=True,
-                        filters=filter_pointer)
+                        filters=sim_filters,
+                        chunkshape=sim_chunkshape)
 
     # Instrument node V0.6
     #    --instrument (Group)
@@ -218,46 +332,55 @@ def create_hfile_out(input_filename, outfile_name, sim_pointer08, config_pointer
     #          `--subarray (Group)
     #             +--mc_shower (Table)
     #             `--trigger (Table)
-    dl1_event_node06 = hfile_out.copy_node(dl1_pointer.event,
-                                           newparent=hfile_out.root.dl1,
-                                           recursive=True,
-                                           filters=filter_pointer)
+    # Only the nodes kept as they are are copied. The `tel_00X` parameters and images tables are not: they are read
+    # (once) from the input file and stacked into the output file.
+    dl1_event_node06 = copy_group_except(hfile_out,
+                                         dl1_pointer.event,
+                                         hfile_out.root.dl1,
+                                         ['telescope/parameters', 'telescope/images'],
+                                         filters=filter_pointer)
     # This will only happen on ctapipe, not RTA
     # hfile_out.remove_node(dl1_event_node06.telescope.trigger)  # Table stored twice, remove to avoid problems.
 
     subarray_pointer = hfile_out.root.dl1.event.subarray
-    hfile_out.copy_node(sim_pointer08.event.subarray.shower,
-                        newparent=subarray_pointer,
-                        newname="mc_shower",
-                        recursive=True,
-                        filters=filter_pointer)
-
-    rename_mc_shower_colnames(input_filename,
-                              hfile_out,
-                              dl1_event_node06,
-                              subarray_pointer
+    rename_mc_shower_colnames(hfile_out,
+                              sim_pointer08.event.subarray.shower,
+                              subarray_pointer,
+                              output_layout=output_layout
                               )
-    stack_and_write_parameters_table(input_filename,
-                                     hfile_out,
+    stack_and_write_parameters_table(hfile_out,
+                                     dl1_pointer.event,
                                      dl1_event_node06,
-                                     subarray_pointer
+                                     subarray_pointer,
+                                     config_pointer08.simulation.run.col('run_array_direction')[0],
+                                     config_pointer08.instrument.telescope.optics.col('equivalent_focal_length')[0],
+                                     mc_type=get_mc_type(outfile_name),
+                                     chunk_size=chunk_size,
+                                     output_layout=output_layout
                                      )
-    if 'images' in dl1_event_node06.telescope:
-        stack_and_write_images_table(input_filename,
-                                     hfile_out,
-                                     dl1_event_node06
+    if 'images' in dl1_pointer.event.telescope:
+        stack_and_write_images_table(hfile_out,
+                                     dl1_pointer.event,
+                                     dl1_event_node06,
+                                     chunk_size=chunk_size,
+                                     output_layout=output_layout,
+                                     image_storage=image_storage
                                      )
 
     hfile_out.close()
 
 
-def main(input_filename, output_filename):
+def main(input_filename, output_filename, chunk_size=DEFAULT_CHUNK_SIZE, output_layout=None, image_storage='table'):
     """
     Conversion from dl1 data model (ctapipe and hiper(CTA)RTA) data model, and convert it to lstchain_v0.6 data mode.
 
     Parameters
     input_filename : [str] Input filename
     output_filename : [str] Output filename
+    chunk_size : [int] Number of rows of the telescope tables read and written at once. Bounds the memory used.
+    output_layout : [dict] Compression and chunkshape of the output nodes (see `read_output_layout`)
+    image_storage : [str] Storage of the stacked images, `table` (lstchain layout) or `arrays` (not readable by
+        lstchain, see `stack_and_write_images_table`)
     """
     hfile = tables.open_file(input_filename, 'r')
 
@@ -267,14 +390,190 @@ def main(input_filename, output_filename):
     dl1_v08 = hfile.root.dl1
     filter_v08 = hfile.filters
 
-    create_hfile_out(input_filename, output_filename, simulation_v08, configuration_v08, dl1_v08, filter_v08)
-
-    # Add disp_* and mc_type to the parameters table.
-    add_disp_and_mc_type_to_parameters_table(output_filename, 'dl1/event/telescope/parameters/LST_LSTCam')
+    create_hfile_out(output_filename, simulation_v08, configuration_v08, dl1_v08, filter_v08, chunk_size=chunk_size,
+                     output_layout=output_layout, image_storage=image_storage)
 
     hfile.close()
 
 
+def get_n_workers_allocation():
+    """
+    Number of CPUs available for the current job: the slurm allocation if the code runs within a slurm job,
+    the CPUs of the machine otherwise.
+
+    Returns
+    int
+    """
+    for slurm_variable in ['SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE']:
+        if slurm_variable in os.environ:
+            return int(os.environ[slurm_variable])
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def get_output_filename(input_filename, output_dir):
+    """
+    Name of the reorganized file of a `hiperta_r0_dl1` output file, same naming as in `hiperta_r0_to_dl1lstchain`.
+
+    Parameters
+    input_filename : [str] `dl1_*` file produced by `hiperta_r0_dl1`
+    output_dir : [str] output directory
+
+    Returns
+    str
+    """
+    basename = os.path.basename(input_filename)
+    if basename.startswith('dl1_'):
+        basename = basename[len('dl1_'):]
+    return os.path.join(output_dir, 'dl1v06_reorganized_' + basename)
+
+
+def _reorganize_one_file(input_filename, output_filename, chunk_size, output_layout, image_storage):
+    """
+    Worker of `batch_main`. Any exception is caught and returned so that a failing file does not stop the batch.
+    A partially written output file is removed.
+
+    Returns
+    (input_filename, output_filename, error) : error is None if the conversion succeeded, the traceback otherwise.
+    """
+    try:
+        main(input_filename, output_filename, chunk_size=chunk_size, output_layout=output_layout,
+             image_storage=image_storage)
+        return input_filename, output_filename, None
+    except Exception:
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+        return input_filename, output_filename, traceback.format_exc()
+
+
+def batch_main(input_files, output_dir='./', n_workers=None, chunk_size=DEFAULT_CHUNK_SIZE, output_layout=None,
+               image_storage='table'):
+    """
+    Convert several dl1 files (v0.8) to lstchain_v0.6 data model in parallel, with a pool of `n_workers` processes.
+    Modules are imported once per worker, not once per file.
+
+    Parameters
+    input_files : [list] input filenames or glob patterns
+    output_dir : [str] output directory
+    n_workers : [int] number of processes. If None, the number of CPUs of the slurm allocation (or of the machine)
+    chunk_size : [int] number of rows of the telescope tables read and written at once, by each worker
+    output_layout : [dict] compression and chunkshape of the output nodes
+    image_storage : [str] storage of the stacked images, `table` or `arrays`
+
+    Returns
+    failed_files : [dict] input filename --> traceback of the files whose conversion failed
+    """
+    input_filenames = []
+    for pattern in input_files:
+        input_filenames.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+
+    if n_workers is None:
+        n_workers = get_n_workers_allocation()
+
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"\tConverting {len(input_filenames)} files with {n_workers} workers")
+
+    failed_files = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_reorganize_one_file,
+                                   input_filename,
+                                   get_output_filename(input_filename, output_dir),
+                                   chunk_size,
+                                   output_layout,
+                                   image_storage)
+                   for input_filename in input_filenames]
+
+        for input_filename, future in zip(input_filenames, futures):
+            try:
+                _, output_filename, error = future.result()
+            except Exception:
+                # the worker died (e.g. killed when out of memory): the pool is broken (BrokenProcessPool) and the
+                # files not converted yet fail too, but the batch goes on with the report
+                output_filename = get_output_filename(input_filename, output_dir)
+                error = traceback.format_exc()
+                if os.path.exists(output_filename):
+                    os.remove(output_filename)
+            if error is None:
+                print(f'\t\t{input_filename} --> {output_filename}')
+            else:
+                failed_files[input_filename] = error
+                print(f'\t\tFAILED {input_filename}:\n{error}')
+
+    print(f"\t{len(input_filenames) - len(failed_files)} files converted, {len(failed_files)} failed")
+
+    return failed_files
+
+
+def benchmark_output_layouts(input_filename, layouts, output_dir='./', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Convert the same file with different output layouts (compression and chunkshape of the output nodes) and report,
+    for each layout, the time to write the output file, the time to read back its parameters and images tables and
+    the size of the file. Output files are removed after the measurement.
+
+    Note that the read time is measured right after writing, so the file may be (partially) in the page cache.
+
+    Parameters
+    input_filename : [str] dl1 output file of `hiperta_r0_dl1`
+    layouts : [dict] name --> output layout (see `read_output_layout`)
+    output_dir : [str] directory where the (temporal) output files are written
+    chunk_size : [int] number of rows of the telescope tables read and written at once
+
+    Returns
+    results : [dict] name --> {'write_time_s', 'read_time_s', 'size_MB'}
+    """
+    # all the layouts are checked before the first (long) conversion
+    for layout in layouts.values():
+        check_output_layout(layout)
+
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+
+    for name, layout in layouts.items():
+        output_filename = os.path.join(output_dir, f'benchmark_layout_{name}.h5')
+
+        start = time.perf_counter()
+        main(input_filename, output_filename, chunk_size=chunk_size, output_layout=layout)
+        write_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with tables.open_file(output_filename, 'r') as hfile:
+            telescope_node = hfile.root.dl1.event.telescope
+            for node_name in ['parameters', 'images']:
+                if node_name in telescope_node:
+                    telescope_node[node_name].LST_LSTCam.read()
+        read_time = time.perf_counter() - start
+
+        results[name] = {'write_time_s': write_time,
+                         'read_time_s': read_time,
+                         'size_MB': os.path.getsize(output_filename) / 1e6}
+        os.remove(output_filename)
+
+    print(f"\n\t{'layout':<25}{'write (s)':>12}{'read (s)':>12}{'size (MB)':>12}")
+    for name, result in results.items():
+        print(f"\t{name:<25}{result['write_time_s']:>12.2f}{result['read_time_s']:>12.2f}{result['size_MB']:>12.1f}")
+
+    return results
+
+
 if __name__ == '__main__':
     args = parser.parse_args()
-    main(args.infile, args.outfile)
+
+    if args.benchmark_layouts is not None:
+        with open(args.benchmark_layouts) as f:
+            benchmark_layouts = json.load(f)
+        benchmark_output_layouts(args.infile, benchmark_layouts, args.outdir, args.chunk_size)
+
+    elif args.input_files is not None or args.input_list is not None:
+        batch_files = args.input_files if args.input_files is not None else []
+        if args.input_list is not None:
+            with open(args.input_list) as f:
+                batch_files += [line.strip() for line in f if line.strip() != '']
+
+        failed = batch_main(batch_files, args.outdir, args.n_workers, args.chunk_size,
+                            read_output_layout(args.output_layout), args.image_storage)
+        if failed:
+            raise SystemExit(1)
+    else:
+        main(args.infile, args.outfile, args.chunk_size, read_output_layout(args.output_layout), args.image_storage)
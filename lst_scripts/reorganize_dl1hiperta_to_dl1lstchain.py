@@ -7,13 +7,13 @@
 # $ python reorganize_dl1_file -i input.h5 [-o outname.h5]
 
 import os
-import copy
+import json
 import tables
 import argparse
 import numpy as np
-import pandas as pd
+from numpy.lib.recfunctions import repack_fields, append_fields
 import astropy.units as u
-from astropy.table import join, Table, vstack, Column
+from astropy.table import Table, Column
 from ctapipe.coordinates import CameraFrame
 from astropy.time import Time
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz
@@ -27,6 +27,11 @@ from astropy.coordinates import SkyCoord, EarthLocation, AltAz
 
 dl1_params_lstcam_key = 'dl1/event/telescope/parameters/LST_LSTCam'
 dl1_images_lstcam_key = 'dl1/event/telescope/image/LST_LSTCam'
+# number of rows read (and written) at once when stacking the telescope tables
+DEFAULT_CHUNK_SIZE = 10000
+# kind of output nodes whose compression and chunk layout can be configured through an `output_layout` dictionary
+OUTPUT_LAYOUT_NODES = ['parameters', 'images', 'simulation']
+IMAGE_STORAGES = ['table', 'arrays']
 # position of the LST1
 location = EarthLocation.from_geodetic(-17.89139 * u.deg, 28.76139 * u.deg, 2184 * u.m)
 obstime = Time('2018-11-01T02:00')
@@ -51,6 +56,22 @@ parser.add_argument('--outfile', '-o',
                     default='./dl1_reorganized.h5'
                     )
 
+parser.add_argument('--chunk_size', '-cs',
+                    type=int,
+                    dest='chunk_size',
+                    help='Number of rows of the telescope tables read and written at once. Bounds the memory used. '
+                         f'{DEFAULT_CHUNK_SIZE} by default.',
+                    default=DEFAULT_CHUNK_SIZE
+                    )
+
+parser.add_argument('--output_layout', '-ol',
+                    type=str,
+                    dest='output_layout',
+                    help='Path to a json file with the compression (complib, complevel, shuffle, bitshuffle) and '
+                         f'chunkshape of the output nodes {OUTPUT_LAYOUT_NODES}. Uncompressed by default.',
+                    default=None
+                    )
+
 
 def add_column_table(table, ColClass, col_label, values):
     """
@@ -167,107 +188,658 @@ def sky_to_camera(alt, az, focal, pointing_alt, pointing_az):
     return camera_pos
 
 
-def add_disp_and_mc_type_to_parameters_table(dl1_file, table_path):
+def sky_to_camera_numpy(alt, az, focal, pointing_alt, pointing_az):
+    """
+    Closed-form numpy version of `sky_to_camera` for a fixed pointing and focal length, without building any astropy
+    frame. It applies the same rotations (AltAz -> TelescopeFrame) and equidistant projection
+    (TelescopeFrame -> CameraFrame) as ctapipe.
+
+    Parameters
+    ----------
+    alt: `numpy.ndarray` or float - altitude in rad
+    az: `numpy.ndarray` or float - azimuth in rad
+    focal: float - focal length in m
+    pointing_alt: float - pointing altitude in rad
+    pointing_az: float - pointing azimuth in rad
+
+    Returns
+    -------
+    (x, y): `numpy.ndarray` - position in the camera frame in m
+    """
+    alt = np.clip(alt, -np.pi / 2., np.pi / 2.)
+    pointing_alt = np.clip(pointing_alt, -np.pi / 2., np.pi / 2.)
+
+    cos_alt = np.cos(alt)
+    delta_az = az - pointing_az
+
+    # Event direction in the frame centred on the telescope pointing
+    x_tel = np.cos(pointing_alt) * cos_alt * np.cos(delta_az) + np.sin(pointing_alt) * np.sin(alt)
+    y_tel = cos_alt * np.sin(delta_az)
+    z_tel = np.cos(pointing_alt) * np.sin(alt) - np.sin(pointing_alt) * cos_alt * np.cos(delta_az)
+
+    fov_lon = np.arctan2(y_tel, x_tel)
+    fov_lat = np.arctan2(z_tel, np.hypot(x_tel, y_tel))
+
+    return focal * fov_lat, focal * fov_lon
+
+
+def get_mc_type(filename):
+    """
+    mc_type of a file from the particle in its name: 0 for gamma, 1 for electron, 101 for proton.
+
+    Parameters
+    ----------
+    filename: str
+
+    Returns
+    -------
+    int or None if no particle is found in the name
+    """
+    mc_type = None
+    for particle, particle_mc_type in [('gamma', 0), ('electron', 1), ('proton', 101)]:
+        if particle in filename:
+            mc_type = particle_mc_type
+    return mc_type
+
+
+def compute_disp_and_mc_type_columns(x, y, mc_alt, mc_az, run_array_direction, focal, mc_type=None,
+                                     use_astropy_frames=False):
     """
     HARDCODED function obtained from `lstchain.reco.dl0_to_dl1` because `mc_alt_tel` and `mc_az_tel` are zipped within
     `run_array_direction`.
-    1. Reconstruct the disp parameters and source position from a DL1 parameters table and write the result in the file.
-    2. Computes mc_type from the name of the file.
+    Compute the disp parameters, source position, telescope pointing and mc_type columns of parameters.
 
+    Parameters
+    ----------
+    x, y: `numpy.ndarray`
+        Position of the image centroid in the camera, in meters
+    mc_alt, mc_az: `numpy.ndarray`
+        True direction of the showers, in rad
+    run_array_direction: (az, alt) pointing of the telescopes, in rad
+    focal: float
+        Focal length in meters
+    mc_type: int or None
+        mc_type of the events (see `get_mc_type`). If None, the column is not computed.
+    use_astropy_frames: bool
+        Compute the source position in the camera with `sky_to_camera` (astropy frames) instead of the default
+        closed-form `sky_to_camera_numpy`.
+
+    Returns
+    -------
+    dict
+        column name --> values, in the order of the columns of the lstchain parameters table
+    """
+    if use_astropy_frames:
+        source_pos_in_camera = sky_to_camera(mc_alt * u.rad,
+                                             mc_az * u.rad,
+                                             focal * u.m,
+                                             run_array_direction[1] * u.rad,
+                                             run_array_direction[0] * u.rad,
+                                             )
+        src_x = source_pos_in_camera.x.to_value(u.m)
+        src_y = source_pos_in_camera.y.to_value(u.m)
+    else:
+        src_x, src_y = sky_to_camera_numpy(mc_alt,
+                                           mc_az,
+                                           focal,
+                                           run_array_direction[1],
+                                           run_array_direction[0],
+                                           )
+
+    # All in meters
+    disp_parameters = disp(x, y, src_x, src_y)
+
+    new_columns = {'disp_dx': disp_parameters[0],
+                   'disp_dy': disp_parameters[1],
+                   'disp_norm': disp_parameters[2],
+                   'disp_angle': disp_parameters[3],
+                   'disp_sign': disp_parameters[4],
+                   'src_x': src_x,
+                   'src_y': src_y,
+                   'mc_alt_tel': np.ones(len(x)) * run_array_direction[1],
+                   'mc_az_tel': np.ones(len(x)) * run_array_direction[0],
+                   }
+    if mc_type is not None:
+        new_columns['mc_type'] = mc_type * np.ones(len(x))
+
+    return new_columns
+
+
+def append_disp_and_mc_type_columns(parameters, run_array_direction, focal, mc_type=None, use_astropy_frames=False):
+    """
+    Append the disp, source position, telescope pointing and mc_type columns (as float32, see
+    `compute_disp_and_mc_type_columns`) to a parameters structured array, with the `x`, `y`, `mc_alt` and `mc_az`
+    columns. Used to compute them on the parameters chunks while they are stacked, instead of reading back the table.
 
     Parameters
     ----------
-    dl1_file: HDF5 DL1 file containing the required field in `table_path`:
-        - mc_alt
-        - mc_az
-        - mc_alt_tel
-        - mc_az_tel
+    parameters: `numpy.ndarray` - structured array
+    run_array_direction: (az, alt) pointing of the telescopes, in rad
+    focal: float
+        Focal length in meters
+    mc_type: int or None
+    use_astropy_frames: bool
 
-    table_path: path to the parameters table in the file
+    Returns
+    -------
+    `numpy.ndarray` - structured array
+    """
+    new_columns = compute_disp_and_mc_type_columns(parameters['x'], parameters['y'], parameters['mc_alt'],
+                                                   parameters['mc_az'], run_array_direction, focal, mc_type=mc_type,
+                                                   use_astropy_frames=use_astropy_frames)
+    return append_fields(parameters,
+                         list(new_columns),
+                         [np.asarray(values, dtype=np.float32) for values in new_columns.values()],
+                         usemask=False)
+
+
+def renamed_dtype(dtype, renames):
+    """
+    Structured dtype with the fields of `dtype` renamed according to `renames`, and exactly the same memory layout
+    (formats, offsets and itemsize), so that an array can be viewed with it without copying its data.
+
+    Parameters
+    ----------
+    dtype: `numpy.dtype`
+    renames: dict
+        old name --> new name. Fields not in `renames` keep their name.
 
     Returns
     -------
-        None
+    `numpy.dtype`
+    """
+    return np.dtype({'names': [renames.get(name, name) for name in dtype.names],
+                     'formats': [dtype.fields[name][0] for name in dtype.names],
+                     'offsets': [dtype.fields[name][1] for name in dtype.names],
+                     'itemsize': dtype.itemsize})
+
+
+def renamed_attrs(attrs, renames):
+    """
+    User attributes of a pytables node, with the column related attributes renamed according to `renames`:
+    `{column}_UNIT`-like attributes (ctapipe v0.8) and the values of `CTAFIELD_N_NAME`-like attributes.
+
+    Parameters
+    ----------
+    attrs: `tables.attributeset.AttributeSet`
+    renames: dict
+        old column name --> new column name
+
+    Returns
+    -------
+    dict
     """
-    with tables.open_file(dl1_file) as hfile:
-        run_array_dir = copy.copy(hfile.root.simulation.run_config.col('run_array_direction')[0])
-        # Remember that /telescope has been moved previously
-        focal = copy.copy(hfile.root.instrument.telescope.optics.col('equivalent_focal_length')[0])
-
-    df = pd.read_hdf(dl1_file, key=table_path)
-    source_pos_in_camera = sky_to_camera(df.mc_alt.values * u.rad,
-                                         df.mc_az.values * u.rad,
-                                         focal * u.m,
-                                         run_array_dir[1] * u.rad,
-                                         run_array_dir[0] * u.rad,
-                                         )
-
-    disp_parameters = disp(df.x.values * u.m,
-                           df.y.values * u.m,
-                           source_pos_in_camera.x,
-                           source_pos_in_camera.y)
-
-    with tables.open_file(dl1_file, mode="a") as file:
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, 'disp_dx', disp_parameters[0].value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, 'disp_dy', disp_parameters[1].value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, 'disp_norm', disp_parameters[2].value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, 'disp_angle', disp_parameters[3].value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, 'disp_sign', disp_parameters[4])
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, 'src_x', source_pos_in_camera.x.value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, 'src_y', source_pos_in_camera.y.value)
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, 'mc_alt_tel', np.ones(len(df)) * run_array_dir[1])
-        tab = file.root[table_path]
-        add_column_table(tab, tables.Float32Col, 'mc_az_tel', np.ones(len(df)) * run_array_dir[0])
-        if 'gamma' in dl1_file:
-            tab = file.root[table_path]
-            add_column_table(tab, tables.Float32Col, 'mc_type', np.zeros(len(df)))
-        if 'electron' in dl1_file:
-            tab = file.root[table_path]
-            add_column_table(tab, tables.Float32Col, 'mc_type', np.ones(len(df)))
-        if 'proton' in dl1_file:
-            tab = file.root[table_path]
-            add_column_table(tab, tables.Float32Col, 'mc_type', 101*np.ones(len(df)))
-
-
-def create_final_h5(hfile, hfile_tmp, hfile_tmp2, output_filename):
+    new_attrs = {}
+    for key in attrs._f_list('user'):
+        value = attrs[key]
+        if key.endswith('_NAME') and isinstance(value, str) and value in renames:
+            value = renames[value]
+        for old_name, new_name in renames.items():
+            suffix = key[len(old_name) + 1:]
+            if key.startswith(old_name + '_') and suffix.isupper():
+                key = f'{new_name}_{suffix}'
+                break
+        new_attrs[key] = value
+
+    return new_attrs
+
+
+def copy_table_renaming_columns(hfile_out, table, where, name, renames, chunk_size=DEFAULT_CHUNK_SIZE,
+                                createparents=False, filters=None, chunkshape=None):
+    """
+    Copy a pytables Table into `where/name` of `hfile_out` with its columns renamed.
+    Only the description and the attributes of the table change: the rows are read by chunks of `chunk_size` and
+    written back as a zero-copy view with the renamed dtype, without converting the data.
+
+    Parameters
+    ----------
+    hfile_out: `tables.file.File`
+        Output file, opened in write or append mode. It can be the file of `table`.
+    table: `tables.table.Table`
+    where: str or `tables.group.Group`
+        Parent node of the new table
+    name: str
+        Name of the new table
+    renames: dict
+        old column name --> new column name
+    chunk_size: int
+        Number of rows read at once
+    createparents: bool
+        Create the needed groups of `where` if they do not exist
+    filters: `tables.filters.Filters`
+        Filters of the new table. If None, the filters of `table` are kept.
+    chunkshape: tuple or None
+        HDF5 chunkshape of the new table. If None, the chunkshape of `table` is kept.
+
+    Returns
+    -------
+    `tables.table.Table`
+    """
+    new_dtype = renamed_dtype(table.description._v_dtype, renames)
+    new_table = hfile_out.create_table(where, name, description=new_dtype,
+                                       filters=table.filters if filters is None else filters,
+                                       chunkshape=table.chunkshape if chunkshape is None else chunkshape,
+                                       expectedrows=max(table.nrows, 1), createparents=createparents)
+    for key, value in renamed_attrs(table.attrs, renames).items():
+        new_table.attrs[key] = value
+
+    for start in range(0, table.nrows, chunk_size):
+        new_table.append(table.read(start, min(start + chunk_size, table.nrows)).view(new_dtype))
+    new_table.flush()
+
+    return new_table
+
+
+def copy_node_with_layout(hfile_out, node, newparent, filters=None, chunkshape=None):
+    """
+    Copy a node of another file (recursively for a group) into `hfile_out`, with the given filters. The chunkshape is
+    applied to each copied table on its own (a number of rows); the other leaves keep the one computed by pytables.
+
+    Parameters
+    ----------
+    hfile_out: `tables.file.File`
+        Output file, opened in write or append mode
+    node: `tables.node.Node`
+        Node to be copied
+    newparent: `tables.group.Group`
+        Parent group of the copy, in `hfile_out`
+    filters: `tables.filters.Filters`
+        Filters of the copied nodes
+    chunkshape: tuple or None
+        HDF5 chunkshape of the copied tables. If None, it is computed by pytables.
+
+    Returns
+    -------
+    `tables.node.Node`
+        The copy of `node`
+    """
+    if isinstance(node, tables.Group):
+        new_group = hfile_out.create_group(newparent, node._v_name, filters=filters)
+        node._v_attrs._f_copy(new_group)
+        for child in node._f_iter_nodes():
+            copy_node_with_layout(hfile_out, child, new_group, filters=filters, chunkshape=chunkshape)
+        return new_group
+
+    return hfile_out.copy_node(node, newparent=newparent, filters=filters,
+                               chunkshape=chunkshape if isinstance(node, tables.Table) else None)
+
+
+def copy_group_except(hfile_out, group, newparent, excluded_paths, filters=None):
+    """
+    Copy a group (and its attributes) into `newparent`, recursively copying all its nodes except the
+    `excluded_paths`, which are created as empty groups (with their attributes) instead.
+
+    Parameters
+    ----------
+    hfile_out: `tables.file.File`
+        Output file, opened in write or append mode
+    group: `tables.group.Group`
+        Group to be copied
+    newparent: `tables.group.Group`
+        Parent group of the copy, in `hfile_out`
+    excluded_paths: list of str
+        Paths, relative to `group`, of the groups not to be copied (e.g. `telescope/parameters`)
+    filters: `tables.filters.Filters`
+        Filters of the copied nodes
+
+    Returns
+    -------
+    `tables.group.Group`
+        The copy of `group`
+    """
+    new_group = hfile_out.create_group(newparent, group._v_name)
+    group._v_attrs._f_copy(new_group)
+
+    for child in group._f_iter_nodes():
+        name = child._v_name
+        excluded_subpaths = [path[len(name) + 1:] for path in excluded_paths if path.startswith(name + '/')]
+        if name in excluded_paths:
+            new_child = hfile_out.create_group(new_group, name)
+            child._v_attrs._f_copy(new_child)
+        elif excluded_subpaths:
+            copy_group_except(hfile_out, child, new_group, excluded_subpaths, filters=filters)
+        else:
+            hfile_out.copy_node(child, newparent=new_group, recursive=True, filters=filters)
+
+    return new_group
+
+
+def sort_on_key(array, key='event_id'):
+    """
+    Stable sort of the keys of a numpy structured array, as needed by `join_on_event_id`.
+
+    Parameters
+    ----------
+    array: `numpy.ndarray` - structured array
+    key: str
+
+    Returns
+    -------
+    (sorted_keys, order): `numpy.ndarray` - `array[key][order]` and the order of the rows that sorts them
+    """
+    order = np.argsort(array[key], kind='stable')
+    return array[key][order], order
+
+
+def join_on_event_id(left, right, key='event_id', right_sorted=None):
+    """
+    Inner join of two numpy structured arrays on `key`, using sorted keys (`argsort` / `searchsorted`) instead of
+    `astropy.table.join`. Keys can be repeated in both arrays (e.g. one row per telescope for the same event_id in
+    `left`), every matching pair of rows is then returned.
+
+    As `astropy.table.join`, the output is sorted by `key` (keeping the original order of `left` for the same
+    key), contains the columns of `left` followed by the columns of `right` (except `key`), and columns present in
+    both arrays are renamed `{name}_1` and `{name}_2`.
+
+    Parameters
+    ----------
+    left: `numpy.ndarray` - structured array
+    right: `numpy.ndarray` - structured array
+    key: str
+    right_sorted: tuple or None
+        `sort_on_key(right, key)`. To be computed once when the same `right` array is joined with many `left` ones
+        (e.g. the mc_events with every chunk of the parameters), instead of sorting it again at each call.
+
+    Returns
+    -------
+    `numpy.ndarray` - structured array
+    """
+    left_keys, left_order = sort_on_key(left, key)
+    right_keys, right_order = sort_on_key(right, key) if right_sorted is None else right_sorted
+
+    # range of matching rows in the sorted right keys, for each (sorted) left row
+    first = np.searchsorted(right_keys, left_keys, side='left')
+    n_matches = np.searchsorted(right_keys, left_keys, side='right') - first
+
+    left_index = np.repeat(left_order, n_matches)
+    offsets = np.arange(n_matches.sum()) - np.repeat(np.cumsum(n_matches) - n_matches, n_matches)
+    right_index = right_order[np.repeat(first, n_matches) + offsets]
+
+    common_names = (set(left.dtype.names) & set(right.dtype.names)) - {key}
+    out_fields = [(f'{name}_1' if name in common_names else name, left.dtype.fields[name][0], name, left)
+                  for name in left.dtype.names]
+    out_fields += [(f'{name}_2' if name in common_names else name, right.dtype.fields[name][0], name, right)
+                   for name in right.dtype.names if name != key]
+
+    joined = np.empty(len(left_index), dtype=[(out_name, dtype) for out_name, dtype, _, _ in out_fields])
+    for out_name, _, name, array in out_fields:
+        joined[out_name] = array[name][left_index if array is left else right_index]
+
+    return joined
+
+
+def read_output_layout(layout_file):
+    """
+    Read the output layout (compression and chunk layout of the output nodes) from a json file.
+
+    Parameters
+    ----------
+    layout_file: str or None
+        Path to a json file such as
+            {"parameters": {"complib": "blosc:zstd", "complevel": 5, "shuffle": true, "chunkshape": [10000]},
+             "images": {"complib": "blosc:zstd", "complevel": 1, "chunkshape": [1]}}
+        Nodes (among `OUTPUT_LAYOUT_NODES`) not declared keep the default layout.
+
+    Returns
+    -------
+    dict or None
+    """
+    if layout_file is None:
+        return None
+
+    with open(layout_file) as f:
+        output_layout = json.load(f)
+
+    return check_output_layout(output_layout)
+
+
+def check_output_layout(output_layout):
+    """
+    Check that an output layout (see `read_output_layout`) only declares nodes among `OUTPUT_LAYOUT_NODES`.
+
+    Parameters
+    ----------
+    output_layout: dict or None
+        None for the default layout
+
+    Returns
+    -------
+    dict or None
+        the output layout
+    """
+    if output_layout is None:
+        return None
+
+    unknown_nodes = set(output_layout) - set(OUTPUT_LAYOUT_NODES)
+    if unknown_nodes:
+        raise ValueError(f"Unknown nodes {unknown_nodes} in output layout. Valid nodes are {OUTPUT_LAYOUT_NODES}")
+
+    return output_layout
+
+
+def get_filters_and_chunkshape(output_layout, node_kind, default_filters=None):
+    """
+    Filters and chunkshape to be used for a kind of output node.
+
+    Parameters
+    ----------
+    output_layout: dict or None
+        Dictionary `{node_kind: {'complib', 'complevel', 'shuffle', 'bitshuffle', 'chunkshape'}}`. See
+        `read_output_layout`.
+    node_kind: str
+        One of `OUTPUT_LAYOUT_NODES`
+    default_filters: `tables.filters.Filters` or None
+        Filters returned when the node kind is not declared in `output_layout`
+
+    Returns
+    -------
+    (filters, chunkshape): (`tables.filters.Filters` or None, tuple or None)
+    """
+    if output_layout is None or output_layout.get(node_kind) is None:
+        return default_filters, None
+
+    node_layout = dict(output_layout[node_kind])
+    chunkshape = node_layout.pop('chunkshape', None)
+    if chunkshape is not None:
+        chunkshape = tuple(chunkshape) if isinstance(chunkshape, (list, tuple)) else (chunkshape,)
+
+    return tables.Filters(**node_layout), chunkshape
+
+
+def iter_table_chunks(input_tables, chunk_size=DEFAULT_CHUNK_SIZE, read_empty=False):
+    """
+    Iterate over the rows of several pytables Tables, in order, by chunks of `chunk_size` rows.
+
+    Parameters
+    ----------
+    input_tables: list of `tables.table.Table`
+    chunk_size: int
+        Number of rows read at once
+    read_empty: bool
+        Yield an (empty) chunk for the empty tables too
+
+    Yields
+    ------
+    (table_index, start, stop, chunk): chunk is the `numpy` structured array with the rows `start:stop` of
+        `input_tables[table_index]`
+    """
+    for table_index, table in enumerate(input_tables):
+        for start in range(0, max(table.nrows, int(read_empty)), chunk_size):
+            stop = min(start + chunk_size, table.nrows)
+            yield table_index, start, stop, table.read(start, stop)
+
+
+def stack_tables_by_chunks(hfile_out, input_tables, where, name, modify_chunk=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                           createparents=False, filters=None, chunkshape=None):
+    """
+    Stack several pytables Tables into a new table of `hfile_out`.
+    The input tables are read, (modified) and appended to the new table by chunks of `chunk_size` rows, so that the
+    memory used is bounded by the chunk size and not by the size of the tables.
+
+    Parameters
+    ----------
+    hfile_out: `tables.file.File`
+        Output file, opened in write or append mode
+    input_tables: list of `tables.table.Table`
+        Tables to be stacked, in order
+    where: str or `tables.group.Group`
+        Parent node of the new table
+    name: str
+        Name of the new table
+    modify_chunk: callable or None
+        Function `modify_chunk(chunk, table_index, start, stop)` applied to every chunk (`numpy` structured array
+        with the rows `start:stop` of `input_tables[table_index]`) before writing it. It must return a structured
+        array, with the same dtype for all the chunks.
+    chunk_size: int
+        Number of rows read at once
+    createparents: bool
+        Create the needed groups of `where` if they do not exist
+    filters: `tables.filters.Filters`
+        Filters of the new table. If None, the filters of `hfile_out` are used.
+    chunkshape: tuple or None
+        HDF5 chunkshape of the new table. If None, it is computed by pytables.
+
+    Returns
+    -------
+    `tables.table.Table`
+    """
+    expected_rows = sum(table.nrows for table in input_tables)
+    new_table = None
+
+    # Empty tables are read once anyway to define the description of the new table
+    for table_index, start, stop, chunk in iter_table_chunks(input_tables, chunk_size, read_empty=True):
+        if modify_chunk is not None:
+            chunk = modify_chunk(chunk, table_index, start, stop)
+
+        if new_table is None:
+            new_table = hfile_out.create_table(where, name, description=chunk.dtype, filters=filters,
+                                               expectedrows=max(expected_rows, 1), chunkshape=chunkshape,
+                                               createparents=createparents)
+        new_table.append(chunk)
+
+    new_table.flush()
+
+    return new_table
+
+
+def stack_images_to_arrays(hfile_out, input_tables, where, name, chunk_size=DEFAULT_CHUNK_SIZE, createparents=False,
+                           filters=None):
+    """
+    Stack several pytables image Tables into a new group `where/name` of `hfile_out`, storing every image-like
+    column (`image`, `peak_time`/`pulse_time`, `image_mask`...) as one contiguous 2-D array (n_events x n_pixels)
+    instead of a column of a table.
+    Each HDF5 chunk of these arrays holds exactly one image, so that any row or range of rows can be sliced
+    (e.g. `group.image[i]`) without reading the rest of the array.
+    The scalar columns (`obs_id`, `event_id`, `tel_id`...) are stored in the `index` table of the group, with the same
+    row ordering as the arrays. Use `read_images_arrays` to get the rows back in the layout of the stacked table.
+
+    Parameters
+    ----------
+    hfile_out: `tables.file.File`
+        Output file, opened in write or append mode
+    input_tables: list of `tables.table.Table`
+        Image tables to be stacked, in order. They must have the same description.
+    where: str or `tables.group.Group`
+        Parent node of the new group
+    name: str
+        Name of the new group
+    chunk_size: int
+        Number of rows read at once
+    createparents: bool
+        Create the needed groups of `where` if they do not exist
+    filters: `tables.filters.Filters`
+        Filters of the new arrays and table. If None, the filters of `hfile_out` are used.
+
+    Returns
+    -------
+    `tables.group.Group`
+    """
+    expected_rows = max(sum(table.nrows for table in input_tables), 1)
+    description = input_tables[0].description._v_dtype
+    image_columns = [col for col in description.names if description[col].shape != ()]
+    index_columns = [col for col in description.names if description[col].shape == ()]
+
+    group = hfile_out.create_group(where, name, createparents=createparents)
+    group._v_attrs['colnames'] = list(description.names)
+    for col in image_columns:
+        hfile_out.create_earray(group, col, atom=tables.Atom.from_dtype(description[col].base),
+                                shape=(0,) + description[col].shape, filters=filters, expectedrows=expected_rows,
+                                chunkshape=(1,) + description[col].shape)
+    index_table = hfile_out.create_table(group, 'index', description=np.dtype([(col, description[col])
+                                                                               for col in index_columns]),
+                                         filters=filters, expectedrows=expected_rows)
+
+    for _, _, _, chunk in iter_table_chunks(input_tables, chunk_size):
+        for col in image_columns:
+            group[col].append(chunk[col])
+        index_table.append(repack_fields(chunk[index_columns]))
+
+    index_table.flush()
+    for col in image_columns:
+        group[col].flush()
+
+    return group
+
+
+def read_images_arrays(group, start=None, stop=None, step=None):
+    """
+    Compatibility view of a group written by `stack_images_to_arrays`: read the rows `start:stop:step` and return them
+    with the layout of the stacked image table (same columns, in the same order). Only these rows are read.
+
+    Parameters
+    ----------
+    group: `tables.group.Group`
+    start: int or None
+    stop: int or None
+    step: int or None
+
+    Returns
+    -------
+    `astropy.table.Table`
+    """
+    rows = slice(start, stop, step)
+    columns = {col: group.index.read(start, stop, step, field=col) if col in group.index.colnames else group[col][rows]
+               for col in group._v_attrs['colnames']}
+
+    return Table(columns)
+
+
+def create_final_h5(hfile, output_filename, focal=28, chunk_size=DEFAULT_CHUNK_SIZE, output_layout=None):
     """
     Create the final output HDF5 file.
     It copies /instruments and /simulations nodes from the output of hipecta_hdf5_r1_to_dl1.py,
-        - and /dl1/event from the created table.
+        - and /dl1/event from the stacked telescope tables.
         - and includes the image and pulse_time within the correct path, i.e., /dl1/event/telescope/
 
     TODO: Define somehow the paths globally so that it can be used .get_node()
 
     Parameters
     ----------
-        hfile: [obj, astropy.table.table.Table] output file
-        hfile_tmp: [obj, astropy.table.table.Table] hdf5 file with dl1 parameters. path:
-                    `dl1/event/telescope/parameters/LST_LSTCam`
-        hfile_tmp2: [obj, astropy.table.table.Table] hdf5 file with images and pulse_time. path:
-                    `dl1/event/telescope/image/LST_LSTCam`
+        hfile: [obj, tables.file.File] input file
         output_filename: [str] name of output file
+        focal: [float] focal length in meters  # TODO: deprecated, done at hipecta/rta level
+        chunk_size: [int] number of rows of the telescope tables read and written at once
+        output_layout: [dict] compression and chunkshape of the output nodes. See `read_output_layout`
 
     Returns
     -------
         None
 
     """
-    # The complevel MUST be set to zero, otherwise this version of libhdf5 does NOT accept the copy_node()
+    # Uncompressed copy of the instrument nodes, and of the simulation ones unless set by the output layout
     filter = tables.Filters(complevel=0, complib='blosc:zstd', shuffle=False, bitshuffle=False, fletcher32=False)
 
     hfile_out = tables.open_file(output_filename, 'w')
     hfile_out.copy_node(hfile.root.instrument, newparent=hfile_out.root, recursive=True, filters=filter)
-    hfile_out.copy_node(hfile.root.simulation, newparent=hfile_out.root, recursive=True, filters=filter)
-    hfile_out.copy_node(hfile_tmp.root.dl1, newparent=hfile_out.root, recursive=True)
-    hfile_out.copy_children(hfile_tmp2.root.dl1.event.telescope, hfile_out.root.dl1.event.telescope, recursive=True)
+    sim_filters, sim_chunkshape = get_filters_and_chunkshape(output_layout, 'simulation', default_filters=filter)
+    copy_node_with_layout(hfile_out, hfile.root.simulation, hfile_out.root, filters=sim_filters,
+                          chunkshape=sim_chunkshape)
+    mc_event = Table(hfile.root.simulation.mc_event.read())
+    mc_event.add_column(np.log10(mc_event['mc_energy']), name='log_mc_energy')
+    stack_and_write_by_telid(hfile.root.dl1, hfile_out, mc_event.as_array(), focal=focal, chunk_size=chunk_size,
+                             output_layout=output_layout,
+                             run_array_direction=hfile.root.simulation.run_config.col('run_array_direction')[0],
+                             mc_type=get_mc_type(output_filename))
 
     # Move the telescope table from /instrument/subarray to /instrument (lstchain output file dl1 format)
     hfile_out.move_node('/instrument/subarray/telescope', newparent='/instrument', createparents=True)
@@ -311,58 +883,111 @@ def modify_params_table(table, tel_id, focal=28):
     table.add_column(table['width'] / table['length'], name='wl')
 
 
-def stack_by_telid(dl1_pointer, focal=28):
+def modify_params_chunk(chunk, tel_id, mc_event, focal=28, run_array_direction=None, mc_type=None,
+                        mc_event_sorted=None):
     """
-    Stack :
-        - LST telescopes' parameters into a table
+    Modify a chunk of a telescope parameters table (see `modify_params_table`), join it with the mc_events and compute
+    the disp_*, source position, telescope pointing (and mc_type) columns.
+
+    Parameters
+    ----------
+        chunk: [obj, numpy.ndarray] rows of the parameters table
+        tel_id: [int] telescope identifier
+        mc_event: [obj, numpy.ndarray] mc_event structured array (with the `log_mc_energy` column)
+        focal: [float] focal length in meters
+        run_array_direction: [tuple] (az, alt) pointing of the telescopes in rad. The disp_* columns are not computed
+            if None.
+        mc_type: [int] mc_type column (see `get_mc_type`). Not written if None.
+        mc_event_sorted: [tuple] `sort_on_key(mc_event)`, computed once for all the chunks (see `join_on_event_id`)
+
+    Returns
+    -------
+        numpy.ndarray - structured array
+    """
+    table = Table(chunk)
+    modify_params_table(table, tel_id, focal=focal)
+
+    # Join together with the mc_events (log of mc_energy already included)
+    parameters = join_on_event_id(table.as_array(), mc_event, right_sorted=mc_event_sorted)
+    if run_array_direction is not None:
+        parameters = append_disp_and_mc_type_columns(parameters, run_array_direction, focal, mc_type=mc_type)
+    return parameters
+
+
+def stack_and_write_by_telid(dl1_pointer, hfile_out, mc_event, focal=28, chunk_size=DEFAULT_CHUNK_SIZE,
+                             output_layout=None, run_array_direction=None, mc_type=None):
+    """
+    Stack, by chunks of `chunk_size` rows, and write in the output file :
+        - LST telescopes' parameters, joined with the mc_events, into a table
         - Calibrated images and pulse_times into another table
 
     Parameters
     ----------
         dl1_pointer: [obj, tables.group.Group] pointer of the input hdf5 file `hfile.root.dl1`
+        hfile_out: [obj, tables.file.File] output file
+        mc_event: [obj, numpy.ndarray] mc_event structured array (with the `log_mc_energy` column) to be joined with
+            the parameters
         focal: [float] focal length in meters  # TODO: deprecated, done at hipecta/rta level
+        chunk_size: [int] number of rows of the telescope tables read and written at once
+        output_layout: [dict] compression and chunkshape of the output nodes. See `read_output_layout`
+        run_array_direction: [tuple] (az, alt) pointing of the telescopes in rad. If given, the disp, source position
+            and telescope pointing columns are computed for each chunk of the parameters table
+        mc_type: [int] mc_type column of the parameters table (see `get_mc_type`). Not written if None.
 
     Returns
     -------
-        Two tables [obj, astropy.table.table.Table] containing the parameters, and the images and pulse_times int their
-            respective path
+        None. The tables are written in their respective path of the output file.
     """
-
-    tels_params = [Table(tel.parameters.read()) for tel in dl1_pointer]
+    tels = list(dl1_pointer)
     try:
         tel_ids = [tel['telId'][0] for tel in dl1_pointer]
     except:
         # if the tel_id column does not exist, we assign tel ids by simple iteration
-        tel_ids = [i+1 for i in range(len(tels_params))]
-
-    for tab, tel_id in zip(tels_params, tel_ids):
-        modify_params_table(tab, tel_id, focal=focal)
-
-    # tabs = [Table(tel) for tel in tels_params]
-
-    stacked_param = vstack(tels_params)
-
-    images = [Table(tel.calib_pic.read()) for tel in dl1_pointer]
-
-    # adding stupid tel_id to the image table as well
-    for image_tab, tel_id in zip(images, tel_ids):
-        image_tab.add_column(Column(tel_id * np.ones(len(image_tab)), dtype=int), name='tel_id')
-
-    stacked_images = vstack(images)
-    if 'event_id' not in stacked_images.columns:
-        stacked_images.add_column(stacked_param['event_id'])
-
-    try:
-        #  HiPeCTA case
-        stacked_images.rename_column('eventId', 'event_id')
-    except KeyError:
-        #  HiPeRTA case
-        pass
-
-    return stacked_param, stacked_images
-
-
-def reorganize_dl1(input_filename, output_filename):
+        tel_ids = [i+1 for i in range(len(tels))]
+
+    def modify_images_chunk(chunk, tel_index, start, stop):
+        table = Table(chunk)
+        # adding stupid tel_id to the image table as well
+        table.add_column(Column(tel_ids[tel_index] * np.ones(len(table)), dtype=int), name='tel_id')
+        if 'event_id' not in table.columns:
+            table.add_column(tels[tel_index].parameters.read(start, stop, field='event_id'), name='event_id')
+        try:
+            #  HiPeCTA case
+            table.rename_column('eventId', 'event_id')
+        except KeyError:
+            #  HiPeRTA case
+            pass
+        return table.as_array()
+
+    params_filters, params_chunkshape = get_filters_and_chunkshape(output_layout, 'parameters')
+    images_filters, images_chunkshape = get_filters_and_chunkshape(output_layout, 'images')
+    # The mc_events are joined with every chunk of the parameters: sorted once for all
+    mc_event_sorted = sort_on_key(mc_event)
+
+    stack_tables_by_chunks(hfile_out,
+                           [tel.parameters for tel in tels],
+                           '/' + os.path.dirname(dl1_params_lstcam_key),
+                           os.path.basename(dl1_params_lstcam_key),
+                           modify_chunk=lambda chunk, tel_index, *_: modify_params_chunk(
+                               chunk, tel_ids[tel_index], mc_event, focal, run_array_direction, mc_type,
+                               mc_event_sorted),
+                           chunk_size=chunk_size,
+                           createparents=True,
+                           filters=params_filters,
+                           chunkshape=params_chunkshape)
+
+    stack_tables_by_chunks(hfile_out,
+                           [tel.calib_pic for tel in tels],
+                           '/' + os.path.dirname(dl1_images_lstcam_key),
+                           os.path.basename(dl1_images_lstcam_key),
+                           modify_chunk=modify_images_chunk,
+                           chunk_size=chunk_size,
+                           createparents=True,
+                           filters=images_filters,
+                           chunkshape=images_chunkshape)
+
+
+def reorganize_dl1(input_filename, output_filename, chunk_size=DEFAULT_CHUNK_SIZE, output_layout=None):
     """
     Reorganize the output dl1 files of hiperta/hipecta codes to reach the same structure found in lstchain dl1 files.
 
@@ -372,6 +997,10 @@ def reorganize_dl1(input_filename, output_filename):
             Input filename
         output_filename: str
             Output filename
+        chunk_size: int
+            Number of rows of the telescope tables read and written at once. Bounds the memory used.
+        output_layout: dict
+            Compression and chunkshape of the output nodes. See `read_output_layout`
     Returns
     -------
         None. It dumps the final hdf5 file with the correct structure.
@@ -379,43 +1008,12 @@ def reorganize_dl1(input_filename, output_filename):
     """
     hfile = tables.open_file(input_filename, 'r')
 
-    # Pointers
-    dl1 = hfile.root.dl1
-    mc_event = Table(hfile.root.simulation.mc_event.read())
-
-    # Temporal names for temporal files, later erased
-    _param = str(os.path.abspath(output_filename).rsplit('/', 1)[0]) + '/dl1_prams_tmp_' + str(
-        os.path.basename(input_filename))
-    _images = str(os.path.abspath(output_filename).rsplit('/', 1)[0]) + '/dl1_imags_tmp_' + str(
-        os.path.basename(input_filename))
-
     # File has not been reorganized yet ! Thus, the path for optics is inside /instrument/subarray/telescope
     # only valid for LSTs !
     focal = hfile.root.instrument.subarray.telescope.optics.col('equivalent_focal_length')[0]
-    table_dl1, table_imags = stack_by_telid(dl1, focal=focal)
-
-    # Join together with the mc_events, compute log of mc_energy and dump it
-    table_dl1 = join(table_dl1, mc_event, keys='event_id')
-    table_dl1.add_column(np.log10(table_dl1['mc_energy']), name='log_mc_energy')
-
-    # write tmp files
-    table_dl1.write(_param, format='hdf5', path=dl1_params_lstcam_key, overwrite=True)
-    table_imags.write(_images, format='hdf5', path=dl1_images_lstcam_key, overwrite=True)
-
-    # open tmp files
-    _hfile_param = tables.open_file(_param, 'r')
-    _hfile_imags = tables.open_file(_images, 'r')
-
-    create_final_h5(hfile, _hfile_param, _hfile_imags, output_filename)
-
-    # Add disp_* and mc_type to the parameters table
-    add_disp_and_mc_type_to_parameters_table(output_filename, dl1_params_lstcam_key)
 
-    # Close and erase
-    _hfile_param.close()
-    _hfile_imags.close()
-    os.remove(_param)
-    os.remove(_images)
+    # Stack the telescope tables by chunks directly in the final file, disp_* and mc_type included
+    create_final_h5(hfile, output_filename, focal=focal, chunk_size=chunk_size, output_layout=output_layout)
 
     hfile.close()
 
@@ -423,4 +1021,6 @@ def reorganize_dl1(input_filename, output_filename):
 if __name__ == '__main__':
     args = parser.parse_args()
     reorganize_dl1(args.infile,
-                   args.outfile)
+                   args.outfile,
+                   args.chunk_size,
+                   read_output_layout(args.output_layout))
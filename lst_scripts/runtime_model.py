@@ -0,0 +1,243 @@
+#!/usr//bin/env python
+
+# Runtime model of the jobs of the MC workflow, to batch them with a tight `--time` and the partition it fits in.
+#
+# The elapsed times of the jobs of previous productions (sacct) are stored, with the size of their input DL0 files, in
+# a json history file. For each stage and particle, the runtime is modelled as a linear function of the input bytes.
+#
+# usage (update of the history, batched at the end of the workflow by batch_mc_production_check):
+# > python runtime_model.py --job_inputs JOB_INPUTS.json --history RUNTIME_HISTORY.json
+
+import os
+import json
+import argparse
+import tempfile
+import numpy as np
+
+# Maximum time of the slurm partitions of the cluster (seconds), from the shortest one
+PARTITION_TIME_LIMITS = [('short', 8 * 3600),
+                         ('long', 7 * 24 * 3600)]
+
+# The time limit of a job is its predicted runtime x a margin, taken from the largest underestimation of the
+# history, and not lower than MIN_TIME_MARGIN
+MIN_TIME_MARGIN = 1.2
+MIN_TIME_LIMIT = 10 * 60
+
+# Time limit (seconds) of the jobs when their runtime cannot be predicted (no history yet, or no input bytes), by stage or
+# by (stage, particle) when it depends on the particle. Within the limit of the partition the jobs are sent to without
+# prediction: proton DL0 to DL1 and training jobs run in the long partition
+DEFAULT_TIME_LIMITS = {'r0_to_dl1': 4 * 3600,
+                       ('r0_to_dl1', 'proton'): 2 * 24 * 3600,
+                       'r0_to_dl1_rta': 4 * 3600,
+                       'merge': 4 * 3600,
+                       'train_pipe': 2 * 24 * 3600,
+                       'dl1_to_dl2': 4 * 3600,
+                       'move_dl1': 2 * 3600,
+                       'move_logs': 30 * 60,
+                       'fingerprint': 30 * 60,
+                       'prod_check': 30 * 60}
+
+parser = argparse.ArgumentParser(description="Add the elapsed time of finished jobs to the runtime history")
+
+parser.add_argument('--job_inputs', '-i', type=str,
+                    dest='job_inputs',
+                    help='json file with the stage, particle and input bytes of the jobs (by jobid)',
+                    )
+
+parser.add_argument('--history', '-hist', type=str,
+                    dest='history',
+                    help='json runtime history file to update',
+                    )
+
+
+def parse_slurm_elapsed(elapsed):
+    """
+    Convert a slurm elapsed time `[DD-[HH:]]MM:SS[.sss]` to seconds
+
+    Parameters
+    ----------
+    elapsed: str
+
+    Returns
+    -------
+    float
+    """
+    days, _, time = elapsed.rpartition('-')
+    seconds = 0
+    for value in time.split(':'):
+        seconds = 60 * seconds + float(value)
+    return seconds + 24 * 3600 * int(days or 0)
+
+
+def format_slurm_time(seconds):
+    """Format a duration in seconds as a slurm `--time` (D-HH:MM:SS), rounded up to the minute"""
+    minutes = int(np.ceil(seconds / 60))
+    return f'{minutes // 1440}-{minutes // 60 % 24:02d}:{minutes % 60:02d}:00'
+
+
+def read_sacct_records(sacct_output):
+    """
+    Parse the output of `sacct --parsable2 --noheader --format=JobID,Elapsed,State`.
+    Job steps (`jobid.batch`, `jobid.extern`...) are skipped.
+
+    Returns
+    -------
+    dict
+        jobid (`{jobid}_{task}` for array tasks) --> (elapsed seconds, state)
+    """
+    records = {}
+    for line in sacct_output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 3 or '.' in fields[0]:
+            continue
+        records[fields[0]] = (parse_slurm_elapsed(fields[1]), fields[2].split()[0])
+    return records
+
+
+def update_runtime_history(history_file, job_inputs, sacct_records):
+    """
+    Add the COMPLETED jobs to the runtime history.
+
+    Parameters
+    ----------
+    history_file: str
+        json file, list of records {'jobid', 'stage', 'particle', 'input_bytes', 'elapsed_s'}. Created if needed
+    job_inputs: dict
+        jobid --> {'stage', 'particle', 'input_bytes'}, `input_bytes` being a list (by task) for job arrays
+    sacct_records: dict
+        output of `read_sacct_records`
+
+    Returns
+    -------
+    list of dict
+        the updated history
+    """
+    history = []
+    if os.path.exists(history_file):
+        with open(history_file) as f:
+            history = json.load(f)
+    known_jobids = {record['jobid'] for record in history}
+
+    for jobid, inputs in job_inputs.items():
+        if isinstance(inputs['input_bytes'], list):
+            tasks = {f'{jobid}_{task}': input_bytes for task, input_bytes in enumerate(inputs['input_bytes'])}
+        else:
+            tasks = {jobid: inputs['input_bytes']}
+
+        for task_id, input_bytes in tasks.items():
+            if task_id in known_jobids or task_id not in sacct_records or input_bytes is None:
+                continue
+            elapsed, state = sacct_records[task_id]
+            if state == 'COMPLETED':
+                history.append({'jobid': task_id, 'stage': inputs['stage'], 'particle': inputs['particle'],
+                                'input_bytes': input_bytes, 'elapsed_s': elapsed})
+
+    # The new history replaces the old one at once, so that it is never read half written (e.g. by a production
+    # starting meanwhile)
+    tmp_fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(history_file)))
+    with os.fdopen(tmp_fd, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp_file, history_file)
+
+    return history
+
+
+def fit_runtime_model(history):
+    """
+    Fit, for each stage and particle, the runtime as `intercept + slope * input_bytes` (proportional to the input bytes
+    if there are not enough different input sizes, or if the fitted slope is negative).
+
+    Parameters
+    ----------
+    history: list of dict
+        see `update_runtime_history`
+
+    Returns
+    -------
+    dict
+        (stage, particle) --> {'intercept', 'slope', 'margin', 'n_jobs'}
+    """
+    by_stage = {}
+    for record in history:
+        by_stage.setdefault((record['stage'], record['particle']), []).append((record['input_bytes'],
+                                                                               record['elapsed_s']))
+
+    model = {}
+    for key, records in by_stage.items():
+        input_bytes, elapsed = np.array(records, dtype=float).T
+        intercept, slope = 0., 0.
+        if len(np.unique(input_bytes)) > 1:
+            slope, intercept = np.polyfit(input_bytes, elapsed, 1)
+        if slope <= 0 or intercept < 0:
+            intercept, slope = 0., elapsed.sum() / max(input_bytes.sum(), 1.)
+        predicted = np.maximum(intercept + slope * input_bytes, 1.)
+        margin = max(MIN_TIME_MARGIN, 1.1 * (elapsed / predicted).max())
+        model[key] = {'intercept': intercept, 'slope': slope, 'margin': margin, 'n_jobs': len(records)}
+
+    return model
+
+
+def load_runtime_model(history_file):
+    """Runtime model fitted on a history file. Empty model if the file does not exist"""
+    if history_file is None or not os.path.exists(history_file):
+        return {}
+    with open(history_file) as f:
+        return fit_runtime_model(json.load(f))
+
+
+def get_time_and_partition(runtime_model, stage, particle, input_bytes, default_partition='short'):
+    """
+    Time limit and partition of a job from its predicted runtime.
+
+    Parameters
+    ----------
+    runtime_model: dict
+        output of `fit_runtime_model`. None to keep the default partition and time limit
+    stage: str
+    particle: str
+    input_bytes: int or list of int
+        bytes of DL0 files processed by the job (by task for a job array, the longest task setting the time limit)
+    default_partition: str
+        partition used when there is no prediction (no model for this stage and particle, or unknown input)
+
+    Returns
+    -------
+    partition: str
+    time_limit: str
+        slurm `--time`. When there is no prediction, the default time limit of the stage and particle, else of the stage
+        (see `DEFAULT_TIME_LIMITS`), or None for an unknown stage
+    """
+    key = (stage, particle)
+    if not runtime_model or key not in runtime_model or input_bytes is None:
+        for default_key in (key, stage):
+            if default_key in DEFAULT_TIME_LIMITS:
+                return default_partition, format_slurm_time(DEFAULT_TIME_LIMITS[default_key])
+        return default_partition, None
+
+    max_input_bytes = max(input_bytes) if isinstance(input_bytes, list) else input_bytes
+    fit = runtime_model[key]
+    seconds = max(MIN_TIME_LIMIT, fit['margin'] * (fit['intercept'] + fit['slope'] * max_input_bytes))
+
+    for partition, time_limit in PARTITION_TIME_LIMITS:
+        if seconds <= time_limit:
+            return partition, format_slurm_time(seconds)
+
+    partition, time_limit = PARTITION_TIME_LIMITS[-1]
+    return partition, format_slurm_time(time_limit)
+
+
+def get_files_bytes(files):
+    """Total size of a list of files, in bytes"""
+    return sum(os.stat(f).st_size for f in files)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    with open(args.job_inputs) as f:
+        job_inputs = json.load(f)
+
+    jobids = ','.join(job_inputs.keys())
+    sacct_output = os.popen(f'sacct --parsable2 --noheader --format=JobID,Elapsed,State -j {jobids}').read()
+    history = update_runtime_history(args.history, job_inputs, read_sacct_records(sacct_output))
+    print(f'{len(history)} jobs in the runtime history {args.history}')
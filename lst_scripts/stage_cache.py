@@ -0,0 +1,215 @@
+#!/usr//bin/env python
+
+# Content-addressed cache of the outputs of the MC workflow stages, shared by all the PROD_IDs.
+#
+# The fingerprint of a stage is a hash of everything its outputs depend on: its inputs (DL0 files, by name, size and
+# modification time, or the fingerprints of the upstream stages), the part of the lstchain config it uses, the lstchain version, the source environment and
+# the code of the scripts run. It is written next to the outputs (FINGERPRINT_FILE) once the stage has finished
+# correctly, by a job batched after the stage. A later production whose stage has the same fingerprint links those
+# outputs instead of producing them again.
+#
+#   - dl1 (r0_to_dl1 + merge_and_copy_dl1, by particle) : DL1 directory of the production
+#   - models (train_pipe) : models directory of the production
+#
+# usage (batched at the end of a stage):
+# > python stage_cache.py --stage STAGE --write OUTPUT_DIR FINGERPRINT [--write OUTPUT_DIR FINGERPRINT ...]
+
+import os
+import json
+import hashlib
+import argparse
+
+FINGERPRINT_FILE = 'stage_fingerprint.json'
+
+# lstchain config keys only used to train the models (and apply them): they do not change the DL1 files
+RF_CONFIG_KEYS = ['random_forest_regressor_args',
+                  'random_forest_classifier_args',
+                  'regression_features',
+                  'classification_features'
+                  ]
+
+# Scripts whose code makes the outputs of each stage (core_list.sh is left out, it is rewritten with the source
+# environment, which is part of the fingerprint)
+STAGE_SCRIPTS = {'dl1': ['onsite_mc_r0_to_dl1.py', 'onsite_mc_merge_and_copy_dl1.py',
+                         'batch_dl1_utils-merge_and_copy.py', 'batch_dl1_utils-merge_tree.py'],
+                 'models': ['onsite_mc_train.py']
+                 }
+
+parser = argparse.ArgumentParser(description="Write the fingerprint of a finished stage next to its outputs")
+
+parser.add_argument('--stage', '-s', type=str,
+                    dest='stage',
+                    choices=list(STAGE_SCRIPTS),
+                    help='stage of the workflow',
+                    )
+
+parser.add_argument('--write', '-w', type=str,
+                    nargs=2,
+                    action='append',
+                    dest='write',
+                    metavar=('OUTPUT_DIR', 'FINGERPRINT'),
+                    help='output directory of the stage and its fingerprint. Can be repeated',
+                    default=[]
+                    )
+
+
+def hash_file(filename):
+    """sha256 of the content of a file"""
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def compute_fingerprint(components):
+    """sha256 of the fingerprint components (a json serializable dict)"""
+    return hashlib.sha256(json.dumps(components, sort_keys=True).encode()).hexdigest()
+
+
+def read_config(config_file):
+    """lstchain config as a dict. Empty dict for the standard config (None), set by the lstchain version"""
+    if config_file is None:
+        return {}
+    with open(config_file) as f:
+        return json.load(f)
+
+
+def get_scripts_hashes(stage):
+    """sha256 of the scripts run by a stage"""
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    return {script: hash_file(os.path.join(scripts_dir, script)) for script in STAGE_SCRIPTS[stage]}
+
+
+def get_dl1_fingerprint(dl0_dir, config_file, lstchain_version, source_env, options):
+    """
+    Fingerprint of the DL1 files of a particle (r0_to_dl1 and merge_and_copy_dl1 stages)
+
+    Parameters
+    ----------
+    dl0_dir: str
+        directory of the DL0 files of the particle
+    config_file: str
+        lstchain config. None for the standard one
+    lstchain_version: str
+    source_env: str
+        source environment of the jobs
+    options: dict
+        other parameters changing the DL1 files (train/test ratio, random seed, merge options...)
+
+    Returns
+    -------
+    fingerprint: str
+    components: dict
+        what the fingerprint is made of
+    """
+    dl0_files = sorted(os.path.join(dl0_dir, f) for f in os.listdir(dl0_dir)
+                       if os.path.isfile(os.path.join(dl0_dir, f)))
+    config = {key: value for key, value in read_config(config_file).items() if key not in RF_CONFIG_KEYS}
+
+    components = {'stage': 'dl1',
+                  # DL0 files rewritten in place (e.g. a re-simulation) change the fingerprint
+                  'dl0_files': [[f, os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in dl0_files],
+                  'config': config,
+                  'lstchain_version': lstchain_version,
+                  'source_env': source_env,
+                  'options': options,
+                  'scripts': get_scripts_hashes('dl1')
+                  }
+
+    return compute_fingerprint(components), components
+
+
+def get_models_fingerprint(dl1_fingerprints, config_file, lstchain_version, source_env):
+    """
+    Fingerprint of the models (train_pipe stage)
+
+    Parameters
+    ----------
+    dl1_fingerprints: dict
+        particle --> fingerprint of the DL1 files the models are trained on
+    config_file: str
+        lstchain config. None for the standard one
+    lstchain_version: str
+    source_env: str
+        source environment of the jobs
+
+    Returns
+    -------
+    fingerprint: str
+    components: dict
+        what the fingerprint is made of
+    """
+    components = {'stage': 'models',
+                  'dl1_fingerprints': dl1_fingerprints,
+                  'config': read_config(config_file),
+                  'lstchain_version': lstchain_version,
+                  'source_env': source_env,
+                  'scripts': get_scripts_hashes('models')
+                  }
+
+    return compute_fingerprint(components), components
+
+
+def write_fingerprint(output_dir, stage, fingerprint):
+    """Write the fingerprint of a stage in its output directory"""
+    with open(os.path.join(output_dir, FINGERPRINT_FILE), 'w') as f:
+        json.dump({'stage': stage, 'fingerprint': fingerprint}, f)
+
+
+def find_cached_output(output_dir, stage, fingerprint):
+    """
+    Output directory of another production (sibling of `output_dir`, i.e. another PROD_ID) with the same fingerprint.
+
+    Returns
+    -------
+    str or None if there is none
+    """
+    productions_dir = os.path.dirname(os.path.abspath(output_dir))
+    if not os.path.isdir(productions_dir):
+        return None
+
+    for prod_id in sorted(os.listdir(productions_dir)):
+        cached_dir = os.path.join(productions_dir, prod_id)
+        fingerprint_file = os.path.join(cached_dir, FINGERPRINT_FILE)
+        if cached_dir == os.path.abspath(output_dir) or not os.path.isfile(fingerprint_file):
+            continue
+        with open(fingerprint_file) as f:
+            cached = json.load(f)
+        if cached['stage'] == stage and cached['fingerprint'] == fingerprint:
+            return cached_dir
+
+    return None
+
+
+def link_cached_output(cached_dir, output_dir, stage, fingerprint):
+    """
+    Link (hard link, or symbolic link across file systems) the content of `cached_dir` into `output_dir`. The PROD_ID
+    of the cached production in the file names is replaced by the one of `output_dir`.
+    """
+    old_prod_id = os.path.basename(os.path.normpath(cached_dir))
+    new_prod_id = os.path.basename(os.path.normpath(output_dir))
+
+    for root, dirs, files in os.walk(cached_dir):
+        destination_dir = os.path.join(output_dir, os.path.relpath(root, cached_dir))
+        os.makedirs(destination_dir, exist_ok=True)
+        for f in files:
+            if f == FINGERPRINT_FILE:
+                continue
+            source = os.path.join(root, f)
+            destination = os.path.join(destination_dir, f.replace(old_prod_id, new_prod_id))
+            if os.path.lexists(destination):
+                os.remove(destination)
+            try:
+                os.link(source, destination)
+            except OSError:
+                os.symlink(os.path.realpath(source), destination)
+
+    write_fingerprint(output_dir, stage, fingerprint)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for output_dir, fingerprint in args.write:
+        write_fingerprint(output_dir, args.stage, fingerprint)
+        print(f'{args.stage} fingerprint {fingerprint} written in {output_dir}')
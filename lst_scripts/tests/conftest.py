@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts of lst_scripts import each other as top-level modules (they are run from that directory)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
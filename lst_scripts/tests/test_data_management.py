@@ -0,0 +1,59 @@
+import os
+import tables
+import datetime
+from lst_scripts.data_management import pack_files_by_size, get_dl1_filename, get_missing_dl1_files, get_prod_id
+
+
+def test_pack_files_by_size(tmp_path):
+    sizes = [900, 100, 500, 500, 300, 300, 200, 50, 50, 1000]
+    files = []
+    for i, size in enumerate(sizes):
+        files.append(str(tmp_path / f'run{i}.simtel.gz'))
+        with open(files[-1], 'w') as f:
+            f.truncate(size)
+
+    sublists = pack_files_by_size(files, max_size=1000)
+    sublists_sizes = [sum(sizes[files.index(f)] for f in sublist) for sublist in sublists]
+
+    assert len(sublists) == 4
+    assert sorted(f for sublist in sublists for f in sublist) == sorted(files)
+    assert sublists_sizes == sorted(sublists_sizes, reverse=True)
+    assert max(sublists_sizes) - min(sublists_sizes) <= 100
+
+    assert pack_files_by_size(files, max_size=1e6) == [sorted(files, key=lambda f: sizes[files.index(f)], reverse=True)]
+    assert len(pack_files_by_size(files, max_size=1)) == len(files)
+    assert pack_files_by_size([], max_size=1000) == []
+
+
+def test_get_missing_dl1_files(tmp_path):
+    dl0_files = [f'/dl0/gamma_run{i}.simtel.gz' for i in range(4)]
+    assert get_dl1_filename(dl0_files[0]) == 'dl1_gamma_run0.h5'
+    assert (get_dl1_filename('/dl0/gamma_20deg_node_theta_10.0_az_102.199_run1.simtel.zst') ==
+            'dl1_gamma_20deg_node_theta_10.0_az_102.199_run1.h5')
+
+    with tables.open_file(tmp_path / 'dl1_gamma_run0.h5', 'w') as hfile:
+        hfile.create_group('/simulation', 'thrown_event_distribution', createparents=True)
+    with tables.open_file(tmp_path / 'dl1_gamma_run1.h5', 'w') as hfile:
+        hfile.create_group('/dl1', 'event', createparents=True)
+    with open(tmp_path / 'dl1_gamma_run2.h5', 'w') as f:
+        f.write('interrupted')
+
+    assert get_missing_dl1_files(dl0_files, str(tmp_path)) == dl0_files[1:]
+
+
+def test_get_prod_id_resume_another_day(tmp_path):
+    running_analysis_dir = str(tmp_path / 'running_analysis' / '{}' / 'node_theta_10.0_az_102.199_')
+    day_1, day_2 = datetime.date(2021, 3, 15), datetime.date(2021, 3, 16)
+
+    prod_id = get_prod_id('test', 'v0.7.3', date=day_1)
+    assert prod_id == '20210315_v0.7.3_test'
+    for particle in ['gamma', 'proton']:
+        os.makedirs(os.path.join(running_analysis_dir.format(particle), prod_id))
+    os.makedirs(os.path.join(running_analysis_dir.format('proton'), '20210314_v0.7.3_test'))
+    os.makedirs(os.path.join(running_analysis_dir.format('proton'), '20210315_v0.7.3_other'))
+
+    # resumed the next day: the production started on day 1 is found, and a full PROD_ID is used as it is
+    assert get_prod_id('test', 'v0.7.3', running_analysis_dir, date=day_2) == prod_id
+    assert get_prod_id('20210314_v0.7.3_test', 'v0.7.3', running_analysis_dir, date=day_2) == '20210314_v0.7.3_test'
+    assert get_prod_id(None, 'v0.7.3', running_analysis_dir, date=day_2) == '20210316_v0.7.3_v00'
+    assert get_prod_id('test', 'vRTA_v0.7.3', running_analysis_dir, date=day_2) == '20210316_vRTA_v0.7.3_test'
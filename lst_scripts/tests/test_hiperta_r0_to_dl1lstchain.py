@@ -0,0 +1,74 @@
+import os
+import sys
+import subprocess
+from lst_scripts import hiperta_r0_to_dl1lstchain
+
+
+def fake_hiperta(tmp_path, monkeypatch, fail_on=None, hiperta_fail_on=None):
+    """
+    hiperta_r0_dl1 writing a dummy dl1 file (a partial one and failing for the file `hiperta_fail_on`), and a
+    reorganizer copying it (failing for the file `fail_on`)
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'hiperta_r0_dl1').write_text('#!/bin/sh\n'
+                                            'while [ $# -gt 0 ]; do\n'
+                                            '    case $1 in -i) infile=$2;; -o) outdir=$2;; esac; shift\n'
+                                            'done\n'
+                                            'echo dl1 > $outdir/dl1_$(basename $infile)\n'
+                                            f'[ "$(basename $infile)" != "{hiperta_fail_on}" ]\n')
+    (bin_dir / 'hiperta_r0_dl1').chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+
+    def reorganize_dl1(input_filename, output_filename, image_storage='table'):
+        # the output feeds the lstchain workflow
+        assert image_storage == 'table'
+        if fail_on is not None and os.path.basename(input_filename) == f'dl1_{fail_on}':
+            raise OSError(f'cannot reorganize {input_filename}')
+        with open(input_filename) as f_in, open(output_filename, 'w') as f_out:
+            f_out.write(f_in.read())
+
+    monkeypatch.setattr(hiperta_r0_to_dl1lstchain, 'reorganize_dl1', reorganize_dl1)
+
+
+def test_staging(tmp_path, monkeypatch):
+    fake_hiperta(tmp_path, monkeypatch)
+    staging_dir, outdir = tmp_path / 'tmpdir', tmp_path / 'dl1'
+    monkeypatch.setenv('TMPDIR', str(staging_dir))
+    infiles = [str(tmp_path / f'gamma_run{i}.simtel.gz') for i in range(3)]
+
+    assert hiperta_r0_to_dl1lstchain.main_list(infiles, str(outdir), keep_file=True, staging=True) == {}
+
+    assert sorted(os.listdir(outdir)) == sorted([f'dl1_gamma_run{i}.simtel.gz' for i in range(3)] +
+                                                [f'dl1v06_reorganized_gamma_run{i}.simtel.gz' for i in range(3)])
+    assert os.listdir(staging_dir) == []
+
+
+def test_staging_cleanup_on_failure(tmp_path, monkeypatch):
+    fake_hiperta(tmp_path, monkeypatch, fail_on='gamma_run1.simtel.gz', hiperta_fail_on='gamma_run2.simtel.gz')
+    staging_dir, outdir = tmp_path / 'tmpdir', tmp_path / 'dl1'
+    infiles = [str(tmp_path / f'gamma_run{i}.simtel.gz') for i in range(4)]
+
+    failed_files = hiperta_r0_to_dl1lstchain.main_list(infiles, str(outdir), staging=True, staging_dir=str(staging_dir))
+
+    # the failed files (reorganizer and hiperta_r0_dl1 failures) are reported, the others are converted and the staged
+    # files of the failed ones removed
+    assert sorted(failed_files) == infiles[1:3]
+    assert 'hiperta_r0_dl1 failed' in failed_files[infiles[2]]
+    assert sorted(os.listdir(outdir)) == ['dl1v06_reorganized_gamma_run0.simtel.gz',
+                                          'dl1v06_reorganized_gamma_run3.simtel.gz']
+    assert os.listdir(staging_dir) == []
+
+
+def test_main_list_exit_code(tmp_path, monkeypatch):
+    fake_hiperta(tmp_path, monkeypatch, hiperta_fail_on='gamma_run0.simtel.gz')
+    input_list = tmp_path / 'gamma.list'
+    input_list.write_text(f'{tmp_path / "gamma_run0.simtel.gz"}\n')
+    script = os.path.join(os.path.dirname(__file__), os.pardir, 'hiperta_r0_to_dl1lstchain.py')
+    package_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+    monkeypatch.setenv('PYTHONPATH', os.path.abspath(package_dir))
+
+    run = subprocess.run([sys.executable, script, '-l', str(input_list), '-o', str(tmp_path / 'dl1'), '-s', 'True',
+                          '-sd', str(tmp_path / 'tmpdir')], capture_output=True, text=True)
+    assert run.returncode != 0
+    assert str(tmp_path / 'gamma_run0.simtel.gz') in run.stderr
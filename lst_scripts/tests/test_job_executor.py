@@ -0,0 +1,58 @@
+from lst_scripts.job_executor import LocalExecutor, SlurmExecutor
+
+
+def test_local_executor(tmp_path):
+    executor = LocalExecutor(max_workers=2, accounting_file=tmp_path / 'accounting.txt')
+    order = tmp_path / 'order.txt'
+
+    first = executor.submit(f'sleep 0.2; echo first >> {order}', job_name='first', stdout=str(tmp_path / 'first.o'))
+    array = executor.submit(f'echo task $SLURM_ARRAY_TASK_ID >> {order}', job_name='array', wait_jobids=first,
+                            n_array_tasks=3, stdout=str(tmp_path / 'job%a.o'))
+    last = executor.submit(f'echo last >> {order}', wait_jobids=f'{first},{array}', stdout=str(tmp_path / 'last.o'))
+    failed = executor.submit('exit 3', stdout=str(tmp_path / 'failed.o'))
+    cancelled = executor.submit(f'echo cancelled >> {order}', wait_jobids=f'{failed},{first}',
+                                stdout=str(tmp_path / 'cancelled.o'))
+
+    states = executor.wait()
+
+    lines = order.read_text().splitlines()
+    assert lines[0] == 'first'
+    assert sorted(lines[1:4]) == ['task 0', 'task 1', 'task 2']
+    assert lines[4:] == ['last']
+    assert states[array] == states[f'{array}_2'] == states[last] == 'COMPLETED'
+    assert states[failed] == 'FAILED'
+    assert states[cancelled] == 'CANCELLED'
+    assert (tmp_path / 'job2.o').exists()
+    assert len((tmp_path / 'accounting.txt').read_text().splitlines()) == 7
+
+
+def test_slurm_executor_command(monkeypatch):
+    commands = []
+
+    class SbatchOutput:
+        def read(self):
+            return '1234\n'
+
+    def popen(cmd):
+        commands.append(cmd)
+        return SbatchOutput()
+
+    monkeypatch.setattr('lst_scripts.job_executor.os.popen', popen)
+
+    executor = SlurmExecutor()
+    jobid = executor.submit('core_list.sh "lstchain_mc_r0_to_dl1 -o out" lists/training', job_name='r0dl1_g',
+                            wait_jobids='12,13', stdout='job%a_train.o', stderr='job%a_train.e', n_array_tasks=4,
+                            wrap=False)
+
+    assert jobid == '1234'
+    assert commands == ['sbatch --parsable -p short -J r0dl1_g --array=0-3 --dependency=afterok:12,13 '
+                        '-e job%a_train.e -o job%a_train.o core_list.sh "lstchain_mc_r0_to_dl1 -o out" lists/training']
+    assert executor.submitted[jobid] == commands[0]
+
+    executor.runtime_model = {('merge', 'proton'): {'intercept': 0., 'slope': 1e-6, 'margin': 1.2, 'n_jobs': 3}}
+    executor.submit('merge', job_inputs={'stage': 'merge', 'particle': 'proton', 'input_bytes': 1e9})
+    executor.submit('merge', job_inputs={'stage': 'merge', 'particle': 'gamma', 'input_bytes': 1e9})
+
+    assert commands[1:] == ['sbatch --parsable -p short --time=0-00:20:00 --wrap="merge"',
+                            'sbatch --parsable -p short --time=0-04:00:00 --wrap="merge"']
+    assert executor.job_inputs['1234']['particle'] == 'gamma'
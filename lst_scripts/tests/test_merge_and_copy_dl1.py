@@ -0,0 +1,148 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+from lst_scripts.job_executor import SlurmExecutor
+from lst_scripts.onsite_mc_merge_and_copy_dl1 import submit_merge_tree, submit_streaming_merge
+
+
+def fake_sbatch(monkeypatch):
+    """sbatch commands, the jobids being their position from 1"""
+    commands = []
+
+    class SbatchOutput:
+        def __init__(self, jobid):
+            self.jobid = jobid
+
+        def read(self):
+            return f'{self.jobid}\n'
+
+    def popen(cmd):
+        commands.append(cmd)
+        return SbatchOutput(len(commands))
+
+    monkeypatch.setattr('lst_scripts.job_executor.os.popen', popen)
+    return commands
+
+
+def test_submit_merge_tree(monkeypatch):
+    commands = fake_sbatch(monkeypatch)
+
+    # 10 files by groups of 3: 4 groups at level 0, 2 at level 1, then the final merge
+    jobids = submit_merge_tree(SlurmExecutor(), '/dl1/training', '/dl1/merged.h5', '/tree', 10, 3, True, False,
+                               'p_merge', '7,8')
+    assert jobids == ['1', '2', '3']
+    assert '--array=0-3 --dependency=afterok:7,8' in commands[0]
+    assert '-i /dl1/training' in commands[0] and '-o /tree/level0' in commands[0]
+    assert '--intermediate False' in commands[0]
+    assert '--array=0-1 --dependency=afterok:1' in commands[1]
+    assert '-i /tree/level0' in commands[1] and '--intermediate True' in commands[1]
+    assert '--array' not in commands[2] and '--dependency=afterok:2' in commands[2]
+    assert '-f /dl1/merged.h5 --cleanup_dir /tree' in commands[2]
+
+    assert len(submit_merge_tree(SlurmExecutor(), '/dl1/testing', '/dl1/merged.h5', '/tree', 3, 3, True, False,
+                                 'p_merge', '7')) == 1
+
+    # time limits from the runtime model of the merge, each job with the share of the bytes of the files it merges
+    commands.clear()
+    executor = SlurmExecutor({('merge', 'proton'): {'intercept': 0., 'slope': 1e-6, 'margin': 1., 'n_jobs': 3}})
+    submit_merge_tree(executor, '/dl1/training', '/dl1/merged.h5', '/tree', 10, 3, True, False, 'p_merge', '7,8',
+                      job_inputs={'stage': 'merge', 'particle': 'proton', 'input_bytes': 1e10})
+    assert executor.job_inputs['1']['input_bytes'] == [3e9, 3e9, 3e9, 1e9]
+    assert executor.job_inputs['2']['input_bytes'] == [9e9, 1e9]
+    assert executor.job_inputs['3']['input_bytes'] == 1e10
+    assert '--time=0-00:50:00' in commands[0] and '--time=0-02:47:00' in commands[2]
+
+
+def test_merge_tree_empty_group(tmp_path):
+    merge_tree_script = os.path.join(os.path.dirname(__file__), os.pardir, 'batch_dl1_utils-merge_tree.py')
+    (tmp_path / 'dl1').mkdir()
+    (tmp_path / 'dl1' / 'dl1_run0.h5').write_text('dl1')
+
+    # a missing DL1 file leaves the last level 0 group empty: it must not break the tree
+    level0 = subprocess.run([sys.executable, merge_tree_script, '-i', str(tmp_path / 'dl1'), '-fi', '2', '-g', '1',
+                             '-o', str(tmp_path / 'level0')])
+    assert level0.returncode == 0
+    final = subprocess.run([sys.executable, merge_tree_script, '-i', str(tmp_path / 'level0'), '-fi', '2',
+                            '--intermediate', 'True', '-f', str(tmp_path / 'merged.h5')])
+    assert final.returncode != 0
+
+
+def test_submit_streaming_merge(monkeypatch, tmp_path):
+    commands = fake_sbatch(monkeypatch)
+    r0_dl1_logs = {'90': {'dl1_files': [['/dl1/a.h5', '/dl1/b.h5'], ['/dl1/c.h5'], ['/dl1/d.h5']],
+                          'input_bytes': [2e9, 1e9, 1e9]}}
+    dl1_files = ['/dl1/a.h5', '/dl1/b.h5', '/dl1/c.h5', '/dl1/d.h5', '/dl1/kept.h5']
+
+    executor = SlurmExecutor()
+    jobids = submit_streaming_merge(executor, r0_dl1_logs, dl1_files, '/dl1/merged.h5', str(tmp_path), 2,
+                                    True, False, 'p_merge', 'proton')
+    assert jobids == ['1', '2', '3']
+    # the files kept from a previous attempt are merged first without waiting, then each job extends the merged file
+    # as soon as its tasks finish
+    assert '--dependency' not in commands[0] and '--append False' in commands[0]
+    assert (tmp_path / 'dl1_merged_0000.list').read_text().split() == ['/dl1/kept.h5']
+    assert '--dependency=afterok:90_0,90_1,1' in commands[1] and '--append True' in commands[1]
+    assert (tmp_path / 'dl1_merged_0001.list').read_text().split() == ['/dl1/a.h5', '/dl1/b.h5', '/dl1/c.h5']
+    assert '--dependency=afterok:90_2,2' in commands[2]
+    assert all('-f /dl1/merged.h5' in cmd for cmd in commands)
+    assert f'--append True --cleanup_dir {tmp_path}' in commands[2]
+    # DL0 bytes of the tasks of each job, estimated for the kept file
+    assert [executor.job_inputs[jobid]['input_bytes'] for jobid in jobids] == [1e9, 3e9, 1e9]
+
+
+def test_streaming_merge_append(tmp_path):
+    tables = pytest.importorskip('tables')
+    merge_tree_script = os.path.join(os.path.dirname(__file__), os.pardir, 'batch_dl1_utils-merge_tree.py')
+    merged_file = tmp_path / 'merged.h5'
+    for name, n_rows, dtype in [('merged.h5', 3, 'f8'), ('dl1_run1.h5', 2, 'f8'), ('dl1_run3.h5', 4, 'f4')]:
+        with tables.open_file(str(tmp_path / name), 'w') as f:
+            parameters = np.zeros(n_rows, dtype=[('x', dtype)])
+            parameters['x'] = np.arange(n_rows)
+            f.create_table('/dl1/event/telescope/parameters', 'LST_LSTCam', parameters, createparents=True)
+            f.create_table('/simulation', 'run_config', np.zeros(1, dtype=[('run_id', 'i8')]), createparents=True)
+            f.create_table('/instrument/telescope', 'optics', np.ones(1, dtype=[('focal', 'f8')]), createparents=True)
+
+    # the DL1 file of a failed task is missing: the others are appended to the running merged file, by two jobs
+    for job, files in enumerate([['dl1_run1.h5', 'dl1_run2.h5'], ['dl1_run3.h5']]):
+        file_list = tmp_path / f'dl1_merged_{job:04d}.list'
+        file_list.write_text(''.join(f'{tmp_path / file}\n' for file in files))
+        merge = subprocess.run([sys.executable, merge_tree_script, '-l', str(file_list), '-f', str(merged_file),
+                                '--append', 'True'])
+        assert merge.returncode == 0
+
+    with tables.open_file(str(merged_file)) as f:
+        parameters = f.root.dl1.event.telescope.parameters.LST_LSTCam.read()
+        assert parameters.dtype == np.dtype([('x', 'f8')])
+        np.testing.assert_array_equal(parameters['x'], [0, 1, 2, 0, 1, 0, 1, 2, 3])
+        # the tables describing the production are not appended
+        assert f.root.simulation.run_config.nrows == 1
+        assert f.root.instrument.telescope.optics.nrows == 1
+
+    # a file without the event tables of the merged file fails the merge, or is skipped with --smart
+    with tables.open_file(str(tmp_path / 'dl1_other.h5'), 'w') as f:
+        f.create_table('/dl1/event/telescope/parameters', 'LST_LSTCam', np.zeros(2, dtype=[('y', 'f8')]),
+                       createparents=True)
+    file_list.write_text(f'{tmp_path / "dl1_other.h5"}\n')
+    for smart, failed in [('False', True), ('True', False)]:
+        merge = subprocess.run([sys.executable, merge_tree_script, '-l', str(file_list), '-f', str(merged_file),
+                                '--append', 'True', '--smart', smart])
+        assert (merge.returncode != 0) == failed
+    with tables.open_file(str(merged_file)) as f:
+        assert f.root.dl1.event.telescope.parameters.LST_LSTCam.nrows == 9
+
+
+def test_merge_tree_refuses_image_arrays(tmp_path):
+    tables = pytest.importorskip('tables')
+    merge_tree_script = os.path.join(os.path.dirname(__file__), os.pardir, 'batch_dl1_utils-merge_tree.py')
+    (tmp_path / 'dl1').mkdir()
+    with tables.open_file(str(tmp_path / 'dl1' / 'dl1_run0.h5'), 'w') as f:
+        f.create_group('/dl1/event/telescope/images', 'LST_LSTCam_arrays', createparents=True)
+
+    # `arrays` images are not readable by lstchain: the file is refused before lstchain_merge_hdf5_files
+    merge = subprocess.run([sys.executable, merge_tree_script, '-i', str(tmp_path / 'dl1'), '-fi', '2',
+                            '-f', str(tmp_path / 'merged.h5')], capture_output=True, text=True)
+    assert merge.returncode != 0
+    assert 'dl1_run0.h5' in merge.stderr
+    assert not (tmp_path / 'merged.h5').exists()
@@ -0,0 +1,204 @@
+import os
+import json
+import pytest
+import numpy as np
+import tables
+import astropy.units as u
+from astropy.table import Table, vstack, join
+from lst_scripts.reorganize_dl1hiperta_to_dl1lstchain import (stack_tables_by_chunks,
+                                                              stack_images_to_arrays,
+                                                              read_images_arrays,
+                                                              join_on_event_id,
+                                                              sort_on_key,
+                                                              append_disp_and_mc_type_columns,
+                                                              sky_to_camera,
+                                                              sky_to_camera_numpy)
+from lst_scripts import reorganize_dl1hiperta300_to_dl1lstchain060 as reorganizer300
+from lst_scripts.reorganize_dl1hiperta_to_dl1lstchain import reorganize_dl1
+from lst_benchmarks.synthetic_dl1_files import create_hiperta_v300_file, create_hipecta_file
+
+
+def create_dummy_table(filename, n_rows=1000):
+    data = np.zeros(n_rows, dtype=[('event_id', 'i8'), ('tel_id', 'i2'), ('x', 'f4')])
+    data['event_id'] = np.arange(n_rows)
+    data['tel_id'] = 1
+    data['x'] = np.linspace(-1, 1, n_rows)
+    with tables.open_file(filename, 'w') as hfile:
+        table = hfile.create_table('/', 'parameters', obj=data)
+        table.attrs['dummy_attr'] = 'dummy'
+
+
+def add_wl(chunk, table_index, start, stop):
+    table = Table(chunk)
+    table['tel_id'] = table_index
+    table['wl'] = 2 * table['x']
+    return table.as_array()
+
+
+def test_stack_tables_by_chunks(tmp_path):
+    n_rows = [1000, 0, 555]
+    for tel_id, n in enumerate(n_rows):
+        create_dummy_table(tmp_path / f'tel_{tel_id}.h5', n)
+
+    hfiles = [tables.open_file(tmp_path / f'tel_{tel_id}.h5') for tel_id in range(len(n_rows))]
+    expected = vstack([Table(add_wl(hfile.root.parameters.read(), i, 0, None)) for i, hfile in enumerate(hfiles)])
+
+    with tables.open_file(tmp_path / 'stacked.h5', 'w') as hfile_out:
+        stacked = stack_tables_by_chunks(hfile_out, [hfile.root.parameters for hfile in hfiles], '/dl1', 'stacked',
+                                         modify_chunk=add_wl, chunk_size=100, createparents=True)
+        assert stacked.nrows == sum(n_rows)
+        np.testing.assert_array_equal(stacked.read(), expected.as_array())
+
+    for hfile in hfiles:
+        hfile.close()
+
+
+def test_stack_images_to_arrays(tmp_path):
+    n_rows, n_pixels = [300, 0, 155], 50
+    rng = np.random.default_rng(0)
+    with tables.open_file(tmp_path / 'images.h5', 'w') as hfile:
+        for tel_id, n in enumerate(n_rows):
+            images = np.zeros(n, dtype=[('event_id', 'i8'), ('image', 'f4', (n_pixels,)), ('tel_id', 'i2'),
+                                        ('image_mask', '?', (n_pixels,))])
+            images['event_id'] = np.arange(n)
+            images['image'] = rng.normal(size=(n, n_pixels))
+            images['tel_id'] = tel_id
+            images['image_mask'] = images['image'] > 0
+            hfile.create_table('/', f'tel_{tel_id:03d}', obj=images)
+
+    with tables.open_file(tmp_path / 'images.h5', 'a') as hfile:
+        input_tables = [hfile.get_node(f'/tel_{tel_id:03d}') for tel_id in range(len(n_rows))]
+        expected = np.concatenate([table.read() for table in input_tables])
+        group = stack_images_to_arrays(hfile, input_tables, '/dl1', 'LST_LSTCam_arrays', chunk_size=100,
+                                       createparents=True)
+
+        assert group.image.shape == (sum(n_rows), n_pixels)
+        assert group.image.chunkshape == (1, n_pixels)
+        np.testing.assert_array_equal(group.image[10:20], expected['image'][10:20])
+        np.testing.assert_array_equal(read_images_arrays(group).as_array(), expected)
+        np.testing.assert_array_equal(read_images_arrays(group, 290, 310, 3).as_array(), expected[290:310:3])
+
+
+def test_sky_to_camera_numpy():
+    rng = np.random.default_rng(0)
+    focal = 28.
+    for pointing_alt, pointing_az in [(70, 180), (20, 0), (90, 10)]:
+        alt = np.deg2rad(pointing_alt + rng.normal(0, 3, 1000))
+        az = np.deg2rad(pointing_az + rng.normal(0, 3, 1000))
+
+        camera_pos = sky_to_camera(alt * u.rad, az * u.rad, focal * u.m,
+                                   np.deg2rad(pointing_alt) * u.rad, np.deg2rad(pointing_az) * u.rad)
+        x, y = sky_to_camera_numpy(alt, az, focal, np.deg2rad(pointing_alt), np.deg2rad(pointing_az))
+
+        np.testing.assert_allclose(x, camera_pos.x.to_value(u.m), atol=1e-9)
+        np.testing.assert_allclose(y, camera_pos.y.to_value(u.m), atol=1e-9)
+
+
+def test_join_on_event_id():
+    rng = np.random.default_rng(0)
+    parameters = np.zeros(300, dtype=[('obs_id', 'i4'), ('event_id', 'i8'), ('tel_id', 'i2'), ('x', 'f4')])
+    parameters['event_id'] = rng.integers(0, 100, len(parameters))
+    parameters['tel_id'] = np.arange(len(parameters)) % 4 + 1
+    parameters['x'] = rng.normal(size=len(parameters))
+    mc_shower = np.zeros(90, dtype=[('event_id', 'i8'), ('obs_id', 'i4'), ('mc_energy', 'f8')])
+    mc_shower['event_id'] = rng.permutation(100)[:90]
+    mc_shower['mc_energy'] = rng.uniform(size=len(mc_shower))
+
+    expected = join(Table(parameters), Table(mc_shower), keys='event_id').as_array()
+    joined = join_on_event_id(parameters, mc_shower)
+
+    assert joined.dtype == expected.dtype
+    assert joined.dtype.names == ('obs_id_1', 'event_id', 'tel_id', 'x', 'obs_id_2', 'mc_energy')
+    # astropy does not keep the original order of the rows sharing the same event_id
+    np.testing.assert_array_equal(joined['event_id'], expected['event_id'])
+    np.testing.assert_array_equal(joined[np.lexsort((joined['x'], joined['event_id']))],
+                                  expected[np.lexsort((expected['x'], expected['event_id']))])
+
+    # mc_shower sorted once, joined by chunks of parameters
+    mc_shower_sorted = sort_on_key(mc_shower)
+    for start in range(0, len(parameters), 100):
+        np.testing.assert_array_equal(join_on_event_id(parameters[start:start + 100], mc_shower,
+                                                       right_sorted=mc_shower_sorted),
+                                      join_on_event_id(parameters[start:start + 100], mc_shower))
+
+
+def test_disp_and_mc_type_columns():
+    rng = np.random.default_rng(0)
+    run_array_direction, focal = (np.pi, np.deg2rad(70)), 28.
+    parameters = np.zeros(100, dtype=[('event_id', 'i8'), ('x', 'f4'), ('y', 'f4'), ('mc_alt', 'f8'), ('mc_az', 'f8')])
+    parameters['x'] = rng.uniform(-1, 1, len(parameters))
+    parameters['y'] = rng.uniform(-1, 1, len(parameters))
+    parameters['mc_alt'] = run_array_direction[1] + rng.normal(0, 0.02, len(parameters))
+    parameters['mc_az'] = run_array_direction[0] + rng.normal(0, 0.02, len(parameters))
+
+    table = append_disp_and_mc_type_columns(parameters, run_array_direction, focal, mc_type=101)
+    assert table.dtype.names == parameters.dtype.names + ('disp_dx', 'disp_dy', 'disp_norm', 'disp_angle', 'disp_sign',
+                                                          'src_x', 'src_y', 'mc_alt_tel', 'mc_az_tel', 'mc_type')
+    assert all(table.dtype[name] == np.float32 for name in table.dtype.names[len(parameters.dtype.names):])
+    assert (table['mc_type'] == 101).all()
+    np.testing.assert_array_equal(table[list(parameters.dtype.names)], parameters)
+    np.testing.assert_allclose(table['disp_dx'], table['src_x'] - parameters['x'], atol=1e-6)
+
+    # same source position with the astropy frames
+    astropy_table = append_disp_and_mc_type_columns(parameters, run_array_direction, focal, use_astropy_frames=True)
+    np.testing.assert_allclose(astropy_table['src_x'], table['src_x'], atol=1e-5)
+    assert 'mc_type' not in astropy_table.dtype.names
+def crash_worker(input_filename, output_filename, *args):
+    """worker of batch_main dying without a result, as when killed out of memory"""
+    os._exit(1)
+
+
+def test_batch_main_failing_files(tmp_path, monkeypatch):
+    input_filename = str(tmp_path / 'dl1_corrupted.h5')
+    with open(input_filename, 'w') as f:
+        f.write('not a hdf5 file')
+
+    # a failing conversion is reported, without partial output
+    failed_files = reorganizer300.batch_main([input_filename], output_dir=str(tmp_path / 'out'), n_workers=1)
+    assert list(failed_files) == [input_filename]
+    assert os.listdir(tmp_path / 'out') == []
+
+    # a dead worker breaks the pool: all its files are reported as failed instead of stopping the batch
+    monkeypatch.setattr(reorganizer300, '_reorganize_one_file', crash_worker)
+    input_filenames = [input_filename, str(tmp_path / 'dl1_other.h5')]
+    failed_files = reorganizer300.batch_main(input_filenames, output_dir=str(tmp_path / 'out'), n_workers=1)
+    assert sorted(failed_files) == input_filenames
+    assert 'BrokenProcessPool' in failed_files[input_filename]
+
+
+def test_benchmark_output_layouts(tmp_path):
+    input_filename = str(tmp_path / 'dl1_gamma_run1.h5')
+    create_hiperta_v300_file(input_filename, n_events=100, n_tels=2, n_pixels=10)
+    layouts_file = os.path.join(os.path.dirname(__file__), os.pardir, 'standard_configs',
+                                'reorganizer_benchmark_layouts.json')
+    with open(layouts_file) as f:
+        layouts = dict(list(json.load(f).items())[:2])
+
+    results = reorganizer300.benchmark_output_layouts(input_filename, layouts, str(tmp_path / 'out'))
+    assert list(results) == list(layouts)
+    assert all(result['size_MB'] > 0 for result in results.values())
+    assert os.listdir(tmp_path / 'out') == []
+
+    # a misspelled node is rejected before any conversion
+    with pytest.raises(ValueError):
+        reorganizer300.benchmark_output_layouts(input_filename, {'zstd': {'parameter': {'complevel': 5}}},
+                                                str(tmp_path / 'out'))
+
+
+def test_simulation_layout(tmp_path):
+    input_filename = str(tmp_path / 'dl1_gamma_run1.h5')
+    create_hipecta_file(input_filename, n_events=100, n_tels=2, n_pixels=10)
+    with tables.open_file(input_filename, 'a') as hfile:
+        hfile.create_carray('/simulation', 'histogram', obj=np.ones((10, 4)))
+    output_layout = {'simulation': {'complib': 'zlib', 'complevel': 1, 'chunkshape': [16]}}
+
+    reorganize_dl1(input_filename, str(tmp_path / 'dl1v06_reorganized_gamma_run1.h5'), output_layout=output_layout)
+
+    # the chunkshape is applied to each table of the recursively copied simulation group, not to the other leaves
+    with tables.open_file(tmp_path / 'dl1v06_reorganized_gamma_run1.h5') as hfile, tables.open_file(input_filename) as f:
+        for node in hfile.root.simulation:
+            assert node.filters.complevel == 1
+            np.testing.assert_array_equal(node.read(), f.get_node('/simulation', node.name).read())
+            if isinstance(node, tables.Table):
+                assert node.chunkshape == (16,)
+        assert hfile.root.simulation.histogram.chunkshape != (16,)
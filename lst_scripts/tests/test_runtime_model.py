@@ -0,0 +1,49 @@
+import json
+from lst_scripts.runtime_model import (parse_slurm_elapsed,
+                                       format_slurm_time,
+                                       read_sacct_records,
+                                       update_runtime_history,
+                                       fit_runtime_model,
+                                       get_time_and_partition)
+
+
+def test_slurm_times():
+    assert parse_slurm_elapsed('00:42') == 42
+    assert parse_slurm_elapsed('01:02:03') == 3723
+    assert parse_slurm_elapsed('2-01:00:00') == 2 * 86400 + 3600
+    assert format_slurm_time(3723) == '0-01:03:00'
+    assert format_slurm_time(2 * 86400 + 60) == '2-00:01:00'
+
+
+def test_runtime_model(tmp_path):
+    sacct_output = '10_0|00:10:00|COMPLETED\n10_0.batch|00:10:00|COMPLETED\n10_1|00:20:00|COMPLETED\n' \
+                   '10_2|00:01:00|FAILED\n11|01:00:00|COMPLETED\n12|00:30:00|CANCELLED by 0\n'
+    records = read_sacct_records(sacct_output)
+    assert records == {'10_0': (600, 'COMPLETED'), '10_1': (1200, 'COMPLETED'), '10_2': (60, 'FAILED'),
+                       '11': (3600, 'COMPLETED'), '12': (1800, 'CANCELLED')}
+
+    job_inputs = {'10': {'stage': 'r0_to_dl1', 'particle': 'proton', 'input_bytes': [1e9, 2e9, 3e9]},
+                  '11': {'stage': 'merge', 'particle': 'proton', 'input_bytes': 1e10},
+                  '12': {'stage': 'merge', 'particle': 'gamma', 'input_bytes': 1e10}}
+    history_file = tmp_path / 'history.json'
+    update_runtime_history(str(history_file), job_inputs, records)
+    history = update_runtime_history(str(history_file), job_inputs, records)
+    assert json.loads(history_file.read_text()) == history
+    assert sorted(record['jobid'] for record in history) == ['10_0', '10_1', '11']
+
+    model = fit_runtime_model(history)
+    assert sorted(model) == [('merge', 'proton'), ('r0_to_dl1', 'proton')]
+    assert abs(model[('r0_to_dl1', 'proton')]['slope'] - 600 / 1e9) < 1e-12
+
+    # 3 GB --> 1800 s x 1.2
+    assert get_time_and_partition(model, 'r0_to_dl1', 'proton', [1e9, 3e9], 'long') == ('short', '0-00:36:00')
+    assert get_time_and_partition(model, 'r0_to_dl1', 'proton', 1e11, 'short') == ('long', '0-20:00:00')
+    # default time limit without prediction, by stage and particle else by stage
+    assert get_time_and_partition(model, 'r0_to_dl1', 'gamma', 1e9, 'short') == ('short', '0-04:00:00')
+    assert get_time_and_partition({}, 'r0_to_dl1', 'proton', [1e9], 'long') == ('long', '2-00:00:00')
+    assert get_time_and_partition(None, 'r0_to_dl1_rta', 'proton', [1e9], 'short') == ('short', '0-04:00:00')
+    assert get_time_and_partition(model, 'merge', 'proton', None, 'short') == ('short', '0-04:00:00')
+    assert get_time_and_partition({}, 'unknown_stage', 'proton', 1e9, 'short') == ('short', None)
+    assert get_time_and_partition(model, 'prod_check', None, None, 'short') == ('short', '0-00:30:00')
+    assert get_time_and_partition({}, 'move_dl1', 'proton', 1e9, 'short') == ('short', '0-02:00:00')
+    assert [f.name for f in tmp_path.iterdir()] == ['history.json']
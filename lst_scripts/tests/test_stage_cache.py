@@ -0,0 +1,48 @@
+import os
+import json
+from lst_scripts.stage_cache import (get_dl1_fingerprint,
+                                     write_fingerprint,
+                                     find_cached_output,
+                                     link_cached_output,
+                                     FINGERPRINT_FILE)
+
+
+def test_stage_cache(tmp_path):
+    dl0_dir = tmp_path / 'DL0'
+    dl0_dir.mkdir()
+    for i in range(3):
+        (dl0_dir / f'gamma_run{i}.simtel.gz').write_text('dl0')
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({'tailcut': {'picture_thresh': 6}, 'random_forest_regressor_args': {'n': 1}}))
+
+    fingerprint, components = get_dl1_fingerprint(str(dl0_dir), str(config_file), '0.6.3', 'conda activate cta;', {})
+    assert 'random_forest_regressor_args' not in components['config']
+
+    # the RF arguments are not used to produce the DL1 files
+    config_file.write_text(json.dumps({'tailcut': {'picture_thresh': 6}, 'random_forest_regressor_args': {'n': 2}}))
+    assert get_dl1_fingerprint(str(dl0_dir), str(config_file), '0.6.3', 'conda activate cta;', {})[0] == fingerprint
+    assert get_dl1_fingerprint(str(dl0_dir), str(config_file), '0.6.2', 'conda activate cta;', {})[0] != fingerprint
+    # a DL0 file rewritten with the same size
+    os.utime(dl0_dir / 'gamma_run0.simtel.gz', ns=(0, 0))
+    assert get_dl1_fingerprint(str(dl0_dir), str(config_file), '0.6.3', 'conda activate cta;', {})[0] != fingerprint
+    fingerprint, components = get_dl1_fingerprint(str(dl0_dir), str(config_file), '0.6.3', 'conda activate cta;', {})
+    assert get_dl1_fingerprint(str(dl0_dir), str(config_file), '0.6.3', 'conda activate cta;',
+                               {'random_seed': 43})[0] != fingerprint
+    (dl0_dir / 'gamma_run3.simtel.gz').write_text('dl0')
+    assert get_dl1_fingerprint(str(dl0_dir), str(config_file), '0.6.3', 'conda activate cta;', {})[0] != fingerprint
+
+    old_dir = tmp_path / 'DL1' / 'prod_A'
+    (old_dir / 'training').mkdir(parents=True)
+    (old_dir / 'dl1_gamma_prod_A_training.h5').write_text('merged')
+    (old_dir / 'training' / 'dl1_gamma_run0.h5').write_text('dl1')
+    new_dir = tmp_path / 'DL1' / 'prod_B'
+
+    assert find_cached_output(str(new_dir), 'dl1', fingerprint) is None
+    write_fingerprint(str(old_dir), 'dl1', fingerprint)
+    assert find_cached_output(str(new_dir), 'models', fingerprint) is None
+    assert find_cached_output(str(new_dir), 'dl1', fingerprint) == str(old_dir)
+
+    link_cached_output(str(old_dir), str(new_dir), 'dl1', fingerprint)
+    assert (new_dir / 'dl1_gamma_prod_B_training.h5').read_text() == 'merged'
+    assert os.path.samefile(new_dir / 'training' / 'dl1_gamma_run0.h5', old_dir / 'training' / 'dl1_gamma_run0.h5')
+    assert json.loads((new_dir / FINGERPRINT_FILE).read_text()) == {'stage': 'dl1', 'fingerprint': fingerprint}
@@ -0,0 +1,74 @@
+import time
+import pytest
+from lst_scripts.workflow_dag import WorkflowDAG
+
+
+def build_dag(submitted):
+    def submit(node):
+        def submit_node(wait_jobids, results):
+            submitted[node] = wait_jobids
+            return {'jobids': f'{node[0]}_{node[1]}'}
+        return submit_node
+
+    def existing(results):
+        return {'jobids': ''}
+
+    dag = WorkflowDAG()
+    for particle in ['electron', 'proton']:
+        dag.add(('merge', particle, None), submit(('merge', particle)), existing=existing)
+    dag.add(('train', None, None), submit(('train', None)), [('merge', 'proton', None)], existing=existing)
+    for particle in ['electron', 'proton']:
+        dag.add(('dl1_to_dl2', particle, 'testing'), submit(('dl1_to_dl2', particle)),
+                [('merge', particle, None), ('train', None, None)])
+    return dag
+
+
+def test_workflow_dag():
+    submitted = {}
+    dag = build_dag(submitted)
+
+    with pytest.raises(ValueError):
+        dag.add(('check', None, None), None, [('dl2_to_dl3', None, None)])
+
+    results = dag.run()
+    assert list(results) == list(dag.nodes)
+    assert submitted[('dl1_to_dl2', 'electron')] == 'merge_electron,train_None'
+    assert submitted[('train', None)] == 'merge_proton'
+
+    # partial rerun: the outputs of the merge are already there
+    assert dag.select(['train']) == {('train', None, None), ('dl1_to_dl2', 'electron', 'testing'),
+                                     ('dl1_to_dl2', 'proton', 'testing')}
+    assert dag.select(['merge', 'dl1_to_dl2'], ['electron']) == {('merge', 'electron', None),
+                                                                 ('dl1_to_dl2', 'electron', 'testing')}
+    submitted.clear()
+    dag.run(dag.select(['train']))
+    assert submitted == {('train', None): '', ('dl1_to_dl2', 'electron'): 'train_None',
+                         ('dl1_to_dl2', 'proton'): 'train_None'}
+
+    with pytest.raises(ValueError):
+        dag.run(dag.select(['merge']) - {('dl1_to_dl2', 'proton', 'testing')})
+
+
+def test_workflow_dag_concurrency():
+    starts = {}
+
+    def sleep_node(node):
+        def submit(wait_jobids, results):
+            starts[node] = time.perf_counter()
+            time.sleep(0.3)
+            return {'jobids': ''}
+        return submit
+
+    # nodes added particle by particle: the merges waiting for their r0_to_dl1 must not hold the workers
+    dag = WorkflowDAG()
+    for particle in ['electron', 'gamma', 'gamma-diffuse', 'proton']:
+        dag.add(('r0_to_dl1', particle, None), sleep_node(('r0_to_dl1', particle)))
+        dag.add(('merge', particle, None), sleep_node(('merge', particle)), [('r0_to_dl1', particle, None)])
+
+    start = time.perf_counter()
+    dag.run(max_workers=4)
+    elapsed = time.perf_counter() - start
+
+    r0_starts = [starts[node] - start for node in starts if node[0] == 'r0_to_dl1']
+    assert max(r0_starts) < 0.15
+    assert elapsed < 0.8
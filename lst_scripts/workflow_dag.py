@@ -0,0 +1,158 @@
+# Declarative dependency graph of the jobs of the MC workflow
+#
+# Each node is a stage x particle x set_type (particle and set_type being None for the stages that do not depend on
+# them, e.g. train_pipe). A node batches its jobs once all the nodes it depends on have been batched, with a slurm
+# dependency (`afterok`) on their jobs only: e.g. the electron dl1_to_dl2 jobs wait for the electron merge and the
+# training, not for the merge of the other particles.
+#
+# A subset of the graph can be run (partial reruns): the nodes that are not run are expected to have produced their
+# outputs already, and are replaced by what their `existing` function reads from disk.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum number of nodes batched at the same time
+MAX_CONCURRENT_NODES = 4
+
+
+class WorkflowDAG:
+    """
+    Graph of the workflow nodes.
+
+    Nodes are added with `add`, from the first stages to the last ones, and batched with `run`. A node is a tuple
+    (stage, particle, set_type).
+    """
+
+    def __init__(self):
+        # node --> {'submit', 'dependencies', 'existing'}
+        self.nodes = {}
+
+    def add(self, node, submit, dependencies=(), existing=None):
+        """
+        Add a node to the graph.
+
+        Parameters
+        ----------
+        node : tuple
+            (stage, particle, set_type)
+        submit : callable
+            `submit(wait_jobids, results)` batches the jobs of the node and returns its result, a dict with at least
+            the key 'jobids' (str, jobids separated by ',') that the next nodes must wait for. `wait_jobids` are the
+            jobids of the dependencies and `results` the results of all the nodes batched or read so far
+        dependencies : list of tuple
+            nodes whose outputs are needed by this one. They must have been added before
+        existing : callable
+            `existing(results)` returns the result of the node when it is not run, its outputs being already there
+            (empty 'jobids'). None if the node cannot be skipped
+        """
+        for dependency in dependencies:
+            if dependency not in self.nodes:
+                raise ValueError(f'Unknown dependency {dependency} of {node}')
+        self.nodes[node] = {'submit': submit, 'dependencies': list(dependencies), 'existing': existing}
+
+    def descendants(self, nodes):
+        """The nodes and all the nodes depending on them, directly or not"""
+        selected = set(nodes)
+        for node, description in self.nodes.items():  # nodes are in topological order
+            if any(dependency in selected for dependency in description['dependencies']):
+                selected.add(node)
+        return selected
+
+    def select(self, stages=None, particles=None, downstream=True):
+        """
+        Nodes of the given stages and particles. When particles are given, the nodes without particle (e.g. the
+        training) are only selected as nodes depending on the selected ones.
+
+        Parameters
+        ----------
+        stages : list of str
+            all the stages if None
+        particles : list of str
+            all the particles if None
+        downstream : bool
+            also select the nodes depending on the selected ones, whose inputs change
+
+        Returns
+        -------
+        set of tuple
+        """
+        selected = {node for node in self.nodes
+                    if (stages is None or node[0] in stages) and (particles is None or node[1] in particles)}
+        return self.descendants(selected) if downstream else selected
+
+    def run(self, selected=None, max_workers=MAX_CONCURRENT_NODES):
+        """
+        Batch the jobs of the selected nodes. A node is queued once all its dependencies are done (it never holds a
+        worker while waiting for them), at most `max_workers` nodes being batched at the same time.
+
+        Parameters
+        ----------
+        selected : set of tuple
+            nodes to run, all of them if None. The result of the others is read with their `existing` function
+        max_workers : int
+            maximum number of nodes batched at the same time
+
+        Returns
+        -------
+        results : dict
+            node --> result, in the order of the graph. The results of the nodes not run have an empty 'jobids'.
+            The first exception raised by a node is raised again here, once the nodes not depending on it are done
+        """
+        selected = set(self.nodes) if selected is None else set(selected)
+        results = {}
+        errors = []
+        remaining = {node: set(description['dependencies']) for node, description in self.nodes.items()}
+        dependents = {node: [] for node in self.nodes}
+        for node, description in self.nodes.items():
+            for dependency in description['dependencies']:
+                dependents[dependency].append(node)
+
+        condition = threading.Condition()
+        running = [0]  # nodes queued and not finished
+
+        def run_node(node):
+            description = self.nodes[node]
+            if node in selected:
+                wait_jobids = ','.join(results[dependency]['jobids'] for dependency in description['dependencies']
+                                       if results[dependency]['jobids'] != '')
+                return description['submit'](wait_jobids, results)
+            elif description['existing'] is not None:
+                return description['existing'](results)
+            else:
+                raise ValueError(f'{node} must be run, its outputs cannot be read from a previous run')
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+
+            def queue(node):
+                future = pool.submit(run_node, node)
+                future.add_done_callback(lambda done: finish(node, done))
+
+            def finish(node, future):
+                ready = []
+                with condition:
+                    if future.exception() is not None:
+                        errors.append(future.exception())
+                    else:
+                        # the nodes depending on a failed node are never queued
+                        results[node] = future.result()
+                        for dependent in dependents[node]:
+                            remaining[dependent].discard(node)
+                            if not remaining[dependent]:
+                                ready.append(dependent)
+                    running[0] += len(ready) - 1
+                    condition.notify_all()
+                for dependent in ready:
+                    queue(dependent)
+
+            first_nodes = [node for node in self.nodes if not remaining[node]]
+            with condition:
+                running[0] = len(first_nodes)
+            for node in first_nodes:
+                queue(node)
+            with condition:
+                condition.wait_for(lambda: running[0] == 0)
+
+        if errors:
+            raise errors[0]
+
+        return {node: results[node] for node in self.nodes}
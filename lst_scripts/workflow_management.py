@@ -4,152 +4,20 @@
 
 import os
 import glob
+import json
 import pprint
 import yaml
+from job_executor import SlurmExecutor
+from workflow_dag import WorkflowDAG
 from onsite_mc_r0_to_dl1 import main as r0_to_dl1
 from onsite_mc_hiperta_r0_to_dl1lstchain import main as r0_to_dl1_rta
 from onsite_mc_merge_and_copy_dl1 import main as merge_and_copy_dl1
 from onsite_mc_train import main as train_pipe
 from onsite_mc_dl1_to_dl2 import main as dl1_to_dl2
 
-
-def batch_r0_to_dl1(input_dir, conf_file, prod_id, particles_loop, source_env):
-    """
-    Function to batch the r0_to_dl1 jobs by particle type.
-
-    The function will also create, arrange and return a dictionary with all the log of this stage.
-    Finally # TODO in V0.2 - Job management
-    the jobids of the batched jobs will be checked to confirm that there were no Error within the batched jobs.
-
-    Parameters
-    ----------
-    input_dir : str
-        Path to the DL0 files
-    conf_file : str
-        Path to a configuration file. If none is given, a standard configuration is applied
-    prod_id : str
-        Production ID. If None, _v00 will be used, indicating an official base production. Default = None.
-    particles_loop : list
-        list with the particles to be processed. Takes the global variable ALL_PARTICLES
-    source_env : str
-        source environment to select the desired conda environment to run the r0/1_to_dl1 stage.
-
-    Returns
-    -------
-    full_log : dict
-        Dictionary of dictionaries containing the full log of the batched jobs (jobids as keys) as well as the
-        4 more keys (one by particle) with all the jobs associated with each particle.
-
-    debug_log : dict
-            dictionary containing minimum information - jobids -  for log_reduced.txt
-
-    all_jobids_from_r0_dl1_stage : str
-        TBD
-
-    # ids_by_particle_ok : str  # TODO in V0.2 - Job management
-    #     a string (of chained jobids separated by ',' and without spaces between each element), to be passed to the
-    #     the next stage of the workflow (as a slurm dependency).
-
-    """
-    full_log = {'jobid_log': {}}
-    debug_log = {}
-    all_jobids_from_r0_dl1_stage = []
-    # ids_by_particle_ok = []
-
-    print("\n ==== START {} ==== \n".format('batch r0_to_dl1_workflow'))
-
-    for particle in particles_loop:
-        log, jobids_by_particle = r0_to_dl1(input_dir.format(particle),
-                                            config_file=conf_file,
-                                            prod_id=prod_id,
-                                            flag_full_workflow=True,
-                                            source_environment=source_env
-                                            )
-
-        # Create dictionary : jobid to full log information, and
-        #  the inverse dictionary, particle to the list of all the jobids of that same particle
-        full_log['jobid_log'].update(log)
-        full_log[particle] = ','.join(jobids_by_particle)
-        all_jobids_from_r0_dl1_stage.append(full_log[particle])  # Create a list with particles elements
-
-        for jid in jobids_by_particle:
-            debug_log[jid] = f'{particle} job from r0_to_dl1'
-
-        # TODO in V0.2 - Job management : how to launch the check of files and what to pass to merge (4 ids or ~300)
-        # jobid_summary = check_job_output_logs(full_log[particle])  # full_log is a dict of dicts
-        # ids_by_particle_ok.append(jobid_summary)
-
-    all_jobids_from_r0_dl1_stage = ','.join(all_jobids_from_r0_dl1_stage)  # Create a string to be directly passed
-
-    print("\n ==== END {} ==== \n".format('batch r0_to_dl1_workflow'))
-
-    return full_log, debug_log, all_jobids_from_r0_dl1_stage  # ids_by_particle_ok
-
-
-def batch_r0_to_dl1_rta(input_dir, conf_file_rta, prod_id, particles_loop, conf_file_lst):
-    """
-    Function to batch the r0_to_dl1 jobs by particle type, using the HiPeRTA code. Files in input_dir MUST had been
-     previously converted to *.h5
-
-    It will also create, arrange and return a dictionary with all the log of this stage.
-
-    Parameters
-    ----------
-    input_dir : str
-        Path to the R1 (h5 !) files
-
-    conf_file_rta : str
-        Path to a HiPeRTA configuration file. If none is given, a standard configuration is applied
-
-    prod_id : str
-        Production ID. If None, _v00 will be used, indicating an official base production. Default = None.
-
-    particles_loop : list
-        list with the particles to be processed. Takes the global variable ALL_PARTICLES
-
-    conf_file_lst : str
-        Path to a lstchain configuration. JUST to be copied at the same time as the rta_config to `/running_analysis/`.
-
-    Returns
-    -------
-    full_log : dict
-        Dictionary of dictionaries containing the full log of the batched jobs (jobids as keys) as well as the
-        4 more keys (one by particle) with all the jobs associated with each particle.
-
-    debug_log : dict
-            dictionary containing minimum information - jobids -  for log_reduced.txt
-
-    all_jobids_from_r0_dl1_stage : str
-        TBD
-    """
-    full_log = {'jobid_log': {}}
-    debug_log = {}
-    all_jobids_from_r0_dl1_stage = []
-
-    print("\n ==== START {} ==== \n".format('HiPeRTA_r0_to_dl1_workflow'))
-
-    for particle in particles_loop:
-        log, jobids_by_particle = r0_to_dl1_rta(input_dir.format(particle),
-                                                config_file=conf_file_rta,
-                                                prod_id=prod_id,
-                                                flag_full_workflow=True,
-                                                lst_config=conf_file_lst
-                                                )
-
-        # Create jobid to full log information dictionary.
-        # And the inverse dictionary, particle to the list of all the jobids of that same particle
-        full_log['jobid_log'].update(log)
-        full_log[particle] = ','.join(jobids_by_particle)
-        all_jobids_from_r0_dl1_stage.append(full_log[particle])  # Create a list with particles elements
-
-        for jid in jobids_by_particle:
-            debug_log[jid] = f'{particle} job from r0_to_dl1_RTA'
-
-    all_jobids_from_r0_dl1_stage = ','.join(all_jobids_from_r0_dl1_stage)  # Create a string to be directly passed
-
-    print("\n ==== END {} ==== \n".format('HiPeRTA_r0_to_dl1_workflow'))
-
-    return full_log, debug_log, all_jobids_from_r0_dl1_stage
+# Stages of the nodes of the MC workflow graph (see build_mc_workflow_dag)
+MC_WORKFLOW_STAGES = ['r0_to_dl1', 'merge_and_copy_dl1', 'dl1_fingerprint', 'train_pipe', 'models_fingerprint',
+                      'dl1_to_dl2', 'check']
 
 
 # def check_job_output_logs(dict_particle_jobid):
@@ -183,96 +51,7 @@ def batch_r0_to_dl1_rta(input_dir, conf_file_rta, prod_id, particles_loop, conf_
 #     return ids_single_particle_ok
 
 
-def batch_merge_and_copy_dl1(running_analysis_dir, log_jobs_from_r0_to_dl1, particles_loop, smart_merge=False,
-                             no_image_flag=True, prod_id=None):
-    """
-    Function to batch the onsite_mc_merge_and_copy function once the all the r0_to_dl1 jobs (batched by particle type)
-    have finished.
-
-    Batch 8 merge_and_copy_dl1 jobs ([train, test] x particle) + the move_dl1 and move_dir jobs (2 per particle).
-
-    Parameters
-    ----------
-    running_analysis_dir : str
-        Directory to dl1 files
-
-    log_jobs_from_r0_to_dl1 : dict
-        dictionary of dictionaries containing the log (jobids organized by particle) from the previous stage
-        (onsite_mc_r0_to_dl1)
-
-    smart_merge : bool
-        flag to indicate whether the merge of the files should be done with `--smart True` or `--smart False`,
-        controlling the argument of the `lstchain_merge_hdf5_files.py` script (batched in this function).
-
-    particles_loop : list
-        list with the particles to be processed. Takes the global variable ALL_PARTICLES
-
-    no_image_flag : bool
-        flag to indicate whether the --no-image argument of the `lstchain_merge_hdf5_files.py` script (batched in
-        this function) should be either True or False.
-
-    prod_id : str
-        TBD
-
-    Returns
-    -------
-    log_merge_and_copy : dict
-        Dictionary containing the log of the batched merge_and_copy_dl1 jobs
-
-    jobid_4_train : str
-         string containing the jobids to be passed to the next stage of the workflow (as a slurm dependency)
-    all_merge : str
-        string containing all the jobs to indicate that all the dl1 are correctly finished (for dl1_to_dl2)
-    debug_log : dict
-        Debug purposes
-
-    """
-    log_merge_and_copy = {}
-    jobid_4_train = []
-    all_jobs_from_merge_stage = []
-    debug_log = {}
-
-    if smart_merge == 'lst':
-        merge_flag = True
-    elif smart_merge == 'rta':
-        merge_flag = False
-    elif smart_merge:
-        merge_flag = True
-    elif not smart_merge:
-        merge_flag = False
-    else:
-        merge_flag = False
-
-    print("\n ==== START {} ==== \n".format('batch merge_and_copy_dl1_workflow'))
-
-    for particle in particles_loop:
-        log, jobids, jobid_debug = merge_and_copy_dl1(running_analysis_dir.format(particle),
-                                                      flag_full_workflow=True,
-                                                      particle2jobs_dict=log_jobs_from_r0_to_dl1,
-                                                      particle=particle,
-                                                      flag_merge=merge_flag,
-                                                      flag_no_image=no_image_flag
-                                                      )
-
-        log_merge_and_copy.update(log)
-        all_jobs_from_merge_stage.append(jobid_debug)
-        if particle == 'gamma-diffuse' or particle == 'proton':
-            jobid_4_train.append(jobids)
-
-        debug_log[jobids] = f'{particle} merge_and_copy-jobs - INDEED IT IS JUST PASSED move_dl1 jobid -' \
-                            f' that will go to dl1_to_dl2. They depend on the following' \
-                            f' {log_jobs_from_r0_to_dl1[particle]} r0_t0_dl1 jobs.'
-        debug_log[jobid_debug] = f'Are all the {particle} jobs that have been launched in merge_and_copy_dl1.'
-
-    jobid_4_train = ','.join(jobid_4_train)
-    all_jobs_from_merge_stage = ','.join(all_jobs_from_merge_stage)
-
-    print("\n ==== END {} ==== \n".format('batch merge_and_copy_dl1_workflow'))
-
-    return log_merge_and_copy, jobid_4_train, all_jobs_from_merge_stage, debug_log
-
-
-def batch_train_pipe(log_from_merge, config_file, jobids_from_merge, source_env):
+def batch_train_pipe(log_from_merge, config_file, jobids_from_merge, source_env, executor=None):
     """
     Function to batch the lstchain train_pipe once the proton and gamma-diffuse merge_and_copy_dl1 batched jobs have
     finished.
@@ -281,7 +60,7 @@ def batch_train_pipe(log_from_merge, config_file, jobids_from_merge, source_env)
     ----------
     log_from_merge : dict
         dictionary containing the output name and abs path to the DL1 files, derived in merge_and_copy and saved
-        through the log
+        through the log (and the bytes of DL0 files of the training datasets, `dl0_bytes`, when known)
 
     config_file : str
         Path to a configuration file. If none is given, a standard configuration is applied
@@ -293,6 +72,9 @@ def batch_train_pipe(log_from_merge, config_file, jobids_from_merge, source_env)
     source_env : str
         source environment to select the desired conda environment to run train_pipe and dl1_to_dl2 stages
 
+    executor : SlurmExecutor or LocalExecutor
+        executor of the batched jobs (see job_executor). Slurm by default.
+
     Returns
     -------
     log_train : dict
@@ -316,12 +98,18 @@ def batch_train_pipe(log_from_merge, config_file, jobids_from_merge, source_env)
     gamma_dl1_train_file = log_from_merge['gamma-diffuse']['training']['train_path_and_outname_dl1']
     proton_dl1_train_file = log_from_merge['proton']['training']['train_path_and_outname_dl1']
 
+    # to predict the runtime of the job, unknown if the workflow did not start from r0_to_dl1
+    dl0_bytes = [log_from_merge[particle]['training'].get('dl0_bytes') for particle in ['gamma-diffuse', 'proton']]
+    dl0_bytes = None if None in dl0_bytes else sum(dl0_bytes)
+
     log_train, jobid_4_dl1_to_dl2, model_path = train_pipe(gamma_dl1_train_file,
                                                            proton_dl1_train_file,
                                                            config_file=config_file,
                                                            source_environment=source_env,
                                                            flag_full_workflow=True,
-                                                           wait_ids_proton_and_gammas=jobids_from_merge
+                                                           wait_ids_proton_and_gammas=jobids_from_merge,
+                                                           executor=executor,
+                                                           dl0_bytes=dl0_bytes
                                                            )
 
     debug_log[jobid_4_dl1_to_dl2] = f'The single jobid from train_pipe that depends of {jobids_from_merge} - merge' \
@@ -332,85 +120,49 @@ def batch_train_pipe(log_from_merge, config_file, jobids_from_merge, source_env)
     return log_train, jobid_4_dl1_to_dl2, model_path, debug_log
 
 
-def batch_dl1_to_dl2(dl1_directory, path_to_models, config_file, jobid_from_training, jobids_from_merge,
-                     dict_with_dl1_paths, particles_loop, source_env):
+def batch_dl2_to_dl3():
+    pass
+
+
+def batch_stage_fingerprints(stage, fingerprints, wait_jobids, executor=None):
     """
-    Function to batch the dl1_to_dl2 stage once the lstchain train_pipe batched jobs have finished.
+    Batch the job writing the fingerprints of a stage next to its outputs (see stage_cache), once all the jobs of the
+    stage have finished correctly. Later productions can then reuse these outputs.
 
     Parameters
     ----------
-    dl1_directory : str
-        Path to the dl1 directory
-
-    path_to_models : str
-        Path to the model directory - should be taken from train_pipe
-
-    config_file : str
-        Path to a configuration file. If none is given, a standard configuration is applied
-
-    jobid_from_training : str
-        string containing the jobid from the jobs batched in the train_pipe stage, to be passed to the
-        dl1_to_dl2 function (as a slurm dependency)
+    stage : str
+        stage of the workflow, `dl1` or `models`
 
-    jobids_from_merge : str
-        string containing the jobid from the jobs batched in the merge_and_copy_dl1 stage,
-        to be passed to the dl1_to_dl2 function (as a slurm dependency)
+    fingerprints : dict
+        output directory --> fingerprint of the stage outputs in it
 
-    dict_with_dl1_paths : dict
-        Indeed the log of the merge_and_copy stage, where the final names of the dl1 files were stored
+    wait_jobids : str
+        jobids of the stage (separated by ','), to be passed as a slurm dependency
 
-    particles_loop : list
-        list with the particles to be processed. Takes the global variable ALL_PARTICLES
-
-    source_env : str
-        source environment to select the desired conda environment to run train_pipe and dl1_to_dl2 stages
+    executor : SlurmExecutor or LocalExecutor
+        executor of the batched jobs (see job_executor). Slurm by default.
 
     Returns
     -------
-    log_batch_dl1_to_dl2 : dict
-        Dictionary containing the log of the batched dl1_to_dl2 jobs
-
-    jobid_4_dl2_to_dl3 : str
-        string containing the jobids to be passed to the next stage of the workflow (as a slurm dependency)
-
     debug_log : dict
         Debug purposes
-
     """
-
-    log_dl1_to_dl2 = {}
-    jobid_for_dl2_to_dl3 = []
     debug_log = {}
+    if executor is None:
+        executor = SlurmExecutor()
 
-    print("\n ==== START {} ==== \n".format('batch dl1_to_dl2_workflow'))
+    cmd = f'python stage_cache.py --stage {stage}'
+    for output_dir, fingerprint in fingerprints.items():
+        cmd += f' --write {output_dir} {fingerprint}'
 
-    for particle in particles_loop:
-        log, jobid = dl1_to_dl2(dl1_directory.format(particle),
-                                path_models=path_to_models,
-                                config_file=config_file,
-                                flag_full_workflow=True,
-                                particle=particle,
-                                wait_jobid_train_pipe=jobid_from_training,
-                                wait_jobids_merge=jobids_from_merge,
-                                dictionary_with_dl1_paths=dict_with_dl1_paths,
-                                source_environment=source_env
-                                )
-
-        log_dl1_to_dl2.update(log)
-        jobid_for_dl2_to_dl3.append(jobid)
-
-        debug_log[jobid] = f'{particle} job from dl1_to_dl2 that depends both on : {jobid_from_training} training ' \
-                           f'jobs AND from {jobids_from_merge} merge_and_copy_dl1 jobs'
-
-    jobid_4_dl2_to_dl3 = ','.join(jobid_for_dl2_to_dl3)
-
-    print("\n ==== END {} ==== \n".format('batch dl1_to_dl2_workflow'))
+    jobid = executor.submit(cmd, job_name=f'{stage}_fingerprint', wait_jobids=wait_jobids,
+                            job_inputs={'stage': 'fingerprint', 'particle': None, 'input_bytes': None})
+    print(f'\tSubmitted batch job {jobid}. It will write the {stage} fingerprints when {wait_jobids} finish.')
 
-    return log_dl1_to_dl2, jobid_4_dl2_to_dl3, debug_log
+    debug_log[jobid] = f'{stage} fingerprints job that depends on the {wait_jobids} jobs'
 
-
-def batch_dl2_to_dl3():
-    pass
+    return debug_log
 
 
 def save_log_to_file(dictionary, output_file, log_format, workflow_step=None):
@@ -484,12 +236,16 @@ def create_dict_with_filenames(dl1_directory, particles_loop):
 
 
 def batch_mc_production_check(jobids_from_r0_to_dl1, jobids_from_merge, jobids_from_train_pipe,
-                              jobids_from_dl1_to_dl2, prod_id):
+                              jobids_from_dl1_to_dl2, prod_id, executor=None, runtime_history=None):
     """
     Check that the dl1_to_dl2 stage, and therefore, the whole workflow has ended correctly.
     The machine information of each job will be dumped to the file.
     The file will take the form `check_MC_prodID_{prod_id}_OK.txt`
 
+    With slurm, the elapsed times of the jobs batched with their inputs are then added to the runtime history, from
+    which the runtime of the jobs of the next productions is predicted (see runtime_model). Their inputs are saved in
+    `runtime_inputs_prodID_{prod_id}.json`.
+
     Parameters
     ----------
     jobids_from_dl1_to_dl2 : str
@@ -498,6 +254,12 @@ def batch_mc_production_check(jobids_from_r0_to_dl1, jobids_from_merge, jobids_f
     prod_id : str
         MC Production ID.
 
+    executor : SlurmExecutor or LocalExecutor
+        executor of the batched jobs (see job_executor). Slurm by default.
+
+    runtime_history : str
+        json runtime history file to update. None to not update it.
+
     Returns
     -------
     debug_log : dict
@@ -505,22 +267,25 @@ def batch_mc_production_check(jobids_from_r0_to_dl1, jobids_from_merge, jobids_f
 
     """
     debug_log = {}
+    if executor is None:
+        executor = SlurmExecutor()
 
-    all_pipeline_jobs = jobids_from_r0_to_dl1 + ',' + jobids_from_merge + ',' + jobids_from_train_pipe + ',' + \
-                        jobids_from_dl1_to_dl2
+    # The stages reused from previous productions (see stage_cache) have no jobs
+    all_pipeline_jobs = ','.join(jobids for jobids in [jobids_from_r0_to_dl1, jobids_from_merge, jobids_from_train_pipe,
+                                                       jobids_from_dl1_to_dl2] if jobids != '')
 
     # Save machine info into the check file
     cmd_wrap = f'touch check_MC_prodID_{prod_id}_OK.txt; '
-    cmd_wrap += f'sacct --format=jobid,jobname,nodelist,cputime,state,exitcode,' \
-                f'avediskread,maxdiskread,avediskwrite,maxdiskwrite,AveVMSize,MaxVMSize,avecpufreq,' \
-                f'reqmem -j {all_pipeline_jobs} >> check_MC_prodID_{prod_id}_OK.txt'
-    batch_cmd = 'sbatch -p short --parsable --dependency=afterok:{} -J {} --wrap="{}"'.format(
-        jobids_from_dl1_to_dl2,
-        'prod_check',
-        cmd_wrap
-    )
-
-    jobid = os.popen(batch_cmd).read().strip('\n')
+    cmd_wrap += executor.accounting_command(all_pipeline_jobs, f'check_MC_prodID_{prod_id}_OK.txt')
+
+    if runtime_history is not None and executor.name == 'slurm' and executor.job_inputs:
+        job_inputs_file = os.path.abspath(f'runtime_inputs_prodID_{prod_id}.json')
+        with open(job_inputs_file, 'w') as f:
+            json.dump(executor.job_inputs, f)
+        cmd_wrap += f'; python runtime_model.py -i {job_inputs_file} -hist {runtime_history}'
+
+    jobid = executor.submit(cmd_wrap, job_name='prod_check', wait_jobids=jobids_from_dl1_to_dl2,
+                            job_inputs={'stage': 'prod_check', 'particle': None, 'input_bytes': None})
     print(f'\n\n\tSubmitted batch CHECK-job {jobid}\n\n')
 
     # and in case the code brakes, here there is a summary of all the jobs by stages
@@ -531,3 +296,224 @@ def batch_mc_production_check(jobids_from_r0_to_dl1, jobids_from_merge, jobids_f
     debug_log['dl1_dl2'] = jobids_from_dl1_to_dl2
 
     return debug_log
+
+
+def build_mc_workflow_dag(workflow_kind, dl0_data_dir, running_analysis_dir, dl1_data_dir, models_dir, prod_id,
+                          particles_loop, config_file_lst, source_env, executor=None, config_file_rta=None,
+                          no_image_flag=True, pack_by_size=False, resume=False, merge_fan_in=0, streaming_merge=0,
+                          dl1_fingerprints=None, models_fingerprint=None, runtime_history=None, train_test_ratio=0.5,
+                          random_seed=42):
+    """
+    Dependency graph of the MC workflow (see workflow_dag), each stage being batched by particle (and set type for
+    dl1_to_dl2) as soon as its own inputs are batched:
+
+        r0_to_dl1 (particle) --> merge_and_copy_dl1 (particle) --> dl1_fingerprint (particle)
+        merge_and_copy_dl1 (gamma-diffuse, proton) --> train_pipe --> models_fingerprint
+        merge_and_copy_dl1 (particle) + train_pipe --> dl1_to_dl2 (particle, set_type) --> check
+
+    e.g. the electron dl1_to_dl2 jobs only wait for the electron merge and the training.
+
+    Parameters
+    ----------
+    workflow_kind : str
+        'lst' or 'rta'
+    dl0_data_dir : str
+        Path to the DL0 (R0 for rta) files, with `{}` in place of the particle
+    running_analysis_dir : str
+        Path to the running_analysis directory, with `{}` in place of the particle
+    dl1_data_dir : str
+        Path to the final DL1 directory, with `{}` in place of the particle
+    models_dir : str
+        Path to the models directory, to read the models when the training is not run
+    prod_id : str
+        Production ID
+    particles_loop : list
+        list with the particles to be processed. Takes the global variable ALL_PARTICLES
+    config_file_lst : str
+        Path to a lstchain configuration file. If none is given, a standard configuration is applied
+    source_env : str
+        source environment to select the desired conda environment to run the jobs
+    executor : SlurmExecutor or LocalExecutor
+        executor of the batched jobs (see job_executor). Slurm by default.
+    config_file_rta : str
+        Path to a HiPeRTA configuration file (rta workflow)
+    no_image_flag : bool
+        --no-image argument of the merge of the DL1 files
+    pack_by_size : bool
+        pack the DL0 files into r0_to_dl1 jobs according to their size (lst workflow)
+    resume : bool
+        resume the r0_to_dl1 stage of the production (lst workflow)
+    merge_fan_in : int
+        number of files merged by job in a tree-reduction merge of the DL1 files, 0 for a single merge job (see
+        onsite_mc_merge_and_copy_dl1)
+    streaming_merge : int
+        number of r0_to_dl1 array tasks whose DL1 files are appended to the merged file as soon as they finish, 0 to
+        wait for all the r0_to_dl1 jobs (see onsite_mc_merge_and_copy_dl1)
+    dl1_fingerprints : dict
+        particle --> fingerprint of its DL1 files (see stage_cache). No dl1_fingerprint nodes if None
+    models_fingerprint : str
+        fingerprint of the models (see stage_cache). No models_fingerprint node if None
+    runtime_history : str
+        json runtime history file updated by the check job (see batch_mc_production_check)
+    train_test_ratio : float
+        ratio of training data of the r0_to_dl1 stage (lst workflow)
+    random_seed : int
+        random seed of the split into training and testing data of the r0_to_dl1 stage (lst workflow)
+
+    Returns
+    -------
+    dag : WorkflowDAG
+        graph whose node results are dicts with the keys 'jobids', and 'log' and 'debug' (logs to be saved) when the
+        node was run
+    """
+    if executor is None:
+        executor = SlurmExecutor()
+
+    dag = WorkflowDAG()
+
+    def r0_to_dl1_node(particle):
+        def submit(wait_jobids, results):
+            if workflow_kind == 'lst':
+                log, jobids = r0_to_dl1(dl0_data_dir.format(particle),
+                                        config_file=config_file_lst,
+                                        train_test_ratio=train_test_ratio,
+                                        random_seed=random_seed,
+                                        prod_id=prod_id,
+                                        flag_full_workflow=True,
+                                        source_environment=source_env,
+                                        executor=executor,
+                                        pack_by_size=pack_by_size,
+                                        resume=resume
+                                        )
+            else:
+                log, jobids = r0_to_dl1_rta(dl0_data_dir.format(particle),
+                                            config_file=config_file_rta,
+                                            prod_id=prod_id,
+                                            flag_full_workflow=True,
+                                            lst_config=config_file_lst,
+                                            executor=executor
+                                            )
+            return {'jobids': ','.join(jobids),
+                    'log': log,
+                    'debug': {jobid: f'{particle} job from r0_to_dl1' for jobid in jobids}}
+        return submit
+
+    def merge_node(particle):
+        def submit(wait_jobids, results):
+            r0_to_dl1_log = results[('r0_to_dl1', particle, None)]['log']
+            log, jobid_move_dl1, all_jobids = merge_and_copy_dl1(running_analysis_dir.format(particle),
+                                                                 flag_full_workflow=True,
+                                                                 particle2jobs_dict={particle: wait_jobids,
+                                                                                     'jobid_log': r0_to_dl1_log},
+                                                                 particle=particle,
+                                                                 flag_merge=False,
+                                                                 flag_no_image=no_image_flag,
+                                                                 executor=executor,
+                                                                 merge_fan_in=merge_fan_in,
+                                                                 streaming_merge=streaming_merge
+                                                                 )
+            debug_log = {jobid_move_dl1: f'{particle} move_dl1 job, that depends on the {wait_jobids} r0_to_dl1 '
+                                         f'jobs',
+                         all_jobids: f'Are all the {particle} jobs that have been launched in merge_and_copy_dl1.'}
+            return {'jobids': jobid_move_dl1, 'all_jobids': all_jobids, 'dl1_paths': log[particle], 'log': log,
+                    'debug': debug_log}
+
+        def existing(results):
+            # Create just the needed dictionary inputs (dl1 files must exist !)
+            return {'jobids': '', 'all_jobids': '',
+                    'dl1_paths': create_dict_with_filenames(dl1_data_dir, [particle])[particle]}
+        return submit, existing
+
+    def dl1_fingerprint_node(particle):
+        def submit(wait_jobids, results):
+            debug_log = batch_stage_fingerprints('dl1', {dl1_data_dir.format(particle): dl1_fingerprints[particle]},
+                                                 results[('merge_and_copy_dl1', particle, None)]['all_jobids'],
+                                                 executor=executor)
+            return {'jobids': ','.join(debug_log), 'debug': debug_log}
+        return submit
+
+    def train_submit(wait_jobids, results):
+        dl1_paths = {particle: results[('merge_and_copy_dl1', particle, None)]['dl1_paths']
+                     for particle in ['gamma-diffuse', 'proton']}
+        log, jobid, model_path, debug_log = batch_train_pipe(dl1_paths, config_file_lst, wait_jobids,
+                                                             source_env=source_env, executor=executor)
+        return {'jobids': jobid, 'models_dir': model_path, 'log': log, 'debug': debug_log}
+
+    def models_fingerprint_submit(wait_jobids, results):
+        debug_log = batch_stage_fingerprints('models',
+                                             {results[('train_pipe', None, None)]['models_dir']: models_fingerprint},
+                                             wait_jobids, executor=executor)
+        return {'jobids': ','.join(debug_log), 'debug': debug_log}
+
+    def dl1_to_dl2_node(particle, set_type):
+        def submit(wait_jobids, results):
+            jobid_train = results[('train_pipe', None, None)]['jobids']
+            jobid_merge = results[('merge_and_copy_dl1', particle, None)]['jobids']
+            log, jobids = dl1_to_dl2(dl1_data_dir.format(particle),
+                                     path_models=results[('train_pipe', None, None)]['models_dir'],
+                                     config_file=config_file_lst,
+                                     flag_full_workflow=True,
+                                     particle=particle,
+                                     wait_jobid_train_pipe=jobid_train,
+                                     wait_jobids_merge=jobid_merge,
+                                     dictionary_with_dl1_paths={
+                                         particle: results[('merge_and_copy_dl1', particle, None)]['dl1_paths']},
+                                     source_environment=source_env,
+                                     executor=executor,
+                                     set_types=[set_type]
+                                     )
+            debug_log = {jobids: f'{particle} {set_type} job from dl1_to_dl2 that depends both on : {jobid_train} '
+                                 f'training job AND from {jobid_merge} merge_and_copy_dl1 job'}
+            return {'jobids': jobids, 'log': log, 'debug': debug_log}
+        return submit
+
+    def check_submit(wait_jobids, results):
+        def stage_jobids(stage, key='jobids'):
+            # the fingerprint nodes, that the check does not wait for, may still add their results
+            return ','.join(result[key] for node, result in dict(results).items()
+                            if node[0] == stage and result[key] != '')
+
+        debug_log = batch_mc_production_check(stage_jobids('r0_to_dl1'),
+                                              stage_jobids('merge_and_copy_dl1', key='all_jobids'),
+                                              stage_jobids('train_pipe'),
+                                              wait_jobids,
+                                              prod_id=prod_id,
+                                              executor=executor,
+                                              runtime_history=runtime_history)
+        return {'jobids': '', 'debug': debug_log}
+
+    def not_run(results):
+        return {'jobids': ''}
+
+    def r0_to_dl1_existing(results):
+        return {'jobids': '', 'log': {}}
+
+    for particle in particles_loop:
+        dag.add(('r0_to_dl1', particle, None), r0_to_dl1_node(particle), existing=r0_to_dl1_existing)
+        merge_submit, merge_existing = merge_node(particle)
+        dag.add(('merge_and_copy_dl1', particle, None), merge_submit, [('r0_to_dl1', particle, None)],
+                existing=merge_existing)
+        if dl1_fingerprints is not None:
+            dag.add(('dl1_fingerprint', particle, None), dl1_fingerprint_node(particle),
+                    [('merge_and_copy_dl1', particle, None)], existing=not_run)
+
+    def train_existing(results):
+        return {'jobids': '', 'models_dir': models_dir}
+
+    dag.add(('train_pipe', None, None), train_submit,
+            [('merge_and_copy_dl1', particle, None) for particle in ['gamma-diffuse', 'proton']],
+            existing=train_existing)
+    if models_fingerprint is not None:
+        dag.add(('models_fingerprint', None, None), models_fingerprint_submit, [('train_pipe', None, None)],
+                existing=not_run)
+
+    dl1_to_dl2_nodes = []
+    for particle in particles_loop:
+        for set_type in ['training', 'testing']:
+            dag.add(('dl1_to_dl2', particle, set_type), dl1_to_dl2_node(particle, set_type),
+                    [('merge_and_copy_dl1', particle, None), ('train_pipe', None, None)], existing=not_run)
+            dl1_to_dl2_nodes.append(('dl1_to_dl2', particle, set_type))
+
+    dag.add(('check', None, None), check_submit, dl1_to_dl2_nodes, existing=not_run)
+
+    return dag